@@ -0,0 +1,156 @@
+import itertools
+import math
+import random
+import sys
+
+from typing import Iterator
+
+from imagegeneration import ImageGeneration, ImageGenerationResult
+from imagegenerationdb import ImageGenerationDb
+
+
+# Single Responsibility Principle (SRP): This class has the single responsibility of sweeping (exploring) the image aspect
+# combinations for a subject.
+# The cartesian product of the aspect tables (millions of combinations) is never materialized: each combination is
+# addressed by its index, a mixed-radix number with one digit per aspect table, and decoded on demand.  Combinations are
+# enumerated in order, sampled at random, or sampled stratified (each value of each aspect table is used equally often, in
+# a shuffled order), with the sampling being reproducible given its seed.  Prompts are deduplicated, and the generations
+# are fed lazily to the bounded, concurrent batch of ImageGeneration, capped by the budget (total number of images).
+class AspectSweep:
+    # Sampling gives up once this many consecutive combinations were duplicates (i.e. the space is nearly exhausted).
+    MAX_CONSECUTIVE_DUPLICATES = 1000
+
+    class Mode:
+        EXHAUSTIVE = "exhaustive"
+        RANDOM = "random"
+        STRATIFIED = "stratified"
+
+    def __init__(
+        self,
+        image_generation: ImageGeneration,
+        catalog: dict[str, list[str]] = None,
+    ):
+        self._image_generation = image_generation
+        self._db = image_generation.db
+        catalog = catalog if catalog is not None else self._db.get_catalog()
+        self.tables = tuple(
+            table
+            for table in ImageGenerationDb.Entity.ASPECT_TABLES
+            if table in catalog
+        )
+        self._values = tuple(tuple(catalog[table]) for table in self.tables)
+
+    # Number of aspect combinations.
+    def size(self) -> int:
+        return math.prod(len(values) for values in self._values)
+
+    def combination(self, index: int) -> dict[str, str]:
+        combination = {}
+        for table, values in zip(reversed(self.tables), reversed(self._values)):
+            index, digit = divmod(index, len(values))
+            combination[table] = values[digit]
+        return {table: combination[table] for table in self.tables}
+
+    # Indexes of the combinations, in the order of the sweep mode (without repetition).
+    def indexes(self, mode: str = Mode.EXHAUSTIVE, seed: int = None) -> Iterator[int]:
+        if mode == self.Mode.EXHAUSTIVE:
+            return iter(range(self.size()))
+        rng = random.Random(seed)
+        if mode == self.Mode.RANDOM:
+            return self._unique(iter(lambda: rng.randrange(self.size()), None))
+        if mode == self.Mode.STRATIFIED:
+            return self._unique(self._stratified(rng))
+        raise ValueError(f"Unknown sweep mode: {mode}")
+
+    # Datasets (as submitted by the view) of the subject, one per combination.
+    def datasets(
+        self, subject: str, mode: str = Mode.EXHAUSTIVE, seed: int = None
+    ) -> Iterator[dict]:
+        for index in self.indexes(mode, seed):
+            dataset = self.combination(index)
+            dataset[ImageGeneration.OpenApi.PROMPT_TEXT] = subject
+            yield dataset
+
+    # Distinct prompts of the subject.  Prompts that were already generated (i.e. are in the event log), are optionally
+    # skipped as well.
+    def prompts(
+        self,
+        subject: str,
+        mode: str = Mode.EXHAUSTIVE,
+        seed: int = None,
+        skip_generated: bool = False,
+    ) -> Iterator[str]:
+        seen = set[str]()
+        for dataset in self.datasets(subject, mode, seed):
+            prompt = self._image_generation.build_image_prompt(dataset)
+            prompt_hash = ImageGenerationDb.prompt_hash(prompt)
+            if prompt_hash in seen:
+                continue
+            seen.add(prompt_hash)
+            if skip_generated and self._db.get_event_log_by_prompt(prompt):
+                continue
+            yield prompt
+
+    # Generates up to budget images of the subject (at most max_workers at a time), yielding their results as they complete.
+    # Prompts are only built as generation slots become available.
+    def run(
+        self,
+        subject: str,
+        configuration: dict,
+        budget: int,
+        mode: str = Mode.STRATIFIED,
+        seed: int = None,
+        max_workers: int = ImageGeneration.BATCH_MAX_WORKERS,
+        skip_generated: bool = False,
+    ) -> Iterator[ImageGenerationResult]:
+        prompts = self.prompts(subject, mode, seed, skip_generated)
+        requests = (
+            (prompt, configuration) for prompt in itertools.islice(prompts, budget)
+        )
+        return self._image_generation.request_image_generation_batch(
+            requests, max_workers
+        )
+
+    # Each aspect table cycles through its values in a shuffled order (reshuffled upon each cycle), so that every value is
+    # used equally often, while the values of the different tables are combined at random.
+    def _stratified(self, rng: random.Random) -> Iterator[int]:
+        orders = [list(range(len(values))) for values in self._values]
+        for position in itertools.count():
+            index = 0
+            for order in orders:
+                slot = position % len(order)
+                if slot == 0:
+                    rng.shuffle(order)
+                index = index * len(order) + order[slot]
+            yield index
+
+    def _unique(self, indexes: Iterator[int]) -> Iterator[int]:
+        seen = set[int]()
+        duplicates = 0
+        size = self.size()
+        for index in indexes:
+            if len(seen) == size or duplicates >= self.MAX_CONSECUTIVE_DUPLICATES:
+                return
+            if index in seen:
+                duplicates += 1
+                continue
+            duplicates = 0
+            seen.add(index)
+            yield index
+
+
+# Dry run, which prints the prompts of a sweep without generating any image:
+# python aspectsweep.py <subject> [count] [exhaustive|random|stratified] [seed]
+if __name__ == "__main__":
+    arguments = sys.argv[1:]
+    sweep = AspectSweep(ImageGeneration())
+    prompts = sweep.prompts(
+        arguments[0],
+        arguments[2] if len(arguments) > 2 else AspectSweep.Mode.STRATIFIED,
+        int(arguments[3]) if len(arguments) > 3 else None,
+    )
+    print(f"{sweep.size()} combinations")
+    for prompt in itertools.islice(
+        prompts, int(arguments[1]) if len(arguments) > 1 else 10
+    ):
+        print(prompt)
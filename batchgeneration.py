@@ -0,0 +1,206 @@
+import argparse
+import hashlib
+import itertools
+import json
+import os
+import sys
+import threading
+
+from typing import Callable, Iterable, Iterator, TextIO
+
+from imagegeneration import ImageGeneration, ImageGenerationResult
+from imagegenerationdb import ImageGenerationDb
+from imageencoder import EncodedImage
+from openai_image_dto import OpenAiImageDto
+
+
+# Single Responsibility Principle (SRP): This class has the single responsibility of running image generation requests
+# headlessly (i.e. without the view), e.g. for large overnight batches run from cron or a pipeline.
+# Each request record holds the same fields as the view's form (see form_submit_handler), and is identified by its "id"
+# field, or else by a hash of its content.  Requests are generated with bounded concurrency, and as each one finishes,
+# its image is written and a result line is emitted.  Completed requests are appended to the checkpoint file (and synced),
+# so that a run that crashed can be resumed without generating the completed requests again.  Failed requests are not
+# checkpointed, hence are retried upon resumption.
+class BatchGeneration:
+    class Status:
+        COMPLETED = "completed"
+        FAILED = "failed"
+        SKIPPED = "skipped"
+
+    REQUIRED_FIELDS = (
+        *ImageGenerationDb.Entity.ASPECT_TABLES,
+        ImageGeneration.OpenApi.PROMPT_TEXT,
+        ImageGeneration.OpenApi.IMAGE_SIZE,
+        ImageGeneration.OpenApi.IMAGE_QUALITY,
+        ImageGeneration.OpenApi.IMAGE_STYLE,
+    )
+
+    def __init__(
+        self,
+        image_generation: ImageGeneration,
+        write_image: Callable[[OpenAiImageDto], EncodedImage],
+        checkpoint: str = None,
+        max_workers: int = ImageGeneration.BATCH_MAX_WORKERS,
+    ):
+        self._image_generation = image_generation
+        self._write_image = write_image
+        self.checkpoint = checkpoint
+        self.max_workers = max_workers
+        self._lock = threading.Lock()
+        self._completed = self._load_checkpoint()
+
+    @staticmethod
+    def request_id(record: dict) -> str:
+        if "id" in record:
+            return str(record["id"])
+        canonical = json.dumps(record, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()[:16]
+
+    @staticmethod
+    def read_records(lines: Iterable[str]) -> Iterator[dict]:
+        for line in lines:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+    # Runs the requests, writing a result line (JSON) to the output as each request finishes, and returning the number of
+    # requests per status.
+    def run(self, records: Iterable[dict], output: TextIO) -> dict[str, int]:
+        counts = {
+            self.Status.COMPLETED: 0,
+            self.Status.FAILED: 0,
+            self.Status.SKIPPED: 0,
+        }
+
+        def emit(result: dict) -> None:
+            counts[result["status"]] += 1
+            output.write(json.dumps(result) + "\n")
+            output.flush()
+
+        # Identifiers of the requests in flight, by their index in the batch.
+        request_ids = {}
+        indexes = itertools.count()
+
+        def requests() -> Iterator[tuple[str, dict]]:
+            for record in records:
+                request_id = self.request_id(record)
+                if request_id in self._completed:
+                    emit({"id": request_id, "status": self.Status.SKIPPED})
+                    continue
+                missing = [f for f in self.REQUIRED_FIELDS if f not in record]
+                if missing:
+                    emit(
+                        self._failure(
+                            request_id, f"Missing fields: {', '.join(missing)}"
+                        )
+                    )
+                    continue
+                prompt = self._image_generation.build_image_prompt(dict(record))
+                request_ids[next(indexes)] = request_id
+                yield prompt, record
+
+        for result in self._image_generation.request_image_generation_batch(
+            requests(), self.max_workers
+        ):
+            request_id = request_ids.pop(result.index)
+            emit(self._finish(request_id, result))
+        return counts
+
+    def _finish(self, request_id: str, result: ImageGenerationResult) -> dict:
+        if result.error is not None:
+            return self._failure(request_id, str(result.error))
+        # From the batch's perspective, any failure is confined to its own request.
+        # pylint: disable=broad-exception-caught
+        try:
+            encoded_image = self._write_image(result.image)
+        except Exception as e:
+            return self._failure(request_id, str(e))
+        outcome = {
+            "id": request_id,
+            "status": self.Status.COMPLETED,
+            "image": result.image.id,
+            "filename": encoded_image.filename,
+            "revised_prompt": result.image.revised_prompt,
+        }
+        self._record_checkpoint(outcome)
+        return outcome
+
+    def _failure(self, request_id: str, error: str) -> dict:
+        return {"id": request_id, "status": self.Status.FAILED, "error": error}
+
+    def _load_checkpoint(self) -> set[str]:
+        completed = set[str]()
+        if self.checkpoint and os.path.exists(self.checkpoint):
+            with open(self.checkpoint, encoding="utf-8") as file:
+                for line in file:
+                    try:
+                        completed.add(json.loads(line)["id"])
+                    except (ValueError, KeyError):
+                        pass  # A line torn by a crash.
+        return completed
+
+    def _record_checkpoint(self, outcome: dict) -> None:
+        with self._lock:
+            self._completed.add(outcome["id"])
+            if not self.checkpoint:
+                return
+            with open(self.checkpoint, "a", encoding="utf-8") as file:
+                file.write(json.dumps(outcome) + "\n")
+                file.flush()
+                os.fsync(file.fileno())
+
+
+# Headless entry point, e.g.:
+# python batchgeneration.py requests.jsonl --output results.jsonl --checkpoint requests.checkpoint --workers 4
+def main(arguments: list[str] = None) -> int:
+    parser = argparse.ArgumentParser(
+        description="Generates images from a JSON lines file of requests (the fields of the view's form), without the view."
+    )
+    parser.add_argument(
+        "requests", nargs="?", default="-", help="request file (default: stdin)"
+    )
+    parser.add_argument("--output", default="-", help="result file (default: stdout)")
+    parser.add_argument(
+        "--checkpoint", help="checkpoint file, to resume an interrupted run"
+    )
+    parser.add_argument(
+        "--workers", type=int, default=ImageGeneration.BATCH_MAX_WORKERS
+    )
+    options = parser.parse_args(arguments)
+
+    # The application's components (database, cache, rate limit scheduler, image store and encoder) are shared.
+    import project  # pylint: disable=import-outside-toplevel
+
+    batch = BatchGeneration(
+        project.image_generation,
+        project.write_image_and_derivatives,
+        options.checkpoint,
+        options.workers,
+    )
+    source = (
+        sys.stdin
+        if options.requests == "-"
+        else open(options.requests, encoding="utf-8")
+    )
+    output = (
+        sys.stdout
+        if options.output == "-"
+        else open(options.output, "a", encoding="utf-8")
+    )
+    try:
+        counts = batch.run(BatchGeneration.read_records(source), output)
+    finally:
+        project.image_derivative_jobs.shutdown(wait=True)
+        if project.image_processing is not None:
+            project.image_processing.shutdown()
+        project.db().flush()
+        if source is not sys.stdin:
+            source.close()
+        if output is not sys.stdout:
+            output.close()
+    print(json.dumps(counts), file=sys.stderr)
+    return 1 if counts[BatchGeneration.Status.FAILED] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
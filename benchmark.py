@@ -0,0 +1,646 @@
+# Performance benchmarks for the Image Genie components.
+
+# None of the benchmarks require an OpenAI key, nor do they touch the application database (db.json), since each benchmark
+# operates on its own temporary data.
+
+# Usage:
+#     python benchmark.py                  (runs every benchmark)
+#     python benchmark.py event_log_lookup (runs the named benchmark(s) only)
+
+import base64
+import json
+import multiprocessing
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from io import BytesIO
+from PIL import Image
+
+from httpclient import PooledHttpSession
+from imagegeneration import ImageGeneration
+from imagegenerationcache import ImageGenerationCache
+from imagegenerationdb import ImageGenerationDb
+from imagederivatives import ImageDerivatives
+from imageencoder import ImageEncoder
+from imageprocessing import ImageProcessingPool
+from imagestore import ImageStore
+from metrics import Metrics
+from mockimageserver import MockImageServer, build_png
+from openai_image_dto import OpenAiImageDto
+from perceptualhash import PerceptualHash, PerceptualHashIndex
+
+try:
+    import resource  # Peak resident set size is only reported where available (i.e. not on Windows).
+except ImportError:
+    resource = None
+
+
+def main():
+    selection = sys.argv[1:] or list(BENCHMARKS)
+    for name in selection:
+        if name not in BENCHMARKS:
+            sys.exit(
+                f"Unknown benchmark: {name} (expected one of {', '.join(BENCHMARKS)})"
+            )
+        print(f"== {name} ==")
+        BENCHMARKS[name]()
+        print()
+
+
+def time_per_call(function, iterations: int) -> float:
+    start = time.perf_counter()
+    for index in range(iterations):
+        function(index)
+    return (time.perf_counter() - start) / iterations
+
+
+def build_event(created: int) -> dict:
+    return {
+        ImageGenerationDb.Entity.COLUMN_PROMPT: f"Benchmark prompt number {created}.",
+        "revised_prompt": f"Revised benchmark prompt number {created}.",
+        ImageGenerationDb.Entity.COLUMN_CREATED: created,
+    }
+
+
+# Builds an OpenAI image generation response with a base64 PNG payload of a size comparable to that of a real DALL-E image.
+def build_image_response(created: int, size: tuple[int, int] = (1792, 1024)) -> dict:
+    return {
+        ImageGeneration.OpenApi.IMAGE_TIMESTAMP: created,
+        ImageGeneration.OpenApi.PAYLOAD_DATA: [
+            {
+                ImageGeneration.OpenApi.PAYLOAD_B64_JSON: base64.b64encode(
+                    build_png(size)
+                ).decode("ascii"),
+                ImageGeneration.OpenApi.REVISED_PROMPT: "Benchmark revised prompt.",
+            }
+        ],
+    }
+
+
+# Runs the function in a freshly spawned process, so that its peak memory is not influenced by the benchmark itself.
+def run_isolated(function, *args):
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+        return executor.submit(function, *args).result()
+
+
+def peak_rss_kib() -> int:
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+
+# The original (eager) OpenAiImageDto, which holds the base64 text, the bitmap and the RGB converted PIL image at once.
+class EagerOpenAiImageDto(OpenAiImageDto):
+    def __init__(self, response: dict):
+        super().__init__(response)
+        self._b64_retained = self.b64_json
+        self._image = Image.open(BytesIO(self.bitmap)).convert("RGB")
+
+
+# Saves several generations that are all in flight at once (i.e. their DTOs are alive), returning the python heap peak
+# and the resident set size growth per generation, in MiB.
+def measure_image_save(mode: str, folder: str, in_flight: int) -> tuple[float, float]:
+    path = os.path.join(folder, "response.json")
+    images = []
+    rss_before = peak_rss_kib()
+    tracemalloc.start()
+
+    for index in range(in_flight):
+        with open(path, encoding="utf-8") as file:
+            response = json.load(file)
+        if mode == "eager":
+            image_object = EagerOpenAiImageDto(response)
+            image_object.save(os.path.join(folder, f"{mode}{index}.jpg"))
+        elif mode == "lazy_jpeg":
+            image_object = OpenAiImageDto(response)
+            image_object.save(os.path.join(folder, f"{mode}{index}.jpg"))
+        else:
+            image_object = OpenAiImageDto(response)
+            image_object.save_original(os.path.join(folder, f"{mode}{index}.png"))
+        del response  # As in ImageGeneration, only the DTO holds on to the payload.
+        images.append(image_object)
+
+    _, heap_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    rss_growth = None if rss_before is None else (peak_rss_kib() - rss_before) / 1024
+    return heap_peak / 1024**2 / in_flight, rss_growth and rss_growth / in_flight
+
+
+# Peak memory per in-flight 1792x1024 generation: the original eager DTO, the lazy DTO re-encoded to JPEG, and the lazy
+# DTO's direct bytes-to-disk path.
+def benchmark_image_memory():
+    in_flight = 8
+    print(f"{in_flight} generations in flight, memory per generation:")
+    print(f"{'mode':>14} {'heap peak (MiB)':>16} {'rss growth (MiB)':>17}")
+    with tempfile.TemporaryDirectory() as folder:
+        with open(os.path.join(folder, "response.json"), "w", encoding="utf-8") as file:
+            json.dump(build_image_response(1), file)
+        for mode in ("eager", "lazy_jpeg", "lazy_original"):
+            heap_peak, rss_growth = run_isolated(
+                measure_image_save, mode, folder, in_flight
+            )
+            rss = "n/a" if rss_growth is None else f"{rss_growth:.1f}"
+            print(f"{mode:>14} {heap_peak:>16.1f} {rss:>17}")
+
+
+# Event log lookup latency by "created", using the maintained index versus a full TinyDB table scan.  Indexed lookup
+# latency is expected to stay flat as the event log grows.
+def benchmark_event_log_lookup():
+    print(f"{'events':>8} {'open (ms)':>10} {'indexed (us)':>13} {'scan (us)':>10}")
+    for event_count in (1_000, 10_000, 50_000):
+        with tempfile.TemporaryDirectory() as folder:
+            database = os.path.join(folder, "db.json")
+            seed = ImageGenerationDb(database)
+            seed.database.table(
+                ImageGenerationDb.Entity.TABLE_EVENT_LOG
+            ).insert_multiple(build_event(created) for created in range(event_count))
+            seed.database.close()
+
+            start = time.perf_counter()
+            db = ImageGenerationDb(database)
+            open_time = time.perf_counter() - start
+
+            table = db.database.table(ImageGenerationDb.Entity.TABLE_EVENT_LOG)
+            indexed = time_per_call(
+                lambda index: db.get_event_log_by_created(index * 7919 % event_count),
+                10_000,
+            )
+            scan = time_per_call(
+                lambda index: table.get(
+                    lambda event: event[ImageGenerationDb.Entity.COLUMN_CREATED]
+                    == index * 7919 % event_count
+                ),
+                5,
+            )
+            db.database.close()
+
+        print(
+            f"{event_count:>8} {open_time * 1e3:>10.1f} {indexed * 1e6:>13.2f} {scan * 1e6:>10.0f}"
+        )
+
+
+# Event log write throughput as the event log grows, for the TinyDB synchronous and batched (write-behind) durability
+# modes, and for the SQLite backend (synchronous).
+def benchmark_event_log_write():
+    writes = 200
+    configurations = {
+        "tinydb sync": (
+            ImageGenerationDb.Backend.TINYDB,
+            ImageGenerationDb.Durability.SYNC,
+        ),
+        "tinydb batched": (
+            ImageGenerationDb.Backend.TINYDB,
+            ImageGenerationDb.Durability.BATCHED,
+        ),
+        "sqlite sync": (
+            ImageGenerationDb.Backend.SQLITE,
+            ImageGenerationDb.Durability.SYNC,
+        ),
+    }
+    print(f"{'events':>8}" + "".join(f"{name:>16}" for name in configurations))
+    print(f"{'':>8}" + "".join(f"{'(ms/event)':>16}" for _ in configurations))
+    for event_count in (1_000, 10_000, 30_000):
+        timings = []
+        for backend, durability in configurations.values():
+            with tempfile.TemporaryDirectory() as folder:
+                database = os.path.join(folder, "db")
+                seed = ImageGenerationDb(database, backend=backend)
+                seed.database.table(
+                    ImageGenerationDb.Entity.TABLE_EVENT_LOG
+                ).insert_multiple(
+                    build_event(created) for created in range(event_count)
+                )
+                seed.close()
+
+                db = ImageGenerationDb(
+                    database, durability, flush_size=50, backend=backend
+                )
+                start = time.perf_counter()
+                for created in range(event_count, event_count + writes):
+                    db.write_event(build_event(created))
+                db.close()
+                timings.append((time.perf_counter() - start) / writes)
+
+        print(
+            f"{event_count:>8}"
+            + "".join(f"{timing * 1e3:>16.2f}" for timing in timings)
+        )
+
+
+# Runs image generations end to end (request, decode, JPEG encode, atomic write and event log write) against the local
+# mock server, returning the throughput, latency percentiles and peak memory.  In the single mode the generations run one
+# after the other, in the batch mode through request_image_generation_batch (whose consumer writes each image as it
+# completes), and in the concurrent mode each generation runs on its own worker, as the application's job queue does.
+def measure_end_to_end(url: str, mode: str, count: int, workers: int) -> dict:
+    with tempfile.TemporaryDirectory() as folder:
+        db = ImageGenerationDb(
+            os.path.join(folder, "db.json"), ImageGenerationDb.Durability.BATCHED
+        )
+        generator = ImageGeneration(
+            http_session=PooledHttpSession(backoff_base=0.05, backoff_max=1.0),
+            db=db,
+            url=url,
+        )
+        store = ImageStore(os.path.join(folder, "img"))
+        encoder = ImageEncoder(ImageEncoder.Mode.JPEG)
+        configuration = {
+            ImageGeneration.OpenApi.IMAGE_SIZE: "1792x1024",
+            ImageGeneration.OpenApi.IMAGE_QUALITY: "hd",
+            ImageGeneration.OpenApi.IMAGE_STYLE: "vivid",
+        }
+        started = {}
+        latencies = []
+        errors = 0
+        lock = threading.Lock()
+
+        def write(prompt, image):
+            with store.writing(image.id, encoder.extension) as filename:
+                encoder.encode(image, filename)
+            with lock:
+                latencies.append(time.perf_counter() - started[prompt])
+
+        request_image_generation = generator.request_image_generation
+
+        def generate(prompt, *args):
+            started[prompt] = time.perf_counter()
+            return request_image_generation(prompt, *args)
+
+        def pipeline(prompt):
+            write(prompt, generate(prompt, configuration))
+
+        prompts = [f"Benchmark prompt number {index}." for index in range(count)]
+        start = time.perf_counter()
+        if mode == "single":
+            for prompt in prompts:
+                try:
+                    pipeline(prompt)
+                except RuntimeError:
+                    errors += 1
+        elif mode == "batch":
+            generator.request_image_generation = generate
+            batch = ((prompt, configuration) for prompt in prompts)
+            for result in generator.request_image_generation_batch(batch, workers):
+                if result.error:
+                    errors += 1
+                else:
+                    write(result.prompt, result.image)
+        else:
+            with ThreadPoolExecutor(workers) as executor:
+                for future in [executor.submit(pipeline, p) for p in prompts]:
+                    if future.exception():
+                        errors += 1
+        elapsed = time.perf_counter() - start
+        db.close()
+
+    percentiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else []
+    return {
+        "throughput": len(latencies) / elapsed,
+        "p50": percentiles[49] if percentiles else None,
+        "p95": percentiles[94] if percentiles else None,
+        "p99": percentiles[98] if percentiles else None,
+        "errors": errors,
+        "peak_rss": peak_rss_kib(),
+    }
+
+
+# End-to-end throughput, latency and peak memory of the image generation pipeline, against the local mock server (with
+# a realistic latency, and injected server errors and throttled replies).  Each mode runs in its own process.
+def benchmark_end_to_end():
+    count, workers = 40, 4
+    print(f"{count} generations of 1792x1024, {workers} workers where concurrent:")
+    print(
+        f"{'mode':>11} {'images/s':>9} {'p50 (s)':>8} {'p95 (s)':>8} {'p99 (s)':>8} {'errors':>7} {'peak rss (MiB)':>15}"
+    )
+    with MockImageServer(
+        latency=0.25, latency_jitter=0.25, error_rate=0.02, throttle_rate=0.03, seed=1
+    ) as server:
+        for mode in ("single", "batch", "concurrent"):
+            result = run_isolated(measure_end_to_end, server.url, mode, count, workers)
+            latencies = "".join(
+                "      n/a" if result[p] is None else f"{result[p]:>9.2f}"
+                for p in ("p50", "p95", "p99")
+            )
+            rss = (
+                "n/a"
+                if result["peak_rss"] is None
+                else f"{result['peak_rss'] / 1024:.0f}"
+            )
+            print(
+                f"{mode:>11} {result['throughput']:>9.2f}{latencies} {result['errors']:>7} {rss:>15}"
+            )
+        print(f"server: {server.stats()}")
+
+
+# Requests image generations from the local mock server, several in flight at once, and writes each original image to
+# disk, returning the python heap peak per generation (in MiB), and the throughput.
+def measure_response_read(url: str, stream: bool, count: int, workers: int) -> tuple:
+    with tempfile.TemporaryDirectory() as folder:
+        db = ImageGenerationDb(
+            os.path.join(folder, "db.json"), ImageGenerationDb.Durability.BATCHED
+        )
+        generator = ImageGeneration(db=db, url=url, stream=stream)
+        store = ImageStore(os.path.join(folder, "img"))
+        configuration = {
+            ImageGeneration.OpenApi.IMAGE_SIZE: "1792x1024",
+            ImageGeneration.OpenApi.IMAGE_QUALITY: "hd",
+            ImageGeneration.OpenApi.IMAGE_STYLE: "vivid",
+        }
+
+        def generate(index: int) -> None:
+            image = generator.request_image_generation(
+                f"Benchmark prompt number {index}.", configuration
+            )
+            with store.writing(image.id, ".png") as filename:
+                image.save_original(filename)
+
+        generate(-1)  # Warms up the connection pool (and the imports of the decoders).
+        tracemalloc.start()
+        start = time.perf_counter()
+        with ThreadPoolExecutor(workers) as executor:
+            list(executor.map(generate, range(count)))
+        elapsed = time.perf_counter() - start
+        _, heap_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        db.close()
+    return heap_peak / 1024**2 / workers, count / elapsed
+
+
+# Peak memory per in-flight 1792x1024 generation, when its reply is buffered (and then parsed and decoded), versus when
+# it is streamed (decoded to its payload file as it is received).
+def benchmark_response_streaming():
+    count, workers = 32, 8
+    print(f"{count} generations of 1792x1024, {workers} in flight at once:")
+    print(f"{'mode':>9} {'heap peak per generation (MiB)':>31} {'images/s':>9}")
+    with MockImageServer(seed=1) as server:
+        for mode, stream in (("buffered", False), ("streamed", True)):
+            heap_peak, throughput = run_isolated(
+                measure_response_read, server.url, stream, count, workers
+            )
+            print(f"{mode:>9} {heap_peak:>31.1f} {throughput:>9.1f}")
+
+
+# Post-processes the images (decode, perceptual hash, JPEG encode and renditions) with the given number of workers, either
+# threads (as the generation threads did), or the processes of an image processing pool, returning the images per second.
+def measure_post_processing(response: dict, count: int, workers: int, mode: str):
+    with tempfile.TemporaryDirectory() as folder:
+        store = ImageStore(folder)
+        encoder = ImageEncoder(ImageEncoder.Mode.JPEG)
+        derivatives = ImageDerivatives(store)
+        timestamp = ImageGeneration.OpenApi.IMAGE_TIMESTAMP
+        images = [
+            OpenAiImageDto({**response, timestamp: index}) for index in range(count)
+        ]
+
+        def post_process(image: OpenAiImageDto) -> None:
+            _ = image.perceptual_hash
+            with store.writing(image.id, encoder.extension) as filename:
+                encoder.encode(image, filename)
+            derivatives.generate(image)
+
+        if mode == "threads":
+            start = time.perf_counter()
+            with ThreadPoolExecutor(workers) as executor:
+                list(executor.map(post_process, images))
+            return count / (time.perf_counter() - start)
+
+        pool = ImageProcessingPool(store, encoder, derivatives, workers)
+        # The workers are started (and import PIL) ahead of the measurement.
+        pool.process(OpenAiImageDto({**response, timestamp: count}))
+        start = time.perf_counter()
+        for future in [pool.submit(image) for image in images]:
+            future.result()
+        elapsed = time.perf_counter() - start
+        pool.shutdown()
+        return count / elapsed
+
+
+# Post-processing throughput of 1792x1024 images by worker count, on threads versus on an image processing pool.
+def benchmark_image_processing():
+    count = 24
+    response = build_image_response(1)
+    worker_counts = sorted({1, 2, 4, os.cpu_count()})
+    print(f"{count} images of 1792x1024 ({os.cpu_count()} cores), images/s:")
+    print(f"{'workers':>8} {'threads':>8} {'processes':>10}")
+    for workers in worker_counts:
+        threads = run_isolated(
+            measure_post_processing, response, count, workers, "threads"
+        )
+        processes = run_isolated(
+            measure_post_processing, response, count, workers, "processes"
+        )
+        print(f"{workers:>8} {threads:>8.1f} {processes:>10.1f}")
+
+
+# Cost of timing a stage, with the metrics disabled (the default) and enabled, against an uninstrumented baseline.
+def benchmark_metrics_overhead():
+    iterations = 200_000
+    disabled, enabled = Metrics(enabled=False), Metrics(enabled=True)
+
+    def stage(metrics: Metrics):
+        with metrics.stage(Metrics.Stage.NETWORK):
+            pass
+
+    def bare(metrics: Metrics):
+        pass
+
+    baseline = time_per_call(lambda index: bare(disabled), iterations)
+    print(f"{'metrics':>9} {'per stage (ns)':>15}")
+    for name, metrics in (("disabled", disabled), ("enabled", enabled)):
+        overhead = time_per_call(lambda index: stage(metrics), iterations) - baseline
+        print(f"{name:>9} {overhead * 1e9:>15.0f}")
+
+
+# Full-text search latency over the event log (prompts and revised prompts), using the inverted index versus a linear scan
+# of the event log, as the event log grows.  The index is built upon the first search.
+def benchmark_event_log_search():
+    adjectives = ("misty", "golden", "ancient", "quiet", "stormy", "neon", "frozen")
+    adjectives += ("crimson", "distant", "gentle", "rusty", "hidden")
+    nouns = ("fox", "lighthouse", "windmill", "dragon", "castle", "forest", "ocean")
+    nouns += ("harbor", "meadow", "robot", "library", "bridge", "volcano", "garden")
+    nouns += ("owl", "train", "cathedral", "desert", "glacier", "market")
+    queries = ("lighthouse", "golden dragon", "stormy harbor", "castle fore")
+    print(f"{'events':>8} {'build (ms)':>11} {'indexed (us)':>13} {'scan (us)':>10}")
+    for event_count in (1_000, 10_000, 50_000):
+        rng = random.Random(event_count)
+        with tempfile.TemporaryDirectory() as folder:
+            database = os.path.join(folder, "db.json")
+            seed = ImageGenerationDb(database)
+            seed.database.table(
+                ImageGenerationDb.Entity.TABLE_EVENT_LOG
+            ).insert_multiple(
+                build_event(created)
+                | {
+                    ImageGenerationDb.Entity.COLUMN_REVISED_PROMPT: f"A {rng.choice(adjectives)} "
+                    f"{rng.choice(nouns)} beside a {rng.choice(adjectives)} {rng.choice(nouns)}, "
+                    f"under a {rng.choice(adjectives)} sky."
+                }
+                for created in range(event_count)
+            )
+            seed.database.close()
+
+            db = ImageGenerationDb(database)
+            start = time.perf_counter()
+            db.search_event_log(queries[0])
+            build_time = time.perf_counter() - start
+
+            events = db.database.table(ImageGenerationDb.Entity.TABLE_EVENT_LOG).all()
+            indexed = time_per_call(
+                lambda index: db.search_event_log(queries[index % len(queries)]), 1_000
+            )
+
+            def scan(index: int) -> list[dict]:
+                terms = queries[index % len(queries)].split()
+                return [
+                    event
+                    for event in events
+                    if all(
+                        term
+                        in (
+                            event[ImageGenerationDb.Entity.COLUMN_PROMPT]
+                            + " "
+                            + event[ImageGenerationDb.Entity.COLUMN_REVISED_PROMPT]
+                        ).lower()
+                        for term in terms
+                    )
+                ]
+
+            scanned = time_per_call(scan, 20)
+            db.database.close()
+
+        print(
+            f"{event_count:>8} {build_time * 1e3:>11.1f} {indexed * 1e6:>13.0f} {scanned * 1e6:>10.0f}"
+        )
+
+
+# Near-duplicate lookup latency (hashes within the default Hamming distance), using the multi-index hash versus a linear
+# scan of every perceptual hash, as the number of images grows.
+def benchmark_perceptual_hash_search():
+    print(f"{'images':>8} {'build (ms)':>11} {'indexed (us)':>13} {'scan (us)':>10}")
+    for image_count in (1_000, 10_000, 100_000):
+        rng = random.Random(image_count)
+        values = [rng.getrandbits(64) for _ in range(image_count)]
+        hashes = [f"{value:016x}" for value in values]
+        start = time.perf_counter()
+        index = PerceptualHashIndex()
+        for number, perceptual_hash in enumerate(hashes):
+            index.add(perceptual_hash, number)
+        build_time = time.perf_counter() - start
+
+        indexed = time_per_call(lambda i: index.search(hashes[i % 100]), 1_000)
+        scanned = time_per_call(
+            lambda i: [
+                value
+                for value in values
+                if (values[i % 100] ^ value).bit_count() <= PerceptualHash.MAX_DISTANCE
+            ],
+            10,
+        )
+        print(
+            f"{image_count:>8} {build_time * 1e3:>11.1f} {indexed * 1e6:>13.0f} {scanned * 1e6:>10.0f}"
+        )
+
+
+# Startup time of the application (import of project.py, in a fresh interpreter), and the time of the first use of its
+# database and of its image store, as the event log and the image store grow (each image having a manifest record per
+# rendition, along with a full response cache).  The import time is expected to stay flat, as the database, the image
+# store and the response cache (as well as Eel, Requests and PIL) are only loaded upon first use.
+def benchmark_import_time():
+    runs = 5
+    script = (
+        "import json, sys, time\n"
+        "start = time.perf_counter()\n"
+        "import project\n"
+        "imported = time.perf_counter()\n"
+        "project.db()\n"
+        "opened = time.perf_counter()\n"
+        "project.image_store()\n"
+        "stored = time.perf_counter()\n"
+        # Eel is reported through gevent, as a lazily imported module is registered right away.
+        "heavy = [m for m in ('gevent', 'requests', 'PIL') if m in sys.modules]\n"
+        "print(json.dumps([imported - start, opened - imported, stored - opened, heavy]))\n"
+    )
+    environment = dict(
+        os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(__file__))
+    )
+    print(
+        f"{'events':>8} {'manifest':>9} {'import (ms)':>12} {'first db use (ms)':>18} "
+        f"{'first store use (ms)':>21} {'heavy imports':>14}"
+    )
+    variants = [""] + [
+        ImageDerivatives.variant(width) for width in ImageDerivatives.WIDTHS
+    ]
+    for event_count in (0, 10_000, 50_000):
+        with tempfile.TemporaryDirectory() as folder:
+            seed = ImageGenerationDb(os.path.join(folder, ImageGenerationDb.DATABASE))
+            seed.database.table(
+                ImageGenerationDb.Entity.TABLE_EVENT_LOG
+            ).insert_multiple(build_event(created) for created in range(event_count))
+            seed.database.close()
+            store = ImageStore(os.path.join(folder, "web", "img"))
+            os.makedirs(store.root)
+            manifest_path = os.path.join(store.root, ImageStore.MANIFEST)
+            with open(manifest_path, "w", encoding="utf-8") as manifest:
+                for created in range(event_count):
+                    image_id = f"{created}-benchmark"
+                    for variant in variants:
+                        path = store.path(image_id, ImageDerivatives.EXTENSION, variant)
+                        record = {
+                            ImageStore.Entry.ID: image_id,
+                            ImageStore.Entry.CREATED: created,
+                            ImageStore.Entry.VARIANT: variant,
+                            ImageStore.Entry.PATH: os.path.relpath(path, store.root),
+                        }
+                        manifest.write(json.dumps(record) + "\n")
+            cache = ImageGenerationCache(
+                os.path.join(folder, ImageGenerationCache.DIRECTORY)
+            )
+            for created in range(min(event_count, ImageGenerationCache.MAX_ENTRIES)):
+                cache.put({"created": created}, {"created": created})
+
+            samples = []
+            for _ in range(runs):
+                output = subprocess.run(
+                    [sys.executable, "-c", script],
+                    cwd=folder,
+                    env=environment,
+                    capture_output=True,
+                    check=True,
+                    text=True,
+                ).stdout
+                samples.append(json.loads(output))
+        import_time = statistics.median(sample[0] for sample in samples)
+        open_time = statistics.median(sample[1] for sample in samples)
+        store_time = statistics.median(sample[2] for sample in samples)
+        heavy = ",".join(samples[0][3]) or "none"
+        print(
+            f"{event_count:>8} {event_count * len(variants):>9} {import_time * 1e3:>12.1f} "
+            f"{open_time * 1e3:>18.1f} {store_time * 1e3:>21.1f} {heavy:>14}"
+        )
+
+
+BENCHMARKS = {
+    "event_log_lookup": benchmark_event_log_lookup,
+    "image_memory": benchmark_image_memory,
+    "event_log_write": benchmark_event_log_write,
+    "event_log_search": benchmark_event_log_search,
+    "perceptual_hash_search": benchmark_perceptual_hash_search,
+    "end_to_end": benchmark_end_to_end,
+    "response_streaming": benchmark_response_streaming,
+    "image_processing": benchmark_image_processing,
+    "metrics_overhead": benchmark_metrics_overhead,
+    "import_time": benchmark_import_time,
+}
+
+
+if __name__ == "__main__":
+    main()
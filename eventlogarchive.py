@@ -0,0 +1,156 @@
+import gzip
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+
+from collections import OrderedDict
+from typing import Callable, Iterable, Iterator
+
+
+# Single Responsibility Principle (SRP): This class has the single responsibility of keeping the rotated (cold) segments of
+# the event log, so the hot segment (in the database) stays small.
+# Events are partitioned by the month (UTC) of their "created" value, and each partition is a gzip compressed JSON lines
+# file (e.g. archive/event_log-2024-04.jsonl.gz).  A partition is rewritten to a temporary file that is then renamed, so a
+# crash never leaves it partially written, and rewriting an event that is already archived (e.g. a rotation interrupted
+# before its events were removed from the hot segment) does not duplicate it.  Lookups by "created" (and so by image
+# identifier) only load the partition of that month; the most recently used partitions are kept in memory.
+class EventLogArchive:
+    DIRECTORY = "archive"
+    PREFIX = "event_log-"
+    EXTENSION = ".jsonl.gz"
+    CACHED_PARTITIONS = 4
+    COLUMN_CREATED = "created"
+
+    PARTITION_PATTERN = re.compile(r"^event_log-(\d{4}-\d{2})\.jsonl\.gz$")
+
+    def __init__(
+        self, directory: str = DIRECTORY, cached_partitions: int = CACHED_PARTITIONS
+    ):
+        self.directory = directory
+        self.cached_partitions = cached_partitions
+        self._lock = threading.RLock()
+        # Partition to its events, ordered from least to most recently used.
+        self._cache = OrderedDict[str, list[dict]]()
+
+    @classmethod
+    def partition(cls, created: int) -> str:
+        return time.strftime("%Y-%m", time.gmtime(created or 0))
+
+    def partitions(self) -> list[str]:
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(
+            match.group(1)
+            for match in map(self.PARTITION_PATTERN.match, os.listdir(self.directory))
+            if match
+        )
+
+    def events(self, partition: str) -> list[dict]:
+        with self._lock:
+            events = self._cache.get(partition)
+            if events is None:
+                events = self._cache[partition] = self._read(partition)
+                while len(self._cache) > self.cached_partitions:
+                    self._cache.popitem(last=False)
+            self._cache.move_to_end(partition)
+            return events
+
+    # Every archived event, partition by partition (oldest first), without holding them all in memory.
+    def __iter__(self) -> Iterator[dict]:
+        for partition in self.partitions():
+            with self._lock:
+                events = self._cache.get(partition)
+            yield from events if events is not None else self._read(partition)
+
+    def find_by_created(self, created: int) -> list[dict]:
+        return [
+            event
+            for event in self.events(self.partition(created))
+            if event.get(self.COLUMN_CREATED) == created
+        ]
+
+    # Archives the events, each into the partition of its month.
+    def append(self, events: Iterable[dict]) -> int:
+        partitions = dict[str, list[dict]]()
+        for event in events:
+            created = event.get(self.COLUMN_CREATED)
+            partitions.setdefault(self.partition(created), []).append(dict(event))
+        with self._lock:
+            for partition, added in partitions.items():
+                archived = self._read(partition)
+                keys = {self._key(event) for event in archived}
+                archived.extend(e for e in added if self._key(e) not in keys)
+                self._write(partition, archived)
+        return sum(map(len, partitions.values()))
+
+    # Removes the archived events that match the predicate (from the given partitions, or else from every partition),
+    # returning the number of events removed.
+    def remove(
+        self, predicate: Callable[[dict], bool], partitions: Iterable[str] = None
+    ) -> int:
+        removed = 0
+        with self._lock:
+            for partition in self.partitions() if partitions is None else partitions:
+                archived = self._read(partition)
+                kept = [event for event in archived if not predicate(event)]
+                if len(kept) < len(archived):
+                    removed += len(archived) - len(kept)
+                    self._write(partition, kept)
+        return removed
+
+    # Updates the archived events in place, by the function (which returns whether it modified the event), in the given
+    # partitions, or else in every partition.  Returns the number of events updated.
+    def update(
+        self, function: Callable[[dict], bool], partitions: Iterable[str] = None
+    ) -> int:
+        updated = 0
+        with self._lock:
+            for partition in self.partitions() if partitions is None else partitions:
+                archived = self._read(partition)
+                modified = sum(1 for event in archived if function(event))
+                if modified:
+                    updated += modified
+                    self._write(partition, archived)
+        return updated
+
+    def _path(self, partition: str) -> str:
+        return os.path.join(self.directory, f"{self.PREFIX}{partition}{self.EXTENSION}")
+
+    def _read(self, partition: str) -> list[dict]:
+        try:
+            with gzip.open(self._path(partition), "rt", encoding="utf-8") as file:
+                return [json.loads(line) for line in file if line.strip()]
+        except FileNotFoundError:
+            return []
+
+    def _write(self, partition: str, events: list[dict]) -> None:
+        path = self._path(partition)
+        if not events:
+            self._cache.pop(partition, None)
+            if os.path.exists(path):
+                os.remove(path)
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        handle, temporary = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(handle, "wb") as raw:
+                with gzip.open(raw, "wt", encoding="utf-8") as file:
+                    for event in events:
+                        file.write(json.dumps(event) + "\n")
+                raw.flush()
+                os.fsync(raw.fileno())
+            os.replace(temporary, path)
+        except BaseException:
+            os.remove(temporary)
+            raise
+        self._cache[partition] = events
+        self._cache.move_to_end(partition)
+        while len(self._cache) > self.cached_partitions:
+            self._cache.popitem(last=False)
+
+    @staticmethod
+    def _key(event: dict) -> str:
+        return json.dumps(event, sort_keys=True)
@@ -1,8 +1,204 @@
+import random
+import threading
+import time
+
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import TYPE_CHECKING, Callable, Mapping
+
+if TYPE_CHECKING:
+    # The Requests package is recommended for a higher-level HTTP client interface.  It is imported upon first use (see
+    # PooledHttpSession.session), as it weighs on the startup time of the application and its tests.
+    import requests
+
+
 class HttpClient:
     AUTHORIZATION = "Authorization"
     CONTENT_LENGTH = "Content-Length"
     CONTENT_TYPE = "Content-Type"
+    RETRY_AFTER = "Retry-After"
     USER_AGENT = "User-Agent"
 
     class MediaType:
-        JSON = "application/json"
\ No newline at end of file
+        JSON = "application/json"
+
+
+# Single Responsibility Principle (SRP): This class has the single responsibility of transporting HTTP requests over a
+# long-lived, pooled (keep-alive) connection, so consecutive requests to the same host avoid a new TCP+TLS handshake.
+# Every request is bounded by connect/read timeouts, so a stalled connection can no longer hang its caller indefinitely.
+# Throttled (429) and server error (5xx) replies, as well as failures to connect, are retried with a jittered exponential
+# backoff that honours the server's Retry-After header.  A read timeout, or a connection dropped once the request was sent
+# (e.g. "Connection aborted"), is deliberately NOT retried, since the server may have already accepted (and charged for) the
+# request.  Every attempt, retries included, can be admitted by a rate limit
+# scheduler (see post), so that retries are paced along with every other request rather than bursting once they are due.
+# The underlying session (and the Requests package) is only created upon first use.
+class PooledHttpSession:
+    CONNECT_TIMEOUT = 10.0
+    READ_TIMEOUT = 180.0
+    MAX_RETRIES = 3
+    BACKOFF_BASE = 1.0
+    BACKOFF_MAX = 60.0
+    POOL_SIZE = 10
+    RETRY_STATUS_CODES = frozenset({429, 500, 502, 503, 504})
+
+    def __init__(
+        self,
+        connect_timeout: float = CONNECT_TIMEOUT,
+        read_timeout: float = READ_TIMEOUT,
+        max_retries: int = MAX_RETRIES,
+        backoff_base: float = BACKOFF_BASE,
+        backoff_max: float = BACKOFF_MAX,
+        pool_size: int = POOL_SIZE,
+        sleep: Callable[[float], None] = time.sleep,
+    ):
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.pool_size = pool_size
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self._request_count = 0
+        self._retry_count = 0
+        self._response_hooks = list[Callable]()
+        self._adapter = None
+        self._session = None
+
+    @property
+    def session(self) -> "requests.Session":
+        if self._session is None:
+            with self._lock:
+                if self._session is None:
+                    self._session = self._create_session()
+        return self._session
+
+    # Observes every reply (including the replies of retried requests), without creating the session ahead of its use.
+    def add_response_hook(self, hook: Callable) -> None:
+        with self._lock:
+            self._response_hooks.append(hook)
+            if self._session is not None:
+                self._session.hooks["response"].append(hook)
+
+    # A streamed reply's body is read by the caller, as it is received (e.g. via iter_content), rather than upon its arrival.
+    # When given, acquire is called ahead of every attempt (e.g. RateLimitScheduler.acquire, of a scheduler attached to this
+    # session).  The scheduler then observes the Retry-After of a throttled (429) reply, and owns its back-off.
+    def post(
+        self,
+        url: str,
+        data: str,
+        headers: Mapping[str, str],
+        stream: bool = False,
+        acquire: Callable[[], None] = None,
+    ) -> "requests.Response":
+        import requests  # pylint: disable=import-outside-toplevel
+
+        session = self.session
+        attempt = 0
+        while True:
+            if acquire:
+                acquire()
+            with self._lock:
+                self._request_count += 1
+            try:
+                reply = session.post(
+                    url,
+                    data=data,
+                    headers=headers,
+                    timeout=self.timeout,
+                    stream=stream,
+                )
+            except requests.ConnectionError as e:
+                if attempt >= self.max_retries or not self.is_unsent(e):
+                    raise
+                delay = self.backoff_delay(attempt)
+            else:
+                if (
+                    reply.status_code not in self.RETRY_STATUS_CODES
+                    or attempt >= self.max_retries
+                ):
+                    return reply
+                if acquire and reply.status_code == 429:
+                    delay = 0.0
+                else:
+                    delay = self.backoff_delay(
+                        attempt, reply.headers.get(HttpClient.RETRY_AFTER)
+                    )
+                reply.close()
+
+            with self._lock:
+                self._retry_count += 1
+            if delay > 0:
+                self._sleep(delay)
+            attempt += 1
+
+    # Whether the request failed before it was sent (i.e. failed to connect), so that it can be retried without ever being
+    # sent twice.
+    @staticmethod
+    def is_unsent(error: "requests.ConnectionError") -> bool:
+        # pylint: disable=import-outside-toplevel
+        import requests
+        from urllib3.exceptions import ConnectTimeoutError, MaxRetryError
+
+        if isinstance(error, requests.ConnectTimeout):
+            return True
+        reason = error.args[0] if error.args else None
+        if isinstance(reason, MaxRetryError):
+            reason = reason.reason
+        # A failure to establish a new connection (NewConnectionError) is a ConnectTimeoutError too.
+        return isinstance(reason, ConnectTimeoutError)
+
+    # "Full jitter" exponential backoff, which is never shorter than what the server requested via Retry-After.
+    def backoff_delay(self, attempt: int, retry_after: str = None) -> float:
+        ceiling = min(self.backoff_max, self.backoff_base * (2**attempt))
+        return max(random.uniform(0, ceiling), self.parse_retry_after(retry_after))
+
+    # Retry-After is either a number of seconds, or an HTTP date.
+    @staticmethod
+    def parse_retry_after(retry_after: str) -> float:
+        if not retry_after:
+            return 0.0
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            pass
+        try:
+            moment = parsedate_to_datetime(retry_after)
+        except (TypeError, ValueError):
+            return 0.0
+        if moment.tzinfo is None:
+            moment = moment.replace(tzinfo=timezone.utc)
+        return max(0.0, (moment - datetime.now(timezone.utc)).total_seconds())
+
+    # Connection reuse statistics, which confirm that the connection pool is being hit.
+    def stats(self) -> dict[str, int]:
+        pools = self._adapter.poolmanager.pools if self._adapter else {}
+        opened = sent = 0
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                opened += pool.num_connections
+                sent += pool.num_requests
+        with self._lock:
+            return {
+                "requests": self._request_count,
+                "retries": self._retry_count,
+                "connections_opened": opened,
+                "connections_reused": max(0, sent - opened),
+            }
+
+    def close(self) -> None:
+        if self._session is not None:
+            self._session.close()
+
+    def _create_session(self) -> "requests.Session":
+        # pylint: disable=import-outside-toplevel
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        # Retries are handled here (not by urllib3), so that they are applied to POST requests and can be observed.
+        self._adapter = HTTPAdapter(pool_maxsize=self.pool_size, max_retries=0)
+        session = requests.Session()
+        session.mount("https://", self._adapter)
+        session.mount("http://", self._adapter)
+        session.hooks["response"].extend(self._response_hooks)
+        return session
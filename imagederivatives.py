@@ -0,0 +1,80 @@
+from typing import TYPE_CHECKING, Iterator
+
+from imagestore import ImageStore
+from openai_image_dto import OpenAiImageDto
+
+if TYPE_CHECKING:
+    from PIL import Image
+
+
+# Single Responsibility Principle (SRP): This class has the single responsibility of producing and locating the derivatives
+# (smaller renditions) of a generated image, such as thumbnails and display-size renditions.
+# The renditions form a multi-resolution set: each rendition is downscaled from the next larger one (rather than from the
+# full-size image), which keeps the cost of the smaller renditions negligible.  Images are never upscaled.
+# Renditions are stored as variants of their image in the image store (and so are deleted along with it).
+class ImageDerivatives:
+    WIDTHS = (256, 512, 1024)
+    QUALITY = 85
+    EXTENSION = ".jpg"
+
+    def __init__(
+        self,
+        store: ImageStore = None,
+        widths: tuple[int, ...] = WIDTHS,
+        quality: int = QUALITY,
+    ):
+        # By default, the shared image store of the application, which is only opened upon first use.
+        self._store = store
+        self.widths = tuple(sorted(widths))
+        self.quality = quality
+
+    @property
+    def store(self) -> ImageStore:
+        if self._store is None:
+            self._store = ImageStore.shared()
+        return self._store
+
+    @staticmethod
+    def variant(width: int) -> str:
+        return f"_{width}w"
+
+    def filename(self, image_id: str, width: int) -> str:
+        return self.store.path(image_id, self.EXTENSION, self.variant(width))
+
+    # Produces the renditions of the image, returning their filenames keyed by width.
+    def generate(self, image: OpenAiImageDto) -> dict[int, str]:
+        renditions = {}
+        for width, rendition in self.downscale(image.image):
+            with self.store.writing(
+                image.id, self.EXTENSION, self.variant(width)
+            ) as filename:
+                self.save(rendition, filename)
+            renditions[width] = self.filename(image.id, width)
+        return renditions
+
+    # Renditions of the (decoded) source image, from the widest to the narrowest, along with their width.
+    def downscale(self, source: "Image.Image") -> Iterator[tuple[int, "Image.Image"]]:
+        from PIL import Image  # pylint: disable=import-outside-toplevel
+
+        for width in reversed(self.widths):
+            if width >= source.width:
+                continue
+            height = max(1, round(source.height * width / source.width))
+            source = source.resize(
+                (width, height), Image.Resampling.LANCZOS, reducing_gap=2.0
+            )
+            yield width, source
+
+    def save(self, rendition: "Image.Image", filename: str) -> None:
+        rendition.save(
+            filename, "JPEG", quality=self.quality, optimize=True, progressive=True
+        )
+
+    # The width of the smallest existing rendition that is at least as wide as requested, or None when the full-size image
+    # is the best fit (or when the renditions have not been produced yet).
+    def best_fit(self, image_id: str, width: float) -> int:
+        files = self.store.get(image_id) or {}
+        for rendition_width in self.widths:
+            if rendition_width >= width and self.variant(rendition_width) in files:
+                return rendition_width
+        return None
@@ -0,0 +1,120 @@
+import os
+import time
+
+from io import BytesIO
+from typing import TYPE_CHECKING, NamedTuple
+
+from imagemetadata import ImageMetadata
+from openai_image_dto import OpenAiImageDto
+
+if TYPE_CHECKING:
+    from PIL import Image
+
+
+# Outcome of encoding an image to disk, along with the time (in seconds) spent in each stage of the encoding pipeline.
+class EncodedImage(NamedTuple):
+    filename: str
+    size: int
+    timings: dict[str, float]
+
+
+# Single Responsibility Principle (SRP): This class has the single responsibility of encoding generated images to disk.
+# The passthrough mode writes the original (lossless PNG) image bytes as-is, so neither a decode nor an encode is needed.
+# The JPEG and WebP modes decode the image and re-encode it with an explicit quality (and, for JPEG, optional progressive
+# and optimized Huffman coding).  Each encoding reports the time spent in the decode, convert, encode and write stages.
+# The metadata of the image (its prompts and request configuration) is embedded in the file, in every mode.
+class ImageEncoder:
+    class Mode:
+        PASSTHROUGH = "passthrough"
+        JPEG = "jpeg"
+        WEBP = "webp"
+
+    class Stage:
+        DECODE = "decode"
+        CONVERT = "convert"
+        ENCODE = "encode"
+        WRITE = "write"
+
+    EXTENSIONS = {Mode.PASSTHROUGH: ".png", Mode.JPEG: ".jpg", Mode.WEBP: ".webp"}
+    QUALITY = 95
+
+    def __init__(
+        self,
+        mode: str = Mode.JPEG,
+        quality: int = QUALITY,
+        progressive: bool = True,
+        optimize: bool = True,
+        lossless: bool = False,
+    ):
+        if mode not in self.EXTENSIONS:
+            raise ValueError(f"Unsupported image encoding mode: {mode}")
+        self.mode = mode
+        self.quality = quality
+        self.progressive = progressive
+        self.optimize = optimize
+        self.lossless = lossless
+
+    @property
+    def extension(self) -> str:
+        return self.EXTENSIONS[self.mode]
+
+    def encode(self, image: OpenAiImageDto, filename: str) -> EncodedImage:
+        timings = {}
+        if self.mode == self.Mode.PASSTHROUGH:
+            start = time.perf_counter()
+            with open(filename, "w+b") as file:
+                image.write_to(file)
+                if image.metadata:
+                    ImageMetadata.append_to_png(file, image.metadata)
+            timings[self.Stage.WRITE] = time.perf_counter() - start
+            return EncodedImage(filename, os.path.getsize(filename), timings)
+
+        # A streamed image was decoded (to its payload file) as it was received, and is read from there by PIL.
+        if not image.streamed:
+            start = time.perf_counter()
+            _ = image.bitmap
+            timings[self.Stage.DECODE] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        pixels = image.image
+        timings[self.Stage.CONVERT] = time.perf_counter() - start
+        return self.encode_pixels(pixels, filename, timings, image.metadata)
+
+    # Encodes the decoded (RGB) pixels to the file, adding the encode and write stages to the timings (of the stages that
+    # decoded them).  Not applicable to the passthrough mode, which writes the original image bytes.
+    def encode_pixels(
+        self,
+        pixels: "Image.Image",
+        filename: str,
+        timings: dict[str, float] = None,
+        metadata: dict = None,
+    ) -> EncodedImage:
+        timings = {} if timings is None else timings
+        # Pillow writes the xmp option of the JPEG encoder as of 11.0 (see requirements.txt), and ignores it before then.
+        options = {"xmp": ImageMetadata.packet(metadata)} if metadata else {}
+        start = time.perf_counter()
+        buffer = BytesIO()
+        if self.mode == self.Mode.JPEG:
+            pixels.save(
+                buffer,
+                "JPEG",
+                quality=self.quality,
+                progressive=self.progressive,
+                optimize=self.optimize,
+                **options,
+            )
+        else:
+            pixels.save(
+                buffer,
+                "WEBP",
+                quality=self.quality,
+                lossless=self.lossless,
+                **options,
+            )
+        timings[self.Stage.ENCODE] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        with open(filename, "wb") as file:
+            file.write(buffer.getbuffer())
+        timings[self.Stage.WRITE] = time.perf_counter() - start
+        return EncodedImage(filename, buffer.tell(), timings)
@@ -1,15 +1,44 @@
+import asyncio
+import contextlib
+import functools
 import json
-from typing import Mapping
-import requests  # The Requests package is recommended for a higher-level HTTP client interface.
+import logging
+import tempfile
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import TYPE_CHECKING, Iterable, Iterator, Mapping, NamedTuple
 
-from httpclient import HttpClient
+from httpclient import HttpClient, PooledHttpSession
+from imagegenerationcache import ImageGenerationCache
 from imagegenerationdb import ImageGenerationDb
+from imagemetadata import ImageMetadata
+from imageresponsestream import ImageResponseStream
+from metrics import Metrics, metrics
 from openai_image_dto import OpenAiImageDto
+from ratelimitscheduler import RateLimitScheduler
+from singleflight import SingleFlight
+
+if TYPE_CHECKING:
+    import requests
+
+    from imageprocessing import ImageProcessingPool
+
+
+# Outcome of a single item of an image generation batch; exactly one of image or error is set.
+class ImageGenerationResult(NamedTuple):
+    index: int
+    prompt: str
+    configuration: dict
+    image: OpenAiImageDto = None
+    error: Exception = None
 
 
 # Single Responsibility Principle (SRP): This class has the single resposiblity of handling the details Image Generation.
 class ImageGeneration:
     USER_AGENT = "ImgGen/1.0"
+    LOGGER = "imagegenie.generation"
+    BATCH_MAX_WORKERS = 4
+    # Payload files of streamed responses are held in memory up to this size, and spill to a temporary file beyond it.
+    PAYLOAD_SPOOL_SIZE = 256 * 1024
 
     class OpenApi:
         KEY = "<<put-your-OpenAI-key-here!>>"
@@ -31,8 +60,67 @@ class ImageGeneration:
         PROMPT_OVERRIDE_TEXT = "I NEED to test hos the tool works with extremely simple prompts.  DO NOT add any detail, just use it AS-IS:"
         REVISED_PROMPT = "revised_prompt"
 
-    def __init__(self):
-        self._db = ImageGenerationDb()
+    def __init__(
+        self,
+        http_session: PooledHttpSession = None,
+        cache: ImageGenerationCache = None,
+        db: ImageGenerationDb = None,
+        scheduler: RateLimitScheduler = None,
+        url: str = OpenApi.URL,
+        stream: bool = False,
+        processor: "ImageProcessingPool" = None,
+        coalesce: bool = True,
+        shared_cache: bool = False,
+    ):
+        # The database is shared with its other users, so that they observe the events logged here (via its indexes).  By
+        # default, it is the shared database of the application, which is only opened upon first use.
+        self._db = db
+        # Long-lived (keep-alive) connection pool, shared by every image generation request.
+        self._http_session = http_session or PooledHttpSession()
+        # Optional response cache; identical requests are then served without a (paid) API call.  When shared_cache is set,
+        # it is the shared cache of the application, which is only opened upon first use.
+        self._cache = cache
+        self._shared_cache = shared_cache
+        # Endpoint of the image generations API (e.g. a local stand-in, see MockImageServer).
+        self.url = url
+        # Optional rate limit scheduler, which paces the requests (by priority) to the rate limit reported by the API.
+        self._scheduler = scheduler
+        # Whether replies are read as they are received, with their image payload decoded straight to a payload file (see
+        # ImageResponseStream), rather than buffered, parsed and then decoded, each holding a copy of the payload.
+        self.stream = stream
+        # Optional image processing pool, on which each generated image is post-processed (decoded, hashed, encoded and
+        # downscaled) as soon as it is received, off the calling thread.
+        self._processor = processor
+        self._logger = logging.getLogger(self.LOGGER)
+        # Identical requests in flight at once (e.g. a double-clicked submit) share a single (paid) API call, and its image,
+        # rather than each making their own (see SingleFlight).
+        self._single_flight = SingleFlight() if coalesce else None
+        if scheduler:
+            scheduler.attach(self._http_session)
+
+    @property
+    def http_session(self) -> PooledHttpSession:
+        return self._http_session
+
+    @property
+    def cache(self) -> ImageGenerationCache:
+        if self._cache is None and self._shared_cache:
+            self._cache = ImageGenerationCache.shared()
+        return self._cache
+
+    @property
+    def db(self) -> ImageGenerationDb:
+        if self._db is None:
+            self._db = ImageGenerationDb.shared()
+        return self._db
+
+    @property
+    def single_flight(self) -> SingleFlight:
+        return self._single_flight
+
+    @property
+    def scheduler(self) -> RateLimitScheduler:
+        return self._scheduler
 
     def build_image_request_header(self) -> Mapping[str, str]:
         return {
@@ -43,23 +131,24 @@ class ImageGeneration:
 
     # The maximum prompt text (description of the desired image) length for OpenAI DALL-E 3 (dall-e-3), is 4,000 characters.
     def build_image_prompt(self, dataset: dict) -> str:
+        entity = ImageGenerationDb.Entity
         prompt_preamble = ""
-        specialization = (
-            f"Specializing as a {dataset[self._db.Entity.TABLE_SPECIALIZATION]}.  "
+        specialization = f"Specializing as a {dataset[entity.TABLE_SPECIALIZATION]}.  "
+        composition_type = f"Create a {dataset[entity.TABLE_IMAGE_COMPOSITION_TYPE]}, "
+        image_style = f"with a {dataset[entity.TABLE_IMAGE_STYLE]} imagery style, "
+        color_scheme = (
+            f"and a {dataset[entity.TABLE_IMAGE_COLOR_SCHEME]} color scheme.  "
         )
-        composition_type = (
-            f"Create a {dataset[self._db.Entity.TABLE_IMAGE_COMPOSITION_TYPE]}, "
+        aesthetics = (
+            f"Use a {dataset[entity.TABLE_IMAGE_AESTHETIC_PATTERN]} aesthetic style.  "
         )
-        image_style = (
-            f"with a {dataset[self._db.Entity.TABLE_IMAGE_STYLE]} imagery style, "
+        depth_of_view = (
+            f"Depth of field is to be {dataset[entity.TABLE_IMAGE_DEPTH_OF_FIELD]}.  "
         )
-        color_scheme = (
-            f"and a {dataset[self._db.Entity.TABLE_IMAGE_COLOR_SCHEME]} color scheme.  "
+        lighting = f"Lighting is {dataset[entity.TABLE_IMAGE_LIGHTING]}.  "
+        contrast = (
+            f"The image is to have {dataset[entity.TABLE_IMAGE_CONTRAST]} contrast.  "
         )
-        aesthetics = f"Use a {dataset[self._db.Entity.TABLE_IMAGE_AESTHETIC_PATTERN]} aesthetic style.  "
-        depth_of_view = f"Depth of field is to be {dataset[self._db.Entity.TABLE_IMAGE_DEPTH_OF_FIELD]}.  "
-        lighting = f"Lighting is {dataset[self._db.Entity.TABLE_IMAGE_LIGHTING]}.  "
-        contrast = f"The image is to have {dataset[self._db.Entity.TABLE_IMAGE_CONTRAST]} contrast.  "
 
         if ImageGeneration.OpenApi.PROMPT_OVERRIDE not in dataset:
             dataset[ImageGeneration.OpenApi.PROMPT_OVERRIDE] = "no"
@@ -82,21 +171,76 @@ class ImageGeneration:
             self.OpenApi.IMAGE_STYLE: configuration[self.OpenApi.IMAGE_STYLE],
         }
 
+    # Requests are keyed by their body (which holds the built prompt), as the response cache is, so an identical request in
+    # flight is joined rather than repeated; its outcome (image or error) is then that of every request that joined it.
     def request_image_generation(
-        self, prompt: str, configuration: dict
+        self,
+        prompt: str,
+        configuration: dict,
+        priority: int = RateLimitScheduler.Priority.INTERACTIVE,
     ) -> OpenAiImageDto:
-        headers = self.build_image_request_header()
         body = self.build_image_request_body(prompt, configuration)
+        if not self._single_flight:
+            return self.__request(prompt, body, priority)
+        return self._single_flight.do(
+            ImageGenerationCache.key(body),
+            lambda: self.__request(prompt, body, priority),
+        )
 
-        # Timeout is intentionally missing (appropriate timeout for OpenAI DALL-E is undefined).
-        # pylint: disable=missing-timeout
-        reply = requests.post(
-            ImageGeneration.OpenApi.URL, data=json.dumps(body), headers=headers
+    # Equivalent of request_image_generation for asyncio tasks; the request is made on the executor of the event loop.
+    async def request_image_generation_async(
+        self,
+        prompt: str,
+        configuration: dict,
+        priority: int = RateLimitScheduler.Priority.INTERACTIVE,
+    ) -> OpenAiImageDto:
+        body = self.build_image_request_body(prompt, configuration)
+        request = functools.partial(self.__request, prompt, body, priority)
+        if not self._single_flight:
+            return await asyncio.get_running_loop().run_in_executor(None, request)
+        return await self._single_flight.do_async(
+            ImageGenerationCache.key(body), request
         )
 
+    def __request(self, prompt: str, body: dict, priority: int) -> OpenAiImageDto:
+        headers = self.build_image_request_header()
+
+        if self.cache:
+            with metrics.stage(Metrics.Stage.CACHE):
+                response = self.cache.get(body)
+            if response:
+                metrics.increment(Metrics.Counter.CACHE_HITS)
+                # Cached images were logged when first generated.
+                return self.__describe(prompt, OpenAiImageDto(response), body)
+            metrics.increment(Metrics.Counter.CACHE_MISSES)
+
+        # Every attempt (retries included) is paced by the scheduler.  The network stage thus includes the waits of retries.
+        def acquire() -> None:
+            with metrics.stage(Metrics.Stage.RATE_LIMIT):
+                self._scheduler.acquire(priority)
+
+        with metrics.stage(Metrics.Stage.NETWORK):
+            reply = self._http_session.post(
+                self.url,
+                data=json.dumps(body),
+                headers=headers,
+                stream=self.stream,
+                acquire=acquire if self._scheduler else None,
+            )
+
+        if reply.ok and self.stream:
+            # The body is received while it is parsed, hence its transfer is measured as part of the parse stage.
+            with metrics.stage(Metrics.Stage.PARSE):
+                image_object = self.__read_streamed(reply, body)
+            self.__log_event(self.__describe(prompt, image_object, body))
+            return image_object
         if reply.ok:
-            image_object = OpenAiImageDto(reply.json())
-            self.__log_event(prompt, image_object)
+            with metrics.stage(Metrics.Stage.PARSE):
+                response = reply.json()
+            image_object = OpenAiImageDto(response)
+            self.__log_event(self.__describe(prompt, image_object, body))
+            if self.cache:
+                self.cache.put(body, response)
             return image_object
         else:
             # Error handling - retrieve the error message and then raise it.
@@ -111,10 +255,116 @@ class ImageGeneration:
             f"Server responded with status code {reply.status_code} due to the call being: {reply.reason}."
         )
 
-    def __log_event(self, prompt: str, image_object: OpenAiImageDto) -> None:
-        log_record = {
+    # Generates an image for each (prompt, configuration) pair concurrently, on a bounded thread pool, and yields each result as
+    # soon as it completes (i.e. not in submission order).  A failed item is reported through its result's error, without
+    # aborting the rest of the batch.  Requests are consumed lazily, so no more than max_workers are ever in flight.
+    # DALL-E 3 only accepts a single image per request (n=1), hence a batch is a set of concurrent requests.
+    def request_image_generation_batch(
+        self,
+        requests: Iterable[tuple[str, dict]],
+        max_workers: int = BATCH_MAX_WORKERS,
+        priority: int = RateLimitScheduler.Priority.BATCH,
+    ) -> Iterator[ImageGenerationResult]:
+        pending = enumerate(requests)
+        in_flight = {}
+
+        def submit_next() -> bool:
+            item = next(pending, None)
+            if item is None:
+                return False
+            index, (prompt, configuration) = item
+            future = executor.submit(
+                self.__request_traced, prompt, configuration, priority
+            )
+            in_flight[future] = ImageGenerationResult(index, prompt, configuration)
+            return True
+
+        executor = ThreadPoolExecutor(max_workers, thread_name_prefix="ImgGen")
+        try:
+            while len(in_flight) < max_workers and submit_next():
+                pass
+            while in_flight:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    result = in_flight.pop(future)
+                    submit_next()
+                    # From the batch's perspective, any failure is confined to its own item.
+                    # pylint: disable=broad-exception-caught
+                    try:
+                        yield result._replace(image=future.result())
+                    except Exception as e:
+                        yield result._replace(error=e)
+        finally:
+            # The consumer may stop iterating early; requests that have not yet started are abandoned.
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    # The reply is read a chunk at a time, and each chunk is both parsed and written to the cache (as received).
+    def __read_streamed(self, reply: "requests.Response", body: dict) -> OpenAiImageDto:
+        payload_file = tempfile.SpooledTemporaryFile(self.PAYLOAD_SPOOL_SIZE)
+        stream = ImageResponseStream(payload_file)
+        with reply, contextlib.ExitStack() as stack:
+            cache_file = None
+            if self.cache:
+                cache_file = stack.enter_context(self.cache.writing(body))
+            for chunk in reply.iter_content(ImageResponseStream.CHUNK_SIZE):
+                stream.feed(chunk)
+                if cache_file:
+                    cache_file.write(chunk)
+            response = stream.close()
+        return OpenAiImageDto(response, payload_file, stream.digest)
+
+    # Each batch item is a request of its own, as far as its (per-request) metrics are concerned.
+    def __request_traced(
+        self, prompt: str, configuration: dict, priority: int
+    ) -> OpenAiImageDto:
+        with metrics.request(prompt_hash=ImageGenerationDb.prompt_hash(prompt)[:16]):
+            return self.request_image_generation(prompt, configuration, priority)
+
+    # The metadata of the image is embedded in its file (see ImageMetadata), hence it is set before the image is written.
+    def __describe(
+        self, prompt: str, image_object: OpenAiImageDto, body: dict
+    ) -> OpenAiImageDto:
+        image_object.metadata = {
             ImageGeneration.OpenApi.PROMPT_TEXT: prompt,
             ImageGeneration.OpenApi.REVISED_PROMPT: image_object.revised_prompt,
             ImageGeneration.OpenApi.IMAGE_TIMESTAMP: image_object.created,
+            ImageGenerationDb.Entity.COLUMN_IMAGE_ID: image_object.id,
+            ImageGeneration.OpenApi.IMAGE_SIZE: body[self.OpenApi.IMAGE_SIZE],
+            ImageMetadata.CONFIGURATION: {
+                key: body[key]
+                for key in (
+                    self.OpenApi.IMAGE_MODEL,
+                    self.OpenApi.IMAGE_QUALITY,
+                    self.OpenApi.IMAGE_STYLE,
+                )
+            },
+        }
+        return image_object
+
+    # The event records the perceptual hash of the image, which is then the outcome of its post-processing.  The image was
+    # paid for, hence it is logged regardless: should neither its post-processing nor its decode succeed, it is logged
+    # without a perceptual hash (which the perceptual hash backfill then fills in, if it can).
+    # pylint: disable=broad-exception-caught
+    def __log_event(self, image_object: OpenAiImageDto) -> None:
+        if self._processor:
+            try:
+                self._processor.submit(image_object)
+            except Exception as e:
+                self._logger.warning(
+                    "Image %s could not be post-processed: %s", image_object.id, e
+                )
+        log_record = {
+            key: value
+            for key, value in image_object.metadata.items()
+            if key != ImageMetadata.CONFIGURATION
         }
-        self._db.write_event(log_record)
+        try:
+            perceptual_hash = image_object.perceptual_hash
+        except Exception as e:
+            self._logger.warning(
+                "Image %s could not be perceptually hashed: %s", image_object.id, e
+            )
+            perceptual_hash = None
+        log_record[ImageGenerationDb.Entity.COLUMN_PERCEPTUAL_HASH] = perceptual_hash
+        with metrics.stage(Metrics.Stage.DB_WRITE):
+            self.db.write_event(log_record)
@@ -0,0 +1,180 @@
+import contextlib
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+from collections import OrderedDict
+from typing import BinaryIO, Iterator
+
+
+# Single Responsibility Principle (SRP): This class has the single responsibility of caching image generation responses on disk.
+# The cache is content-addressed: each entry is keyed by a hash of the complete image request body, which comprises the final
+# prompt text and every configuration value (size, quality, style, model...) that influences the generated image.  Entries
+# are evicted in least recently used (LRU) order once either the entry count or the total size bound is exceeded, and can
+# optionally expire after a time-to-live (TTL).  Recency survives restarts, as it is persisted via the entry's file times.
+class ImageGenerationCache:
+    DIRECTORY = "cache"
+    MAX_ENTRIES = 500
+    MAX_BYTES = 1024**3
+    EXTENSION = ".json"
+
+    class Entry:
+        STORED = "stored"
+        RESPONSE = "response"
+
+    # Options (constructor arguments) of the shared cache, which are to be set before its first use.
+    shared_options = dict[str, object]()
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    # The response cache of the application, shared by all of its components.  Its directory is only scanned upon first
+    # use, rather than upon import, so that the startup time of the application does not grow with the cached entries.
+    @classmethod
+    def shared(cls) -> "ImageGenerationCache":
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls(**cls.shared_options)
+            return cls._shared
+
+    def __init__(
+        self,
+        directory: str = DIRECTORY,
+        max_entries: int = MAX_ENTRIES,
+        max_bytes: int = MAX_BYTES,
+        ttl: float = None,
+    ):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        # Entry key to file size, ordered from least to most recently used.
+        self._entries = OrderedDict[str, int]()
+        self._total_bytes = 0
+        self._load()
+
+    @staticmethod
+    def key(request_body: dict) -> str:
+        canonical = json.dumps(request_body, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+    def get(self, request_body: dict) -> dict:
+        key = self.key(request_body)
+        with self._lock:
+            cached = key in self._entries
+        # Entries (of up to several megabytes) are read and parsed without holding the lock, so lookups of other entries are
+        # not serialized behind them.  Entries are replaced by renaming, so the read never observes a partially written one.
+        entry = self._read(key) if cached else None
+        with self._lock:
+            if entry is not None and not self._expired(entry):
+                # The entry may have been evicted meanwhile, but the response read is nonetheless valid.
+                if key in self._entries:
+                    self._entries.move_to_end(key)
+                    self._touch(key)
+                self.hits += 1
+                return entry[self.Entry.RESPONSE]
+            if cached:
+                self._remove(key)
+            self.misses += 1
+            return None
+
+    def put(self, request_body: dict, response: dict) -> None:
+        with self.writing(request_body) as file:
+            file.write(json.dumps(response).encode("utf-8"))
+
+    # Stores the response (JSON text) that is written to the yielded file, e.g. a response that is streamed as it is
+    # received, without holding it in memory.  The entry is discarded if an exception is raised while writing it.
+    @contextlib.contextmanager
+    def writing(self, request_body: dict) -> Iterator[BinaryIO]:
+        key = self.key(request_body)
+        os.makedirs(self.directory, exist_ok=True)
+        # Written to a temporary file and then renamed, so a reader never observes a partially written entry.
+        handle, temporary = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(handle, "wb") as file:
+                entry = {self.Entry.STORED: time.time(), self.Entry.RESPONSE: None}
+                # The entry's JSON text, up to (i.e. without) the response.
+                file.write(json.dumps(entry)[: -len("null}")].encode("utf-8"))
+                yield file
+                file.write(b"}")
+        except BaseException:
+            os.remove(temporary)
+            raise
+        with self._lock:
+            os.replace(temporary, self._path(key))
+
+            if key in self._entries:
+                self._total_bytes -= self._entries.pop(key)
+            self._entries[key] = os.path.getsize(self._path(key))
+            self._total_bytes += self._entries[key]
+            self._evict()
+
+    def clear(self) -> None:
+        with self._lock:
+            for key in list(self._entries):
+                self._remove(key)
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "bytes": self._total_bytes,
+            }
+
+    def _load(self) -> None:
+        if not os.path.isdir(self.directory):
+            return
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and entry.name.endswith(self.EXTENSION):
+                key = entry.name[: -len(self.EXTENSION)]
+                status = entry.stat()
+                files.append((status.st_mtime, key, status.st_size))
+        for _, key, size in sorted(files):
+            self._entries[key] = size
+            self._total_bytes += size
+        self._evict()
+
+    def _evict(self) -> None:
+        while self._entries and (
+            len(self._entries) > self.max_entries or self._total_bytes > self.max_bytes
+        ):
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _expired(self, entry: dict) -> bool:
+        return (
+            self.ttl is not None and time.time() - entry[self.Entry.STORED] > self.ttl
+        )
+
+    def _read(self, key: str) -> dict:
+        try:
+            with open(self._path(key), encoding="utf-8") as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return None
+
+    def _touch(self, key: str) -> None:
+        try:
+            os.utime(self._path(key))
+        except OSError:
+            pass
+
+    def _remove(self, key: str) -> None:
+        self._total_bytes -= self._entries.pop(key, 0)
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key + self.EXTENSION)
@@ -1,4 +1,19 @@
-from tinydb import Query, TinyDB
+import atexit
+import hashlib
+import threading
+
+import sys
+
+from typing import Callable, Iterator
+
+from tinydb import TinyDB
+from tinydb.table import Document
+
+from eventlogarchive import EventLogArchive
+from metrics import Metrics, metrics
+from perceptualhash import PerceptualHash, PerceptualHashIndex
+from sqlitestorage import SqliteStorage
+from textindex import TextIndex
 
 
 # Single Responsibility Principle (SRP): Data persistance "bridge" design pattern, that provides an abstraction
@@ -6,12 +21,86 @@ from tinydb import Query, TinyDB
 
 
 # TinyDB is a lightweight database and this is the only class in the project that has interaction with its implementation.
+# SQLite is the alternative implementation (selected via the backend), whose storage offers the same table interface.
 class ImageGenerationDb:
 
-    def __init__(self):
-        self._db = TinyDB(self.DATABASE)
+    def __init__(
+        self,
+        database: str = None,
+        durability: str = None,
+        flush_size: int = None,
+        flush_interval: float = None,
+        backend: str = None,
+        archive: str = None,
+        hot_segment_size: int = None,
+    ):
+        self.backend = backend or self.Backend.TINYDB
+        if self.backend == self.Backend.SQLITE:
+            self._db = SqliteStorage(database or self.SQLITE_DATABASE)
+            event_log = self._db.table(self.Entity.TABLE_EVENT_LOG)
+            event_log.create_index(self.Entity.COLUMN_CREATED)
+            event_log.create_index(self.Entity.COLUMN_PROMPT)
+            event_log.create_index(self.Entity.COLUMN_IMAGE_ID)
+        else:
+            self._db = TinyDB(database or self.DATABASE)
+        # TinyDB is not thread-safe; event log writes may come from concurrent image generations.
+        self._lock = threading.RLock()
+        self._event_log_by_created = dict[int, dict]()
+        self._event_log_by_prompt_hash = dict[str, list[dict]]()
+        self._event_log_by_image_id = dict[str, dict]()
+        self._event_log_text_index = None
+        self._event_log_hash_index = None
+        self._catalog = None
+        self.durability = durability or self.Durability.SYNC
+        self.flush_size = flush_size or self.FLUSH_SIZE
+        self.flush_interval = flush_interval or self.FLUSH_INTERVAL
+        self._pending_events = list[dict]()
+        self._flush_timer = None
+        # Rotated (cold) segments of the event log; the event log is not rotated without an archive directory.
+        self.archive = EventLogArchive(archive) if archive else None
+        self.hot_segment_size = hot_segment_size or self.HOT_SEGMENT_SIZE
+        self._hot_event_count = 0
+        self._archived_by_prompt_hash = None
+        if self.durability == self.Durability.BATCHED:
+            atexit.register(self.flush)
+        self.rebuild_event_log_index()
 
     DATABASE = "db.json"
+    SQLITE_DATABASE = "db.sqlite"
+    FLUSH_SIZE = 50
+    FLUSH_INTERVAL = 2.0
+    ARCHIVE = EventLogArchive.DIRECTORY
+    # Number of (most recent) events kept in the database by a rotation.  The event log is rotated once it holds twice as
+    # many, so the database file stays small, and a rotation happens once every HOT_SEGMENT_SIZE events.
+    HOT_SEGMENT_SIZE = 1000
+
+    # Options (constructor arguments) of the shared database, which are to be set before its first use.
+    shared_options = dict[str, object]()
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    # The database of the application, shared by all of its components (a single handle, hence a single parse of the
+    # database file and a single set of indexes).  It is only opened upon first use, rather than upon import, so that the
+    # startup time of the application and its tests does not grow with the database.
+    @classmethod
+    def shared(cls) -> "ImageGenerationDb":
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls(**cls.shared_options)
+            return cls._shared
+
+    # The default JSON storage rewrites the entire database file upon each insert.  In batched (write-behind) mode, events are
+    # queued, and then written as a group once flush_size events are pending, or flush_interval seconds after the first
+    # pending event, whichever comes first, as well as upon close/exit.  A crash may lose the events that are pending.
+    class Durability:
+        SYNC = "sync"
+        BATCHED = "batched"
+
+    # TinyDB loads the entire database into memory, hence its event log lookups are served from in-memory indexes.  SQLite
+    # event log lookups are served by its own (persistent) indexes, so only the pending (batched) events are held in memory.
+    class Backend:
+        TINYDB = "tinydb"
+        SQLITE = "sqlite"
 
     class Entity:
         TABLE_DEFAULT = "_default"
@@ -25,6 +114,23 @@ class ImageGenerationDb:
         TABLE_IMAGE_LIGHTING = "image_lighting"
         TABLE_IMAGE_STYLE = "image_style"
         COLUMN_NAME = "name"
+        COLUMN_CREATED = "created"
+        COLUMN_PROMPT = "prompt"
+        COLUMN_IMAGE_ID = "image_id"
+        COLUMN_REVISED_PROMPT = "revised_prompt"
+        COLUMN_PERCEPTUAL_HASH = "perceptual_hash"
+
+        # Image aspect tables (i.e. the selection lists of the image definition).
+        ASPECT_TABLES = (
+            TABLE_SPECIALIZATION,
+            TABLE_IMAGE_AESTHETIC_PATTERN,
+            TABLE_IMAGE_COLOR_SCHEME,
+            TABLE_IMAGE_COMPOSITION_TYPE,
+            TABLE_IMAGE_CONTRAST,
+            TABLE_IMAGE_DEPTH_OF_FIELD,
+            TABLE_IMAGE_LIGHTING,
+            TABLE_IMAGE_STYLE,
+        )
 
     @property
     def database(self):
@@ -71,15 +177,366 @@ class ImageGenerationDb:
     def image_contrast(self):
         return self._db.table(self.Entity.TABLE_IMAGE_CONTRAST)
 
+    # Image aspect names of every aspect table, keyed by table name.  The catalog is built once, then served from memory
+    # until the aspect tables are (re)seeded.
+    def get_catalog(self) -> dict[str, list[str]]:
+        with self._lock:
+            if self._catalog is None:
+                self._catalog = {
+                    table: [
+                        record[self.Entity.COLUMN_NAME]
+                        for record in self._db.table(table)
+                    ]
+                    for table in self.Entity.ASPECT_TABLES
+                }
+            return {table: list(names) for table, names in self._catalog.items()}
+
+    # Event log lookups are served from in-memory secondary indexes (keyed on "created" and on the prompt hash), rather than
+    # a TinyDB query, which deserializes and scans every event log record on each call.  Events that are no longer in the
+    # hot segment are looked up in the archive (in the partition of their month).
     def get_event_log_by_created(self, created: int) -> dict:
-        query = Query()
-        result = self._db.table(self.Entity.TABLE_EVENT_LOG).search(
-            query.created == created
-        )
-        return next(iter(result), None)
+        with self._lock:
+            if self.backend == self.Backend.SQLITE:
+                event_log = self._db.table(self.Entity.TABLE_EVENT_LOG)
+                events = event_log.search_by(self.Entity.COLUMN_CREATED, created)
+                if events:
+                    return events[0]
+            event = self._event_log_by_created.get(created)
+            if event is None and self.archive is not None:
+                event = next(iter(self.archive.find_by_created(created)), None)
+            return event
+
+    # Unlike "created", the image identifier is unique to an image (see OpenAiImageDto.id).
+    def get_event_log_by_image_id(self, image_id: str) -> dict:
+        with self._lock:
+            if self.backend == self.Backend.SQLITE:
+                event_log = self._db.table(self.Entity.TABLE_EVENT_LOG)
+                events = event_log.search_by(self.Entity.COLUMN_IMAGE_ID, image_id)
+                if events:
+                    return events[0]
+            event = self._event_log_by_image_id.get(image_id)
+            created = self._created_of(image_id)
+            if event is None and self.archive is not None and created is not None:
+                event = next(
+                    (
+                        archived
+                        for archived in self.archive.find_by_created(created)
+                        if archived.get(self.Entity.COLUMN_IMAGE_ID) == image_id
+                    ),
+                    None,
+                )
+            return event
+
+    def get_event_log_by_prompt(self, prompt: str) -> list[dict]:
+        with self._lock:
+            events = []
+            if self.backend == self.Backend.SQLITE:
+                event_log = self._db.table(self.Entity.TABLE_EVENT_LOG)
+                events = event_log.search_by(self.Entity.COLUMN_PROMPT, prompt)
+            events += self._event_log_by_prompt_hash.get(self.prompt_hash(prompt), [])
+            if self.archive is None:
+                return events
+            # Prompt lookups are not confined to a partition, hence the archive is indexed by prompt hash upon first use.
+            if self._archived_by_prompt_hash is None:
+                self._archived_by_prompt_hash = {}
+                for event in self.archive:
+                    self._index_archived_event(event)
+            archived = self._archived_by_prompt_hash.get(self.prompt_hash(prompt), [])
+            return archived + events
+
+    # Events whose prompt or revised prompt contain the words of the query, best match first, a page at a time, along with
+    # the total number of matching events.  The full-text index is built upon the first search (for either backend), and
+    # then maintained as events are written.
+    def search_event_log(
+        self, query: str, offset: int = 0, limit: int = TextIndex.PAGE_SIZE
+    ) -> tuple[int, list[dict]]:
+        with self._lock:
+            if self._event_log_text_index is None:
+                self.flush()
+                self._event_log_text_index = TextIndex()
+                for event in self._all_events():
+                    self._index_event_text(event)
+            total, matches = self._event_log_text_index.search(query, offset, limit)
+            return total, [event for event, _ in matches]
+
+    # Events whose image is near-identical to the image of the perceptual hash (within the Hamming distance), nearest first,
+    # along with their distance.  The image itself (if already logged) is excluded.  Like the full-text index, the
+    # perceptual hash index is built upon the first search, and then maintained as events are written.
+    def find_similar_events(
+        self,
+        perceptual_hash: str,
+        max_distance: int = PerceptualHash.MAX_DISTANCE,
+        exclude_image_id: str = None,
+    ) -> list[tuple[int, dict]]:
+        with self._lock:
+            if self._event_log_hash_index is None:
+                self.flush()
+                self._event_log_hash_index = PerceptualHashIndex()
+                for event in self._all_events():
+                    self._index_event_hash(event)
+            return [
+                (distance, event)
+                for distance, event in self._event_log_hash_index.search(
+                    perceptual_hash, max_distance
+                )
+                if exclude_image_id is None
+                or event.get(self.Entity.COLUMN_IMAGE_ID) != exclude_image_id
+            ]
+
+    # Records the perceptual hashes of the images of already logged events (e.g. see perceptualhash.backfill), keyed by
+    # image key, whether the events are in the database or in the archive.  The event log is rewritten once (and only the
+    # archive partitions of the images' months), and its indexes are rebuilt.  Returns the number of events updated.
+    def set_perceptual_hashes(self, hashes: dict[str, str]) -> int:
+        updated = 0
+
+        def update(event: dict) -> bool:
+            nonlocal updated
+            perceptual_hash = hashes.get(self.image_key(event))
+            if perceptual_hash is None:
+                return False
+            event[self.Entity.COLUMN_PERCEPTUAL_HASH] = perceptual_hash
+            updated += 1
+            return True
+
+        with self._lock:
+            if hashes:
+                self.flush()
+                self._db.table(self.Entity.TABLE_EVENT_LOG).update(update)
+                if self.archive is not None:
+                    created = {self._created_of(key) for key in hashes}
+                    partitions = None
+                    if None not in created:
+                        partitions = {self.archive.partition(c) for c in created}
+                    self.archive.update(update, partitions)
+                    self._archived_by_prompt_hash = None
+                self.rebuild_event_log_index()
+        return updated
 
     def write_event(self, event: object) -> None:
-        self._db.table(self.Entity.TABLE_EVENT_LOG).insert(event)
+        with self._lock:
+            self._hot_event_count += 1
+            if self.durability == self.Durability.SYNC:
+                doc_id = self._db.table(self.Entity.TABLE_EVENT_LOG).insert(event)
+                if self.backend == self.Backend.TINYDB:
+                    self._index_event(Document(event, doc_id))
+                self._index_event_text(event)
+                self._index_event_hash(event)
+                self._rotate_if_full()
+                return
+
+            # Pending events are indexed immediately, so they can be looked up before they are flushed.
+            self._pending_events.append(event)
+            self._index_event(event)
+            self._index_event_text(event)
+            self._index_event_hash(event)
+            if len(self._pending_events) >= self.flush_size:
+                self.flush()
+            elif self._flush_timer is None:
+                self._flush_timer = threading.Timer(self.flush_interval, self.flush)
+                self._flush_timer.daemon = True
+                self._flush_timer.start()
+            self._rotate_if_full()
+
+    # Moves all but the most recent (keep) events of the event log to the archive, so that the database does not grow with
+    # the history of image generations.  Events are archived before they are removed from the database, so an interrupted
+    # rotation leaves events in both segments (which the next rotation reconciles), rather than in neither.  Returns the
+    # number of events archived.
+    def rotate_event_log(self, keep: int = None) -> int:
+        keep = self.hot_segment_size if keep is None else keep
+        with self._lock:
+            if self.archive is None:
+                return 0
+            self.flush()
+            event_log = self._db.table(self.Entity.TABLE_EVENT_LOG)
+            events = event_log.all()
+            if len(events) <= keep:
+                return 0
+            events.sort(
+                key=lambda event: (
+                    event.get(self.Entity.COLUMN_CREATED) or 0,
+                    event.doc_id,
+                )
+            )
+            rotated = events[: len(events) - keep]
+            self.archive.append(rotated)
+            event_log.remove(doc_ids=[event.doc_id for event in rotated])
+            if self._archived_by_prompt_hash is not None:
+                for event in rotated:
+                    self._index_archived_event(event)
+            # The events are still logged (i.e. their full-text and perceptual hash indexes are unaffected), only elsewhere.
+            self._rebuild_hot_index()
+            return len(rotated)
+
+    # Removes the events (from the database and from the archive) that match the predicate, and rebuilds the event log
+    # indexes.  The archive partitions can be narrowed down to those of the given "created" values.  Returns the number of
+    # events removed.
+    def remove_events(
+        self, predicate: Callable[[dict], bool], created: list[int] = None
+    ) -> int:
+        with self._lock:
+            self.flush()
+            event_log = self._db.table(self.Entity.TABLE_EVENT_LOG)
+            doc_ids = [event.doc_id for event in event_log.all() if predicate(event)]
+            if doc_ids:
+                event_log.remove(doc_ids=doc_ids)
+            removed = len(doc_ids)
+            if self.archive is not None:
+                partitions = None
+                if created is not None:
+                    partitions = {self.archive.partition(value) for value in created}
+                removed += self.archive.remove(predicate, partitions)
+            if removed:
+                self._archived_by_prompt_hash = None
+                self.rebuild_event_log_index()
+            return removed
+
+    # Removes the events of an image (by image key), e.g. once the image was deleted.
+    def remove_image_events(self, image_key: str) -> int:
+        created = self._created_of(image_key)
+        return self.remove_events(
+            lambda event: self.image_key(event) == image_key,
+            None if created is None else [created],
+        )
+
+    # Removes the events whose image no longer exists (e.g. images deleted before their events were removed along with them).
+    def sweep_orphaned_events(self, exists: Callable[[dict], bool]) -> int:
+        return self.remove_events(lambda event: not exists(event))
+
+    # Writes the pending (batched) events to the database, as a single group.
+    def flush(self) -> None:
+        with self._lock:
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+            if self._pending_events:
+                events, self._pending_events = self._pending_events, []
+                event_log = self._db.table(self.Entity.TABLE_EVENT_LOG)
+                with metrics.stage(Metrics.Stage.DB_FLUSH):
+                    event_log.insert_multiple(events)
+                if self.backend == self.Backend.SQLITE:
+                    self._event_log_by_created.clear()
+                    self._event_log_by_prompt_hash.clear()
+                    self._event_log_by_image_id.clear()
+
+    def close(self) -> None:
+        with self._lock:
+            self.flush()
+            self._db.close()
+        if self.durability == self.Durability.BATCHED:
+            atexit.unregister(self.flush)
+
+    # Rebuilds the event log indexes from the persisted event log (e.g. after the database file was modified externally).
+    def rebuild_event_log_index(self) -> None:
+        with self._lock:
+            self.flush()
+            self._event_log_text_index = None
+            self._event_log_hash_index = None
+            self._rebuild_hot_index()
+
+    def _rebuild_hot_index(self) -> None:
+        self._event_log_by_created.clear()
+        self._event_log_by_prompt_hash.clear()
+        self._event_log_by_image_id.clear()
+        event_log = self._db.table(self.Entity.TABLE_EVENT_LOG)
+        if self.backend == self.Backend.TINYDB:
+            events = event_log.all()
+            for event in events:
+                self._index_event(event)
+            self._hot_event_count = len(events)
+        else:
+            self._hot_event_count = len(event_log)
+
+    def _rotate_if_full(self) -> None:
+        if (
+            self.archive is not None
+            and self._hot_event_count >= 2 * self.hot_segment_size
+        ):
+            self.rotate_event_log()
+
+    # Every logged event, archived (oldest first) or not.
+    def events(self) -> Iterator[dict]:
+        self.flush()
+        return self._all_events()
+
+    # Every logged event: the archived events (oldest first), then the events of the database.
+    def _all_events(self) -> Iterator[dict]:
+        if self.archive is not None:
+            yield from self.archive
+        yield from self._db.table(self.Entity.TABLE_EVENT_LOG).all()
+
+    # One-shot migration, which imports every table of an existing (TinyDB) JSON database into this database, replacing the
+    # tables of the same name.  Returns the number of records imported per table.
+    def import_database(self, source: str) -> dict[str, int]:
+        imported = {}
+        source_db = TinyDB(source, access_mode="r")
+        try:
+            with self._lock:
+                self.flush()
+                for name in source_db.tables():
+                    records = source_db.table(name).all()
+                    self._db.table(name).truncate()
+                    self._db.table(name).insert_multiple(records)
+                    imported[name] = len(records)
+                self._catalog = None
+                self.rebuild_event_log_index()
+        finally:
+            source_db.close()
+        return imported
+
+    @staticmethod
+    def prompt_hash(prompt: str) -> str:
+        return hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+
+    # Key of the image of an event: its image identifier, or for images stored prior to the image store, its "created"
+    # value (which their file is named after).
+    @classmethod
+    def image_key(cls, event: dict) -> str:
+        image_id = event.get(cls.Entity.COLUMN_IMAGE_ID)
+        if image_id is not None:
+            return image_id
+        return str(event.get(cls.Entity.COLUMN_CREATED))
+
+    def _index_event(self, event: dict) -> None:
+        # The first event logged for a given "created" value wins, consistent with the original query semantics.
+        self._event_log_by_created.setdefault(
+            event.get(self.Entity.COLUMN_CREATED), event
+        )
+        prompt = event.get(self.Entity.COLUMN_PROMPT)
+        if prompt is not None:
+            self._event_log_by_prompt_hash.setdefault(
+                self.prompt_hash(prompt), []
+            ).append(event)
+        image_id = event.get(self.Entity.COLUMN_IMAGE_ID)
+        if image_id is not None:
+            self._event_log_by_image_id.setdefault(image_id, event)
+
+    def _index_archived_event(self, event: dict) -> None:
+        prompt = event.get(self.Entity.COLUMN_PROMPT)
+        if prompt is not None:
+            self._archived_by_prompt_hash.setdefault(
+                self.prompt_hash(prompt), []
+            ).append(event)
+
+    # "Created" value prefix of an image key (see ImageStore.created_of), or None when the key has none.
+    @staticmethod
+    def _created_of(image_key: str) -> int:
+        try:
+            return int(str(image_key).split("-", 1)[0])
+        except ValueError:
+            return None
+
+    def _index_event_text(self, event: dict) -> None:
+        if self._event_log_text_index is not None:
+            self._event_log_text_index.add(
+                event,
+                event.get(self.Entity.COLUMN_PROMPT),
+                event.get(self.Entity.COLUMN_REVISED_PROMPT),
+            )
+
+    def _index_event_hash(self, event: dict) -> None:
+        perceptual_hash = event.get(self.Entity.COLUMN_PERCEPTUAL_HASH)
+        if self._event_log_hash_index is not None and perceptual_hash:
+            self._event_log_hash_index.add(perceptual_hash, event)
 
     # Populates the database with initial data to provide a consistent starting point.
     # Each dataset is maintained in its own database table which avoids the need to preprocess it upon retrieval (e.g. filtering),
@@ -115,6 +572,11 @@ class ImageGenerationDb:
     # Contrast:
     # Allows for guidance in the different levels of distinction or difference between light and dark areas within an image.
     def seed_database(self):
+        with self._lock:
+            self._seed_aspect_tables()
+            self._catalog = None
+
+    def _seed_aspect_tables(self):
         self.specialization.truncate()
         specializations = [
             {self.Entity.COLUMN_NAME: "Digital Artist"},
@@ -233,6 +695,30 @@ class ImageGenerationDb:
         self.image_contrast.insert_multiple(contrast)
 
 
+# Usage:
+#     python imagegenerationdb.py                                 (seeds the TinyDB database)
+#     python imagegenerationdb.py migrate [db.json] [db.sqlite]   (migrates the TinyDB database to SQLite)
+#     python imagegenerationdb.py rotate [keep]                   (moves all but the most recent events to the archive)
+#     python imagegenerationdb.py sweep                           (removes the events whose image no longer exists)
 if __name__ == "__main__":
-    obj = ImageGenerationDb()
-    obj.seed_database()
+    if sys.argv[1:2] in (["rotate"], ["sweep"]):
+        # The application's database (i.e. its backend and archive), and image locations.
+        import project  # pylint: disable=import-outside-toplevel
+
+        if sys.argv[1] == "rotate":
+            keep = int(sys.argv[2]) if len(sys.argv) > 2 else None
+            print(f"{project.db().rotate_event_log(keep)} event(s) archived")
+        else:
+            removed = project.db().sweep_orphaned_events(project.image_exists)
+            print(f"{removed} event(s) removed")
+        project.db().close()
+    elif sys.argv[1:2] == ["migrate"]:
+        source = sys.argv[2] if len(sys.argv) > 2 else ImageGenerationDb.DATABASE
+        target = sys.argv[3] if len(sys.argv) > 3 else ImageGenerationDb.SQLITE_DATABASE
+        obj = ImageGenerationDb(target, backend=ImageGenerationDb.Backend.SQLITE)
+        for table, count in obj.import_database(source).items():
+            print(f"{table}: {count} record(s) imported")
+        obj.close()
+    else:
+        obj = ImageGenerationDb()
+        obj.seed_database()
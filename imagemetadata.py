@@ -0,0 +1,191 @@
+import json
+import struct
+import sys
+import zlib
+
+from typing import TYPE_CHECKING, BinaryIO
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+
+if TYPE_CHECKING:
+    from imagegenerationdb import ImageGenerationDb
+    from imagestore import ImageStore
+
+
+# Single Responsibility Principle (SRP): This class has the single responsibility of embedding the metadata of a generated
+# image (its prompt, revised prompt and request configuration) in the image file itself, and of reading it back.
+# The metadata is stored as an XMP packet, which each supported format holds in a chunk of its own: an iTXt chunk for PNG, an
+# APP1 segment for JPEG, and an "XMP " chunk for WebP.  It is read by walking the chunks (or segments) of the file, seeking
+# over the rest, so the pixels are never decoded (nor even read, but for the JPEG segments that precede them).  An image
+# file is thus self-describing: the view reads its prompts from the file, and the event log can be rebuilt from the files.
+class ImageMetadata:
+    NAMESPACE = "urn:imagegenie:metadata:1.0"
+    PREFIX = "imagegenie"
+    ATTRIBUTE = f"{{{NAMESPACE}}}metadata"
+    CONFIGURATION = "configuration"
+
+    PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+    PNG_XMP_KEYWORD = b"XML:com.adobe.xmp"
+    JPEG_SIGNATURE = b"\xff\xd8"
+    JPEG_XMP_HEADER = b"http://ns.adobe.com/xap/1.0/\x00"
+    WEBP_SIGNATURE = b"WEBP"
+
+    class JpegMarker:
+        APP1 = 0xE1
+        SOS = 0xDA
+        EOI = 0xD9
+
+    # XMP packet holding the metadata (as JSON), e.g. for PIL's xmp option of the JPEG and WebP encoders.
+    @classmethod
+    def packet(cls, metadata: dict) -> bytes:
+        value = escape(json.dumps(metadata), {'"': "&quot;"})
+        return (
+            '<?xpacket begin="\ufeff" id="W5M0MpCehiHzreSzNTczkc9d"?>'
+            '<x:xmpmeta xmlns:x="adobe:ns:meta/">'
+            '<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">'
+            f'<rdf:Description rdf:about="" xmlns:{cls.PREFIX}="{cls.NAMESPACE}" '
+            f'{cls.PREFIX}:metadata="{value}"/>'
+            "</rdf:RDF></x:xmpmeta>"
+            '<?xpacket end="r"?>'
+        ).encode("utf-8")
+
+    # The metadata of the XMP packet, or None if it holds none (e.g. a packet written by another application).
+    @classmethod
+    def parse(cls, packet: bytes) -> dict:
+        try:
+            root = ElementTree.fromstring(packet)
+        except ElementTree.ParseError:
+            return None
+        for element in root.iter():
+            value = element.get(cls.ATTRIBUTE)
+            if value is None and element.tag == cls.ATTRIBUTE:
+                value = element.text
+            if value:
+                return json.loads(value)
+        return None
+
+    # Metadata of the image file, or None if it has none (e.g. an image written before metadata was embedded).
+    @classmethod
+    def read(cls, filename: str) -> dict:
+        with open(filename, "rb") as file:
+            header = file.read(12)
+            file.seek(0)
+            if header.startswith(cls.PNG_SIGNATURE):
+                packet = cls._read_png(file)
+            elif header.startswith(cls.JPEG_SIGNATURE):
+                packet = cls._read_jpeg(file)
+            elif header[8:12] == cls.WEBP_SIGNATURE:
+                packet = cls._read_webp(file)
+            else:
+                packet = None
+        return cls.parse(packet) if packet else None
+
+    # Adds the metadata to the PNG image just written to the file (i.e. in place, without decoding the image), in an iTXt
+    # chunk ahead of its closing (IEND) chunk.
+    @classmethod
+    def append_to_png(cls, file: BinaryIO, metadata: dict) -> None:
+        file.seek(-12, 2)
+        end = file.read(12)
+        if end[4:8] != b"IEND":
+            raise ValueError("The image is not a complete PNG image.")
+        # Keyword, compression flag and method (uncompressed), and empty language tag and translated keyword.
+        data = cls.PNG_XMP_KEYWORD + b"\x00\x00\x00\x00\x00" + cls.packet(metadata)
+        chunk = struct.pack(">I", len(data)) + b"iTXt" + data
+        chunk += struct.pack(">I", zlib.crc32(b"iTXt" + data))
+        file.seek(-12, 2)
+        file.write(chunk + end)
+
+    @classmethod
+    def _read_png(cls, file: BinaryIO) -> bytes:
+        file.seek(len(cls.PNG_SIGNATURE))
+        while header := file.read(8):
+            if len(header) < 8:
+                break
+            length, chunk_type = struct.unpack(">I4s", header)
+            if chunk_type == b"IEND":
+                break
+            if chunk_type != b"iTXt":
+                file.seek(length + 4, 1)
+                continue
+            data = file.read(length)
+            file.seek(4, 1)
+            keyword, _, rest = data.partition(b"\x00")
+            if keyword != cls.PNG_XMP_KEYWORD or len(rest) < 2:
+                continue
+            compressed = rest[0] == 1
+            _, _, rest = rest[2:].partition(b"\x00")  # Language tag.
+            _, _, text = rest.partition(b"\x00")  # Translated keyword.
+            return zlib.decompress(text) if compressed else text
+        return None
+
+    # Segments are walked up to the start of the scan (i.e. the compressed pixels), which is preceded by every APPn segment.
+    @classmethod
+    def _read_jpeg(cls, file: BinaryIO) -> bytes:
+        file.seek(len(cls.JPEG_SIGNATURE))
+        while True:
+            marker = file.read(2)
+            if len(marker) < 2 or marker[0] != 0xFF:
+                return None
+            if marker[1] in (cls.JpegMarker.SOS, cls.JpegMarker.EOI):
+                return None
+            length = struct.unpack(">H", file.read(2))[0] - 2
+            if marker[1] != cls.JpegMarker.APP1:
+                file.seek(length, 1)
+                continue
+            data = file.read(length)
+            if data.startswith(cls.JPEG_XMP_HEADER):
+                return data[len(cls.JPEG_XMP_HEADER) :]
+
+    @classmethod
+    def _read_webp(cls, file: BinaryIO) -> bytes:
+        file.seek(12)
+        while header := file.read(8):
+            if len(header) < 8:
+                break
+            fourcc, length = struct.unpack("<4sI", header)
+            if fourcc == b"XMP ":
+                return file.read(length)
+            # Chunks are padded to an even size.
+            file.seek(length + (length & 1), 1)
+        return None
+
+
+# Rebuilds the event log from the metadata of the stored images, logging an event for each image the event log is missing
+# (e.g. after the database was lost).  The perceptual hash is not part of the metadata (the image is written before it is
+# known), and is then left to the perceptual hash backfill.  Returns the number of events logged.
+def rebuild_event_log(db: "ImageGenerationDb", store: "ImageStore") -> int:
+    logged = 0
+    for image_id in store:
+        if db.get_event_log_by_image_id(image_id) is not None:
+            continue
+        files = store.get(image_id)
+        try:
+            metadata = ImageMetadata.read(files[""]) if files and "" in files else None
+        except OSError:
+            metadata = None
+        if metadata is None:
+            continue
+        metadata.pop(ImageMetadata.CONFIGURATION, None)
+        db.write_event(metadata)
+        logged += 1
+    db.flush()
+    return logged
+
+
+# Usage:
+#     python imagemetadata.py rebuild        (logs the events of the stored images that the event log is missing)
+#     python imagemetadata.py show <file>    (prints the metadata embedded in the image file)
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["rebuild"]:
+        import project  # pylint: disable=import-outside-toplevel
+
+        print(
+            f"{rebuild_event_log(project.db(), project.image_store())} event(s) logged"
+        )
+        project.db().close()
+    elif sys.argv[1:2] == ["show"] and len(sys.argv) > 2:
+        print(json.dumps(ImageMetadata.read(sys.argv[2]), indent=2))
+    else:
+        sys.exit(
+            "Usage: python imagemetadata.py rebuild | python imagemetadata.py show <file>"
+        )
@@ -0,0 +1,240 @@
+import multiprocessing
+import os
+import threading
+import time
+
+from concurrent.futures import Future, ProcessPoolExecutor
+from io import BytesIO
+from multiprocessing.shared_memory import SharedMemory
+from typing import NamedTuple
+
+from imagederivatives import ImageDerivatives
+from imageencoder import EncodedImage, ImageEncoder
+from imagemetadata import ImageMetadata
+from imagestore import ImageStore
+from openai_image_dto import OpenAiImageDto
+from perceptualhash import PerceptualHash
+
+
+# Outcome of the post-processing of an image: the encoded image, its perceptual hash, its size (width, height), and the
+# filenames of its renditions keyed by width.
+class ProcessedImage(NamedTuple):
+    encoded_image: EncodedImage
+    perceptual_hash: str
+    size: tuple[int, int]
+    renditions: dict[int, str]
+
+
+# Post-processing of an image, as handed to a worker: the shared memory block (and size) of its original bytes, the
+# temporary files to write the encoded image and its renditions to, and the metadata to embed in the encoded image.
+class ProcessingTask(NamedTuple):
+    memory: str
+    size: int
+    encoder: ImageEncoder
+    filename: str
+    widths: tuple[int, ...]
+    quality: int
+    renditions: dict[int, str]
+    metadata: dict
+
+
+# Single Responsibility Principle (SRP): This class has the single responsibility of post-processing generated images (decode,
+# RGB convert, perceptual hash, encode and renditions) on a process pool, off the threads of the generations.
+# These stages are CPU bound, and (on the threads of concurrent generations) contend for the GIL, which serializes them on
+# a single core.  Each image is decoded once, by a worker, and everything that is derived from it is produced in the same
+# pass.  The original image bytes are handed to the worker through a shared memory block, rather than pickled through the
+# pool's pipe, and the worker writes the encoded image and its renditions to temporary files, which are committed to the
+# image store once the worker has succeeded, so only metadata travels back.
+# Workers are started upon first use, and are spawned (rather than forked), as the application is multithreaded by then.
+class ImageProcessingPool:
+    def __init__(
+        self,
+        store: ImageStore,
+        encoder: ImageEncoder,
+        derivatives: ImageDerivatives,
+        max_workers: int = None,
+    ):
+        # When None, the shared image store of the application, which is only opened upon first use.
+        self._store = store
+        self.encoder = encoder
+        self.derivatives = derivatives
+        self.max_workers = max_workers or os.cpu_count()
+        self._lock = threading.Lock()
+        self._executor = None
+
+    @property
+    def store(self) -> ImageStore:
+        if self._store is None:
+            self._store = ImageStore.shared()
+        return self._store
+
+    @property
+    def executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    self.max_workers, mp_context=multiprocessing.get_context("spawn")
+                )
+            return self._executor
+
+    # Starts the post-processing of the image, whose outcome is also made available to the image itself (see
+    # OpenAiImageDto.processing), e.g. so that its perceptual hash is not computed twice.
+    def submit(self, image: OpenAiImageDto) -> Future:
+        size = image.original_size
+        memory = SharedMemory(create=True, size=max(1, size))
+        filenames = []
+        try:
+            image.write_to(_MemoryWriter(memory.buf))
+            task = ProcessingTask(
+                memory.name,
+                size,
+                self.encoder,
+                self.store.temporary(image.id, self.encoder.extension),
+                self.derivatives.widths,
+                self.derivatives.quality,
+                {
+                    width: self.store.temporary(
+                        image.id,
+                        ImageDerivatives.EXTENSION,
+                        ImageDerivatives.variant(width),
+                    )
+                    for width in self.derivatives.widths
+                },
+                image.metadata,
+            )
+            filenames = [task.filename, *task.renditions.values()]
+            pending = self.executor.submit(_process, task)
+        except BaseException:
+            self._release(memory)
+            self._remove(filenames)
+            raise
+
+        future = Future()
+        future.set_running_or_notify_cancel()
+        pending.add_done_callback(
+            lambda done: self._complete(done, future, image, task, memory)
+        )
+        image.processing = future
+        return future
+
+    # Post-processes the image (unless it already is being post-processed), and waits for its outcome.
+    def process(self, image: OpenAiImageDto) -> ProcessedImage:
+        future = image.processing or self.submit(image)
+        return future.result()
+
+    def shutdown(self, wait: bool = True) -> None:
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=wait, cancel_futures=True)
+                self._executor = None
+
+    # Commits the files written by the worker to the image store (discarding the renditions it did not need).
+    def _complete(
+        self,
+        done: Future,
+        future: Future,
+        image: OpenAiImageDto,
+        task: ProcessingTask,
+        memory: SharedMemory,
+    ) -> None:
+        self._release(memory)
+        try:
+            processed = done.result()
+            encoded_image = processed.encoded_image._replace(
+                filename=self.store.commit(
+                    task.filename, image.id, self.encoder.extension
+                )
+            )
+            renditions = {
+                width: self.store.commit(
+                    task.renditions[width],
+                    image.id,
+                    ImageDerivatives.EXTENSION,
+                    ImageDerivatives.variant(width),
+                )
+                for width in processed.renditions
+            }
+        # The failure is the outcome of the post-processing.
+        # pylint: disable=broad-exception-caught
+        except BaseException as e:
+            outcome = e
+        else:
+            outcome = processed._replace(
+                encoded_image=encoded_image, renditions=renditions
+            )
+        # Committed files were renamed, hence only the files that were not committed remain.  They are removed before the
+        # outcome is set, so that waiters never observe them.
+        self._remove([task.filename, *task.renditions.values()])
+        if isinstance(outcome, BaseException):
+            future.set_exception(outcome)
+        else:
+            future.set_result(outcome)
+
+    @staticmethod
+    def _release(memory: SharedMemory) -> None:
+        memory.close()
+        memory.unlink()
+
+    @staticmethod
+    def _remove(filenames: list[str]) -> None:
+        for filename in filenames:
+            if os.path.exists(filename):
+                os.remove(filename)
+
+
+# File-like writer of a shared memory block (i.e. the target of OpenAiImageDto.write_to).
+class _MemoryWriter:
+    def __init__(self, buffer: memoryview):
+        self._buffer = buffer
+        self._position = 0
+
+    def write(self, data: bytes) -> int:
+        end = self._position + len(data)
+        self._buffer[self._position : end] = data
+        self._position = end
+        return len(data)
+
+
+# Process pool worker: decodes the original image (from shared memory) once, and then produces its perceptual hash, its
+# encoding and its renditions, returning their metadata (and the stage timings of the encoding).
+def _process(task: ProcessingTask) -> ProcessedImage:
+    from PIL import Image  # pylint: disable=import-outside-toplevel
+
+    memory = SharedMemory(name=task.memory)
+    try:
+        original = bytes(memory.buf[: task.size])
+    finally:
+        memory.close()
+
+    timings = {}
+    start = time.perf_counter()
+    with Image.open(BytesIO(original)) as image:
+        image.load()
+        timings[ImageEncoder.Stage.DECODE] = time.perf_counter() - start
+        start = time.perf_counter()
+        pixels = image.convert("RGB")
+        timings[ImageEncoder.Stage.CONVERT] = time.perf_counter() - start
+
+    if task.encoder.mode == ImageEncoder.Mode.PASSTHROUGH:
+        start = time.perf_counter()
+        with open(task.filename, "w+b") as file:
+            file.write(original)
+            if task.metadata:
+                ImageMetadata.append_to_png(file, task.metadata)
+        timings[ImageEncoder.Stage.WRITE] = time.perf_counter() - start
+        encoded_image = EncodedImage(
+            task.filename, os.path.getsize(task.filename), timings
+        )
+    else:
+        encoded_image = task.encoder.encode_pixels(
+            pixels, task.filename, timings, task.metadata
+        )
+
+    derivatives = ImageDerivatives(None, task.widths, task.quality)
+    renditions = {}
+    for width, rendition in derivatives.downscale(pixels):
+        derivatives.save(rendition, task.renditions[width])
+        renditions[width] = task.renditions[width]
+    return ProcessedImage(
+        encoded_image, PerceptualHash.of(pixels), pixels.size, renditions
+    )
@@ -0,0 +1,117 @@
+import base64
+import hashlib
+import json
+
+from typing import BinaryIO
+
+
+# Single Responsibility Principle (SRP): This class has the single responsibility of reading an image generation response
+# as it is received, without ever holding its image payload in memory.
+# The response is fed a chunk at a time.  The base64 text of the (first) image payload is decoded a chunk at a time, straight
+# into the payload file, while the digest of the text (see OpenAiImageDto.id) is computed along the way.  The rest of the
+# response (i.e. "created", "revised_prompt"...) is small, hence it is retained, and parsed once the response is complete,
+# with the payload replaced by null.  Memory is thus bounded by the chunk size, regardless of the size of the image.
+class ImageResponseStream:
+    CHUNK_SIZE = 64 * 1024
+    PAYLOAD_KEY = b"b64_json"
+    WHITESPACE = frozenset(b" \t\r\n")
+    QUOTE = ord('"')
+    BACKSLASH = ord("\\")
+    COLON = ord(":")
+
+    def __init__(self, payload: BinaryIO):
+        self._payload = payload
+        self._digest = hashlib.sha256()
+        self._retained = bytearray()
+        self._in_string = False
+        self._escaped = False
+        self._string_start = 0
+        self._last_string = None
+        # Key whose value is expected next (i.e. since its colon, only whitespace was received).
+        self._key = None
+        self._in_payload = False
+        self._payloads = 0
+        # Base64 text received but not yet decoded (i.e. less than a 4 character quantum, or a split escape sequence).
+        self._carry = b""
+        self.size = 0
+
+    # Hexadecimal digest (SHA-256) of the base64 text of the image payload.
+    @property
+    def digest(self) -> str:
+        return self._digest.hexdigest()
+
+    def feed(self, chunk: bytes) -> None:
+        position = 0
+        while position < len(chunk):
+            if self._in_payload:
+                position = self._feed_payload(chunk, position)
+            else:
+                position = self._feed_text(chunk, position)
+
+    # The response, without its image payload (which was written to the payload file).
+    def close(self) -> dict:
+        if self._in_payload or self._in_string:
+            raise ValueError("The image generation response is truncated.")
+        if not self._payloads:
+            raise ValueError("The image generation response holds no image payload.")
+        return json.loads(self._retained)
+
+    # Retains the text up to the opening quote of an image payload, keeping track of the JSON strings along the way (the
+    # payload key is only recognized outside of a string, and followed by a colon).
+    def _feed_text(self, chunk: bytes, position: int) -> int:
+        retained = self._retained
+        for index in range(position, len(chunk)):
+            byte = chunk[index]
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif byte == self.BACKSLASH:
+                    self._escaped = True
+                elif byte == self.QUOTE:
+                    self._in_string = False
+                    self._last_string = bytes(retained[self._string_start :])
+                retained.append(byte)
+                continue
+            if byte == self.QUOTE:
+                if self._key == self.PAYLOAD_KEY:
+                    retained += b"null"
+                    self._key = None
+                    self._in_payload = True
+                    return index + 1
+                self._in_string = True
+                self._string_start = len(retained) + 1
+            elif byte == self.COLON:
+                self._key = self._last_string
+            elif byte not in self.WHITESPACE:
+                self._key = None
+            retained.append(byte)
+        return len(chunk)
+
+    # Decodes the base64 text up to the closing quote of the image payload.  Base64 holds neither quotes nor backslashes,
+    # other than its slashes, which a JSON encoder may escape.
+    def _feed_payload(self, chunk: bytes, position: int) -> int:
+        end = chunk.find(self.QUOTE, position)
+        text = self._carry + chunk[position : len(chunk) if end < 0 else end]
+        text = text.replace(b"\\/", b"/")
+        if end < 0:
+            usable = len(text) - text.endswith(b"\\")
+            usable -= usable % 4
+        else:
+            usable = len(text)
+        self._carry = text[usable:]
+        if usable:
+            self._decode(text[:usable])
+        if end < 0:
+            return len(chunk)
+        self._in_payload = False
+        self._payloads += 1
+        return end + 1
+
+    # Only the first image payload is kept (DALL-E 3 generates a single image per request).
+    def _decode(self, text: bytes) -> None:
+        if self._payloads:
+            return
+        self._digest.update(text)
+        bitmap = base64.b64decode(text, validate=True)
+        self._payload.write(bitmap)
+        self.size += len(bitmap)
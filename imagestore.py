@@ -0,0 +1,217 @@
+import contextlib
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+from typing import Iterable, Iterator
+
+
+# Single Responsibility Principle (SRP): This class has the single responsibility of storing image files on disk.
+# Each image is stored under its unique image identifier (rather than its "created" second, which concurrent generations
+# can share), in a hashed and sharded directory layout (e.g. img/3f/a2/<image id>.jpg) that keeps every directory small.
+# Files are written to a temporary file that is then renamed, so a partially written image is never observed.  Variants
+# of an image (e.g. its renditions) are stored alongside it.  The manifest (an append-only JSON lines file), maps image
+# identifiers and "created" values to their files, and is replayed into memory upon opening the store.  Once its stale
+# records (i.e. of deleted or replaced files) outnumber both the compaction threshold and the current records, the manifest
+# is compacted, so that it does not grow with the history of the store.
+class ImageStore:
+    MANIFEST = "manifest.jsonl"
+    COMPACTION_THRESHOLD = 1000
+
+    class Entry:
+        ID = "id"
+        CREATED = "created"
+        VARIANT = "variant"
+        PATH = "path"
+        DELETED = "deleted"
+
+    # Options (constructor arguments) of the shared image store, which are to be set before its first use.
+    shared_options = dict[str, object]()
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    # The image store of the application, shared by all of its components.  It is only opened (i.e. its manifest replayed)
+    # upon first use, rather than upon import, so that the startup time of the application (and of the workers of the image
+    # processing pool, which re-import it) does not grow with the number of stored images.
+    @classmethod
+    def shared(cls) -> "ImageStore":
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls(**cls.shared_options)
+            return cls._shared
+
+    def __init__(
+        self,
+        root: str,
+        manifest: str = MANIFEST,
+        compaction_threshold: int = COMPACTION_THRESHOLD,
+    ):
+        self.root = root
+        self.compaction_threshold = compaction_threshold
+        self._manifest = os.path.join(root, manifest)
+        self._lock = threading.RLock()
+        # Image identifier to its files (keyed by variant), and "created" to the identifiers of its images.
+        self._images = dict[str, dict[str, str]]()
+        self._created = dict[int, list[str]]()
+        # Number of manifest records that no longer describe a stored file.
+        self._stale = 0
+        self._load()
+        self._compact_if_stale()
+
+    @staticmethod
+    def created_of(image_id: str) -> int:
+        return int(str(image_id).split("-", 1)[0])
+
+    def path(self, image_id: str, extension: str, variant: str = "") -> str:
+        shard = hashlib.sha256(image_id.encode("utf-8")).hexdigest()
+        return os.path.join(
+            self.root, shard[:2], shard[2:4], f"{image_id}{variant}{extension}"
+        )
+
+    # URL of the stored file, relative to the web root (i.e. the parent of the store root).
+    def url(self, path: str) -> str:
+        relative = os.path.relpath(path, os.path.dirname(self.root))
+        return "/" + relative.replace(os.sep, "/")
+
+    # Yields a temporary filename to write the file to, which is atomically renamed to its final path (and recorded in the
+    # manifest) once the write has succeeded.
+    @contextlib.contextmanager
+    def writing(
+        self, image_id: str, extension: str, variant: str = ""
+    ) -> Iterator[str]:
+        temporary = self.temporary(image_id, extension, variant)
+        try:
+            yield temporary
+            self.commit(temporary, image_id, extension, variant)
+        except BaseException:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+            raise
+
+    # Temporary filename (alongside the final path of the file) to write a file of the image to, before it is committed.
+    def temporary(self, image_id: str, extension: str, variant: str = "") -> str:
+        path = self.path(image_id, extension, variant)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        handle, temporary = tempfile.mkstemp(
+            dir=os.path.dirname(path), suffix=".tmp" + extension
+        )
+        os.close(handle)
+        return temporary
+
+    # Atomically renames the written temporary file to its final path, and records it in the manifest.
+    def commit(
+        self, temporary: str, image_id: str, extension: str, variant: str = ""
+    ) -> str:
+        path = self.path(image_id, extension, variant)
+        os.replace(temporary, path)
+        self._record(
+            {
+                self.Entry.ID: image_id,
+                self.Entry.CREATED: self.created_of(image_id),
+                self.Entry.VARIANT: variant,
+                self.Entry.PATH: os.path.relpath(path, self.root),
+            }
+        )
+        return path
+
+    # Identifiers of the stored images (as of the call).
+    def __iter__(self) -> Iterator[str]:
+        with self._lock:
+            return iter(list(self._images))
+
+    # Files of the image keyed by variant ("" being the image itself), or None when the image is not stored.
+    def get(self, image_id: str) -> dict[str, str]:
+        with self._lock:
+            files = self._images.get(image_id)
+            if files is None:
+                return None
+            return {
+                variant: os.path.join(self.root, path)
+                for variant, path in files.items()
+            }
+
+    def find_by_created(self, created: int) -> list[str]:
+        with self._lock:
+            return list(self._created.get(created, []))
+
+    def exists(self, image_ids: Iterable[str]) -> dict[str, bool]:
+        result = {}
+        for image_id in image_ids:
+            files = self.get(image_id)
+            result[image_id] = bool(files) and all(map(os.path.exists, files.values()))
+        return result
+
+    # Deletes the images (along with all of their variants), returning the number of images deleted.
+    def delete(self, image_ids: Iterable[str]) -> int:
+        deleted = 0
+        for image_id in image_ids:
+            files = self.get(image_id)
+            if files is None:
+                continue
+            for path in files.values():
+                if os.path.exists(path):
+                    os.remove(path)
+            self._record({self.Entry.ID: image_id, self.Entry.DELETED: True})
+            deleted += 1
+        return deleted
+
+    # Rewrites the manifest with only the files that are currently stored (dropping the deleted and replaced records).
+    def compact(self) -> None:
+        with self._lock:
+            handle, temporary = tempfile.mkstemp(dir=self.root, suffix=".tmp")
+            with os.fdopen(handle, "w", encoding="utf-8") as file:
+                for image_id, files in self._images.items():
+                    for variant, path in files.items():
+                        record = {
+                            self.Entry.ID: image_id,
+                            self.Entry.CREATED: self.created_of(image_id),
+                            self.Entry.VARIANT: variant,
+                            self.Entry.PATH: path,
+                        }
+                        file.write(json.dumps(record) + "\n")
+            os.replace(temporary, self._manifest)
+            self._stale = 0
+
+    def _record(self, record: dict) -> None:
+        with self._lock:
+            os.makedirs(self.root, exist_ok=True)
+            with open(self._manifest, "a", encoding="utf-8") as file:
+                file.write(json.dumps(record) + "\n")
+            self._apply(record)
+            self._compact_if_stale()
+
+    def _compact_if_stale(self) -> None:
+        with self._lock:
+            if self._stale < self.compaction_threshold:
+                return
+            if self._stale >= sum(map(len, self._images.values())):
+                self.compact()
+
+    def _apply(self, record: dict) -> None:
+        image_id = record[self.Entry.ID]
+        if record.get(self.Entry.DELETED):
+            files = self._images.pop(image_id, None)
+            # The deletion record is stale, along with the records of the files it deletes.
+            self._stale += 1 + len(files or ())
+            if files is not None:
+                identifiers = self._created.get(self.created_of(image_id), [])
+                if image_id in identifiers:
+                    identifiers.remove(image_id)
+            return
+        if image_id not in self._images:
+            self._images[image_id] = {}
+            self._created.setdefault(record[self.Entry.CREATED], []).append(image_id)
+        if record[self.Entry.VARIANT] in self._images[image_id]:
+            self._stale += 1
+        self._images[image_id][record[self.Entry.VARIANT]] = record[self.Entry.PATH]
+
+    def _load(self) -> None:
+        if not os.path.exists(self._manifest):
+            return
+        with open(self._manifest, encoding="utf-8") as file:
+            for line in file:
+                line = line.strip()
+                if line:
+                    self._apply(json.loads(line))
@@ -0,0 +1,154 @@
+import threading
+import time
+import uuid
+
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable
+
+
+class JobCancelledError(Exception):
+    pass
+
+
+# A unit of work of the job queue.  The work function receives its job, through which it reports the stage it is in, and
+# checks (between stages) whether it has been cancelled.  A stage entered past the point of no return (e.g. once a paid
+# request has been sent) is not cancellable, so that its work is never discarded half-done.
+class Job:
+    class Status:
+        QUEUED = "queued"
+        RUNNING = "running"
+        COMPLETED = "completed"
+        FAILED = "failed"
+        CANCELLED = "cancelled"
+
+    FINISHED = frozenset({Status.COMPLETED, Status.FAILED, Status.CANCELLED})
+
+    def __init__(self, job_id: str):
+        self.id = job_id
+        self.status = self.Status.QUEUED
+        self.stage = None
+        self.result = None
+        self.error = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.future: Future = None
+        self._cancel_requested = threading.Event()
+
+    @property
+    def done(self) -> bool:
+        return self.status in self.FINISHED
+
+    @property
+    def cancel_requested(self) -> bool:
+        return self._cancel_requested.is_set()
+
+    def request_cancel(self) -> None:
+        self._cancel_requested.set()
+
+    def set_stage(self, stage: str, cancellable: bool = True) -> None:
+        if cancellable:
+            self.raise_if_cancelled()
+        self.stage = stage
+
+    def raise_if_cancelled(self) -> None:
+        if self._cancel_requested.is_set():
+            raise JobCancelledError(f"Job {self.id} was cancelled.")
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "status": self.status,
+            "stage": self.stage,
+            "result": self.result,
+            "error": None if self.error is None else str(self.error),
+            "submitted": self.submitted,
+            "started": self.started,
+            "finished": self.finished,
+        }
+
+
+# Single Responsibility Principle (SRP): This class has the single responsibility of running jobs on a bounded worker pool.
+# Each submitted job is immediately given an identifier, through which its status (and stage) can be polled and through which
+# it can be cancelled.  A queued job is cancelled outright, while a running job is cancelled at its next (cancellable) stage
+# boundary.  Only the most recent finished jobs are retained, so that the job history does not grow without bound.
+class JobQueue:
+    MAX_WORKERS = 4
+    MAX_FINISHED_JOBS = 100
+
+    def __init__(
+        self,
+        max_workers: int = MAX_WORKERS,
+        max_finished_jobs: int = MAX_FINISHED_JOBS,
+        thread_name_prefix: str = "Job",
+    ):
+        self.max_finished_jobs = max_finished_jobs
+        self._executor = ThreadPoolExecutor(max_workers, thread_name_prefix)
+        self._lock = threading.Lock()
+        self._jobs = OrderedDict[str, Job]()
+
+    def submit(self, work: Callable[..., object], *args, **kwargs) -> Job:
+        job = Job(uuid.uuid4().hex)
+        # The job is only made visible (i.e. to status polling and cancellation) once it has its future.
+        job.future = self._executor.submit(self._run, job, work, *args, **kwargs)
+        with self._lock:
+            self._jobs[job.id] = job
+            self._prune()
+        return job
+
+    def get(self, job_id: str) -> Job:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def status(self, job_id: str) -> dict:
+        job = self.get(job_id)
+        return None if job is None else job.to_dict()
+
+    def cancel(self, job_id: str) -> bool:
+        job = self.get(job_id)
+        if job is None or job.done:
+            return False
+        job.request_cancel()
+        if job.future.cancel():
+            self._finish(job, Job.Status.CANCELLED)
+        return True
+
+    # Number of jobs that are queued or running.
+    def pending(self) -> int:
+        with self._lock:
+            return sum(1 for job in self._jobs.values() if not job.done)
+
+    # Stops accepting jobs, optionally cancelling the jobs that are still pending (queued or running).
+    def shutdown(self, wait: bool = True, cancel_pending: bool = False) -> None:
+        if cancel_pending:
+            with self._lock:
+                pending = [job.id for job in self._jobs.values() if not job.done]
+            for job_id in pending:
+                self.cancel(job_id)
+        self._executor.shutdown(wait=wait)
+
+    def _run(self, job: Job, work: Callable[..., object], *args, **kwargs) -> object:
+        job.status = Job.Status.RUNNING
+        job.started = time.time()
+        # A job's failure is confined to the job (and reported through its status).
+        # pylint: disable=broad-exception-caught
+        try:
+            job.raise_if_cancelled()
+            job.result = work(job, *args, **kwargs)
+            self._finish(job, Job.Status.COMPLETED)
+        except JobCancelledError:
+            self._finish(job, Job.Status.CANCELLED)
+        except Exception as e:
+            job.error = e
+            self._finish(job, Job.Status.FAILED)
+        return job.result
+
+    def _finish(self, job: Job, status: str) -> None:
+        job.finished = time.time()
+        job.status = status
+
+    def _prune(self) -> None:
+        finished = [job.id for job in self._jobs.values() if job.done]
+        for job_id in finished[: max(0, len(finished) - self.max_finished_jobs)]:
+            del self._jobs[job_id]
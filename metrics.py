@@ -0,0 +1,183 @@
+import bisect
+import contextlib
+import contextvars
+import json
+import logging
+import threading
+import time
+
+from typing import ContextManager
+
+
+# Single Responsibility Principle (SRP): This class has the single responsibility of measuring the image generation path.
+# The time spent in each stage (prompt build, network, base64 decode, PIL decode, RGB convert, encode, file write and
+# database write) is recorded in a histogram per stage, and events (e.g. cache hits, outcomes) in counters, which are
+# exported in the Prometheus text format.  The stages of a single request are also collected into a trace, which is
+# emitted as one structured (JSON) log line once the request completes.  When disabled, a stage costs a single attribute
+# check, as a shared no-op context manager is returned instead of a timer.
+class Metrics:
+    NAMESPACE = "imagegenie"
+    LOGGER = "imagegenie.metrics"
+    CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+    # Upper bounds (in seconds) of the histogram buckets, spanning sub-millisecond stages to multi-minute generations.
+    BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+    class Stage:
+        REQUEST = "request"  # The request as a whole.
+        PROMPT = "prompt"
+        CACHE = "cache"
+        RATE_LIMIT = "rate_limit"
+        NETWORK = "network"
+        PARSE = "parse"
+        B64_DECODE = "b64_decode"
+        PIL_DECODE = "pil_decode"
+        RGB_CONVERT = "rgb_convert"
+        PERCEPTUAL_HASH = "perceptual_hash"
+        ENCODE = "encode"
+        FILE_WRITE = "file_write"
+        DB_WRITE = "db_write"
+        DB_FLUSH = "db_flush"
+
+    class Counter:
+        REQUESTS = "requests_total"
+        CACHE_HITS = "cache_hits_total"
+        CACHE_MISSES = "cache_misses_total"
+        SINGLE_FLIGHT_CALLS = "single_flight_calls_total"
+        # Requests that waited for an identical request in flight, rather than making a call of their own.
+        SINGLE_FLIGHT_COALESCED = "single_flight_coalesced_total"
+
+    _DISABLED = contextlib.nullcontext()
+
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._histograms = dict[str, list]()  # Stage to [bucket counts, sum, count].
+        self._counters = dict[tuple[str, tuple], float]()
+        self._trace = contextvars.ContextVar[dict]("trace", default=None)
+        self._logger = logging.getLogger(self.LOGGER)
+
+    # Times the stage (of the current request, if any).
+    def stage(self, name: str) -> ContextManager:
+        if not self.enabled:
+            return self._DISABLED
+        return self._timer(name)
+
+    def observe(self, name: str, seconds: float) -> None:
+        if not self.enabled:
+            return
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = [[0] * len(self.BUCKETS), 0.0, 0]
+            index = bisect.bisect_left(self.BUCKETS, seconds)
+            if index < len(self.BUCKETS):
+                histogram[0][index] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+        trace = self._trace.get()
+        if trace is not None:
+            stages = trace["stages"]
+            stages[name] = stages.get(name, 0.0) + seconds
+
+    def increment(self, name: str, amount: float = 1, **labels: str) -> None:
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    # Collects the stages of a request, and logs them as a single structured line once the request completes (along with
+    # its fields and outcome).  A nested request joins the enclosing request, rather than logging a line of its own.
+    @contextlib.contextmanager
+    def request(self, **fields: object):
+        if not self.enabled or self._trace.get() is not None:
+            yield
+            return
+        trace = {"stages": {}}
+        token = self._trace.set(trace)
+        start = time.perf_counter()
+        outcome = "success"
+        try:
+            yield
+        except BaseException:
+            outcome = "failure"
+            raise
+        finally:
+            self._trace.reset(token)
+            self.increment(self.Counter.REQUESTS, outcome=outcome)
+            self.observe(self.Stage.REQUEST, time.perf_counter() - start)
+            record = {
+                **fields,
+                "outcome": outcome,
+                "duration": round(time.perf_counter() - start, 6),
+                "stages": {k: round(v, 6) for k, v in trace["stages"].items()},
+            }
+            self._logger.info(json.dumps(record, default=str))
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "histograms": {
+                    name: {"sum": total, "count": count}
+                    for name, (_, total, count) in self._histograms.items()
+                },
+                "counters": {
+                    name + self._labels(labels): value
+                    for (name, labels), value in self._counters.items()
+                },
+            }
+
+    def reset(self) -> None:
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+
+    def export_prometheus(self) -> str:
+        histogram_name = f"{self.NAMESPACE}_stage_seconds"
+        lines = [
+            f"# HELP {histogram_name} Time spent in each stage of the image generation path.",
+            f"# TYPE {histogram_name} histogram",
+        ]
+        with self._lock:
+            for stage, (buckets, total, count) in sorted(self._histograms.items()):
+                cumulative = 0
+                for bound, bucket in zip(self.BUCKETS, buckets):
+                    cumulative += bucket
+                    labels = self._labels((("stage", stage), ("le", str(bound))))
+                    lines.append(f"{histogram_name}_bucket{labels} {cumulative}")
+                labels = self._labels((("stage", stage), ("le", "+Inf")))
+                lines.append(f"{histogram_name}_bucket{labels} {count}")
+                labels = self._labels((("stage", stage),))
+                lines.append(f"{histogram_name}_sum{labels} {total}")
+                lines.append(f"{histogram_name}_count{labels} {count}")
+
+            for name in sorted({name for name, _ in self._counters}):
+                lines.append(f"# TYPE {self.NAMESPACE}_{name} counter")
+                for (counter, labels), value in sorted(self._counters.items()):
+                    if counter == name:
+                        lines.append(
+                            f"{self.NAMESPACE}_{name}{self._labels(labels)} {value}"
+                        )
+        return "\n".join(lines) + "\n"
+
+    @contextlib.contextmanager
+    def _timer(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    @classmethod
+    def _labels(cls, labels: tuple) -> str:
+        if not labels:
+            return ""
+        return "{" + ",".join(f'{k}="{cls._escape(v)}"' for k, v in labels) + "}"
+
+    @staticmethod
+    def _escape(value: object) -> str:
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+# The metrics of the application, which are shared by every component of the image generation path.
+metrics = Metrics()
@@ -0,0 +1,243 @@
+import base64
+import json
+import random
+import struct
+import sys
+import threading
+import time
+import zlib
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from PIL import Image
+
+from httpclient import HttpClient
+from imagegeneration import ImageGeneration
+from ratelimitscheduler import RateLimitScheduler
+
+
+# Builds a PNG image that blends noise with gradients, which compresses to a payload of a size comparable to that of a
+# real DALL-E image.
+def build_png(size: tuple[int, int]) -> bytes:
+    image = Image.merge(
+        "RGB",
+        [
+            Image.effect_noise(size, 24),
+            Image.linear_gradient("L").resize(size),
+            Image.radial_gradient("L").resize(size),
+        ],
+    )
+    buffer = BytesIO()
+    image.save(buffer, "PNG", compress_level=1)
+    return buffer.getvalue()
+
+
+# Single Responsibility Principle (SRP): This class has the single responsibility of standing in for the OpenAI image
+# generation endpoint (/v1/images/generations), so the image generation pipeline can be exercised and measured locally,
+# without an OpenAI key.
+# Replies carry a realistic base64 PNG payload of the requested size (each payload is made unique with a text chunk, as
+# are real images), after a configurable latency.  Server errors (500), throttled replies (429, with Retry-After) and
+# connections dropped once the request was read (i.e. without a reply) are injected at configurable rates, and an optional requests per minute limit is enforced and reported through the
+# x-ratelimit-* headers, as the API does.
+class MockImageServer:
+    PATH = "/v1/images/generations"
+    RETRY_AFTER = 1
+
+    def __init__(
+        self,
+        latency: float = 0.0,
+        latency_jitter: float = 0.0,
+        error_rate: float = 0.0,
+        throttle_rate: float = 0.0,
+        disconnect_rate: float = 0.0,
+        requests_per_minute: int = None,
+        size: tuple[int, int] = None,
+        port: int = 0,
+        seed: int = None,
+    ):
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.disconnect_rate = disconnect_rate
+        self.requests_per_minute = requests_per_minute
+        self.size = size  # Overrides the requested size (e.g. to keep tests small).
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._payloads = dict[tuple[int, int], bytes]()
+        self._counts = {
+            "requests": 0,
+            "served": 0,
+            "errors": 0,
+            "throttled": 0,
+            "disconnected": 0,
+        }
+        self._tokens = requests_per_minute
+        self._refilled = time.monotonic()
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}{self.PATH}"
+
+    def start(self) -> "MockImageServer":
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, name="MockImageServer", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    # Serves on the calling thread, until stopped.
+    def serve_forever(self) -> None:
+        self._server.serve_forever()
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self) -> "MockImageServer":
+        return self.start()
+
+    def __exit__(self, exception_type, exception, traceback) -> None:
+        self.stop()
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return dict(self._counts)
+
+    # The status code, headers and body of the reply to an image generation request.  The status code is None when the
+    # connection is to be dropped instead.
+    def reply(self, body: dict) -> tuple[int, dict[str, str], dict]:
+        with self._lock:
+            self._counts["requests"] += 1
+            delay = self.latency + self._random.uniform(0, self.latency_jitter)
+            outcome = self._random.random()
+            throttled, headers = self._take_rate_limit_token()
+        time.sleep(delay)
+
+        if throttled or outcome < self.throttle_rate:
+            return self._error(429, "Rate limit exceeded.", "throttled", headers)
+        if outcome < self.throttle_rate + self.error_rate:
+            return self._error(500, "The server had an error.", "errors", headers)
+        if outcome < self.throttle_rate + self.error_rate + self.disconnect_rate:
+            with self._lock:
+                self._counts["disconnected"] += 1
+            return None, headers, None
+
+        size = self.size or tuple(
+            map(int, body[ImageGeneration.OpenApi.IMAGE_SIZE].split("x"))
+        )
+        with self._lock:
+            self._counts["served"] += 1
+            serial = self._counts["served"]
+        response = {
+            ImageGeneration.OpenApi.IMAGE_TIMESTAMP: int(time.time()),
+            ImageGeneration.OpenApi.PAYLOAD_DATA: [
+                {
+                    ImageGeneration.OpenApi.PAYLOAD_B64_JSON: base64.b64encode(
+                        self._payload(size, serial)
+                    ).decode("ascii"),
+                    ImageGeneration.OpenApi.REVISED_PROMPT: body[
+                        ImageGeneration.OpenApi.PROMPT_TEXT
+                    ],
+                }
+            ],
+        }
+        return 200, headers, response
+
+    def _error(
+        self, status: int, message: str, count: str, headers: dict[str, str]
+    ) -> tuple[int, dict[str, str], dict]:
+        with self._lock:
+            self._counts[count] += 1
+        if status == 429:
+            headers[HttpClient.RETRY_AFTER] = str(self.RETRY_AFTER)
+        return status, headers, {"error": {"message": message}}
+
+    # Takes a token of the (per minute) rate limit, returning whether the request is throttled, and the rate limit headers
+    # of the reply.
+    def _take_rate_limit_token(self) -> tuple[bool, dict[str, str]]:
+        if self.requests_per_minute is None:
+            return False, {}
+        now = time.monotonic()
+        rate = self.requests_per_minute / 60.0
+        self._tokens = min(
+            self.requests_per_minute, self._tokens + (now - self._refilled) * rate
+        )
+        self._refilled = now
+        throttled = self._tokens < 1
+        if not throttled:
+            self._tokens -= 1
+        reset = (self.requests_per_minute - self._tokens) / rate
+        return throttled, {
+            RateLimitScheduler.Header.LIMIT_REQUESTS: str(self.requests_per_minute),
+            RateLimitScheduler.Header.REMAINING_REQUESTS: str(int(self._tokens)),
+            RateLimitScheduler.Header.RESET_REQUESTS: f"{reset:.3f}s",
+        }
+
+    # The PNG image of the size, made unique by a text chunk (inserted after the IHDR chunk) holding the serial number.
+    def _payload(self, size: tuple[int, int], serial: int) -> bytes:
+        with self._lock:
+            if size not in self._payloads:
+                self._payloads[size] = build_png(size)
+            png = self._payloads[size]
+        data = b"Serial\x00" + str(serial).encode("ascii")
+        chunk = (
+            struct.pack(">I", len(data))
+            + b"tEXt"
+            + data
+            + struct.pack(">I", zlib.crc32(b"tEXt" + data))
+        )
+        header_end = 8 + 25  # PNG signature, followed by the IHDR chunk.
+        return png[:header_end] + chunk + png[header_end:]
+
+    def _handler(self) -> type:
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # Keep-alive, as the API.
+
+            def do_POST(self):
+                if self.path != server.PATH:
+                    self._send(404, {}, {"error": {"message": "Not found."}})
+                    return
+                length = int(self.headers.get(HttpClient.CONTENT_LENGTH, 0))
+                body = json.loads(self.rfile.read(length))
+                status, headers, reply = server.reply(body)
+                if status is None:
+                    self.close_connection = True
+                    return
+                self._send(status, headers, reply)
+
+            def _send(self, status: int, headers: dict[str, str], body: dict):
+                content = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header(HttpClient.CONTENT_TYPE, HttpClient.MediaType.JSON)
+                self.send_header(HttpClient.CONTENT_LENGTH, str(len(content)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, format, *args):
+                pass  # Quiet, as the request volume of a benchmark would flood the console.
+
+        return Handler
+
+
+# Stand-alone server, e.g. to point the application at (ImageGeneration url):
+# python mockimageserver.py [port] [latency] [error rate] [throttle rate]
+# By default, a free port is bound (rather than e.g. 8000, which is the application's own port), and its URL is printed.
+if __name__ == "__main__":
+    arguments = sys.argv[1:]
+    mock_server = MockImageServer(
+        port=int(arguments[0]) if len(arguments) > 0 else 0,
+        latency=float(arguments[1]) if len(arguments) > 1 else 0.0,
+        error_rate=float(arguments[2]) if len(arguments) > 2 else 0.0,
+        throttle_rate=float(arguments[3]) if len(arguments) > 3 else 0.0,
+    )
+    print(f"Serving {mock_server.url}")
+    mock_server.serve_forever()
@@ -1,49 +1,162 @@
 import base64
+import hashlib
+import os
+import shutil
+import threading
 
+from concurrent.futures import Future
 from io import BytesIO
-from PIL import Image
+from typing import BinaryIO
 
-
-import imagegeneration as ig
+from metrics import Metrics, metrics
+from perceptualhash import PerceptualHash
 
 
+# The image payload is decoded lazily: the base64 text is only decoded to its bitmap (and then released) upon first access
+# of the bitmap, and the bitmap is only decoded/converted by PIL upon first access of the image.  Persisting the original
+# image via save_original() never materializes a PIL image at all, which keeps the memory of an in-flight generation
+# close to a single copy of the payload.
+# A streamed response (see ImageResponseStream) arrives with its payload already decoded to a (temporary) payload file,
+# which is then copied to disk, and decoded by PIL, without ever being held in memory.
+# The image identifier combines the "created" timestamp with a digest of the payload, so it is unique even across images
+# created within the same second, while an identical (e.g. cached) response always yields the same identifier.
 class OpenAiImageDto:
+    # Size of the base64 text chunks decoded at a time when streaming (must be a multiple of 4).
+    B64_CHUNK_SIZE = 64 * 1024
+    ID_DIGEST_LENGTH = 16
+
+    def __init__(
+        self, response: dict, payload_file: BinaryIO = None, digest: str = None
+    ):
+        # Imported here rather than at the top, as the image generation module imports this module (i.e. so that either
+        # module can be imported first).
+        # pylint: disable=import-outside-toplevel
+        from imagegeneration import ImageGeneration
+
+        image_object = response[ImageGeneration.OpenApi.PAYLOAD_DATA][0]
+        self._created = response[ImageGeneration.OpenApi.IMAGE_TIMESTAMP]
+        self._b64_image = image_object[ImageGeneration.OpenApi.PAYLOAD_B64_JSON]
+        self._bitmap = None
+        self._image = None
+        self._perceptual_hash = None
+        # Outcome (a future) of the post-processing of the image on an image processing pool (see ImageProcessingPool).
+        self.processing: Future = None
+        # Metadata of the image (i.e. its prompt, revised prompt and request configuration), which is embedded in the image
+        # file when it is written (see ImageMetadata).  Set by the image generation that requested the image.
+        self.metadata: dict = None
+        self._revised_prompt = image_object[ImageGeneration.OpenApi.REVISED_PROMPT]
+        self._payload_file = payload_file
+        if payload_file is None:
+            digest = hashlib.sha256(self._b64_image.encode("ascii")).hexdigest()
+        self._id = f"{self._created}-{digest[: self.ID_DIGEST_LENGTH]}"
+        self._lock = threading.Lock()
 
-
-    def __init__(self, response: dict):
-        image_object = response[ig.ImageGeneration.OpenApi.PAYLOAD_DATA][0]
-        self._created = response[ig.ImageGeneration.OpenApi.IMAGE_TIMESTAMP]
-        self._b64_image = image_object[ig.ImageGeneration.OpenApi.PAYLOAD_B64_JSON]
-        self._bitmap = base64.b64decode(self._b64_image)
-        self._image = Image.open(BytesIO(self._bitmap))
-        self._image = self._image.convert("RGB")
-        self._revised_prompt = image_object[ig.ImageGeneration.OpenApi.REVISED_PROMPT]
-
+    @property
+    def id(self):
+        return self._id
 
     @property
     def created(self):
         return self._created
 
+    # Whether the payload was decoded to the payload file as it was received (i.e. no base64 decode is left to do).
+    @property
+    def streamed(self) -> bool:
+        return self._payload_file is not None
 
     @property
     def b64_json(self):
-        return self._b64_image
-
+        b64_image = self._b64_image
+        if b64_image is None:
+            # The base64 text was released once decoded; re-encoding is the rare path.
+            return base64.b64encode(self.bitmap).decode("ascii")
+        return b64_image
 
     @property
     def bitmap(self):
+        if self._bitmap is None:
+            with self._lock:
+                if self._bitmap is None and self._payload_file is not None:
+                    self._payload_file.seek(0)
+                    self._bitmap = self._payload_file.read()
+                elif self._bitmap is None:
+                    with metrics.stage(Metrics.Stage.B64_DECODE):
+                        self._bitmap = base64.b64decode(self._b64_image)
+                    self._b64_image = None
         return self._bitmap
 
-
     @property
     def revised_prompt(self):
         return self._revised_prompt
 
-
+    # Size (in bytes) of the original image, which is known without decoding it.
+    @property
+    def original_size(self) -> int:
+        with self._lock:
+            if self._bitmap is not None:
+                return len(self._bitmap)
+            if self._payload_file is not None:
+                return self._payload_file.seek(0, os.SEEK_END)
+            b64_image = self._b64_image
+        return len(b64_image) // 4 * 3 - b64_image[-2:].count("=")
+
+    # PIL is imported upon first decode, as it weighs on the startup time of the application and its tests.
     @property
     def image(self):
+        if self._image is None:
+            from PIL import Image  # pylint: disable=import-outside-toplevel
+
+            source = self._payload_file
+            if source is None:
+                source = BytesIO(self.bitmap)
+            with self._lock:
+                if self._image is None:
+                    source.seek(0)
+                    with Image.open(source) as image:
+                        with metrics.stage(Metrics.Stage.PIL_DECODE):
+                            image.load()
+                        with metrics.stage(Metrics.Stage.RGB_CONVERT):
+                            self._image = image.convert("RGB")
         return self._image
 
+    # Perceptual hash of the image (see PerceptualHash), by which near-identical images are found.  When the image is being
+    # post-processed on an image processing pool, the hash is that of its outcome (i.e. the image is not decoded here),
+    # unless the post-processing failed, in which case it is computed here (its failure is reported by the pool itself).
+    @property
+    def perceptual_hash(self) -> str:
+        if self._perceptual_hash is None and self.processing is not None:
+            # pylint: disable=broad-exception-caught
+            try:
+                self._perceptual_hash = self.processing.result().perceptual_hash
+            except Exception:
+                pass
+        if self._perceptual_hash is None:
+            image = self.image
+            with metrics.stage(Metrics.Stage.PERCEPTUAL_HASH):
+                self._perceptual_hash = PerceptualHash.of(image)
+        return self._perceptual_hash
 
     def save(self, filename: str) -> None:
-        self._image.save(filename)
+        self.image.save(filename)
+
+    # Persists the original (PNG) image bytes as-is, without a PIL decode/encode round trip.
+    def save_original(self, filename: str) -> None:
+        with open(filename, "wb") as file:
+            self.write_to(file)
+
+    # Writes the original image bytes to the file.  While the payload is still base64 text, it is decoded chunk by chunk
+    # straight into the file, and a payload file is copied chunk by chunk, so the complete bitmap is never held in memory.
+    def write_to(self, file: BinaryIO) -> None:
+        with self._lock:
+            if self._payload_file is not None:
+                self._payload_file.seek(0)
+                shutil.copyfileobj(self._payload_file, file, self.B64_CHUNK_SIZE)
+                return
+            b64_image = self._b64_image
+        if b64_image is None:
+            file.write(self.bitmap)
+            return
+        for offset in range(0, len(b64_image), self.B64_CHUNK_SIZE):
+            file.write(
+                base64.b64decode(b64_image[offset : offset + self.B64_CHUNK_SIZE])
+            )
@@ -0,0 +1,175 @@
+import sys
+
+from concurrent.futures import ProcessPoolExecutor
+from typing import TYPE_CHECKING, Callable
+
+if TYPE_CHECKING:
+    from PIL import Image
+
+    from imagegenerationdb import ImageGenerationDb
+
+
+# Single Responsibility Principle (SRP): This class has the single responsibility of telling visually near-identical
+# images apart from different ones.
+# The perceptual hash (a difference hash) reduces an image to a 9x8 grayscale thumbnail, and records whether each pixel is
+# brighter than its right neighbour: 64 bits that survive rescaling, recompression and small edits.  Near-identical images
+# have hashes within a small Hamming distance (number of differing bits) of each other.  Hashes are 16 hexadecimal digits,
+# which (unlike a 64-bit integer) survive a round trip through JSON and SQLite unchanged.
+class PerceptualHash:
+    WIDTH = 9
+    HEIGHT = 8
+    # Hamming distance within which two images are considered near-identical.
+    MAX_DISTANCE = 6
+
+    @classmethod
+    def of(cls, image: "Image.Image") -> str:
+        from PIL import Image  # pylint: disable=import-outside-toplevel
+
+        thumbnail = image.resize(
+            (cls.WIDTH, cls.HEIGHT), Image.Resampling.BOX, reducing_gap=2.0
+        ).convert("L")
+        pixels = thumbnail.tobytes()
+        bits = 0
+        for row in range(cls.HEIGHT):
+            offset = row * cls.WIDTH
+            for column in range(cls.WIDTH - 1):
+                left, right = pixels[offset + column], pixels[offset + column + 1]
+                bits = bits << 1 | (left > right)
+        return f"{bits:016x}"
+
+    # The image is decoded at a reduced scale where the format supports it (e.g. JPEG), which is all the hash needs.
+    @classmethod
+    def of_file(cls, filename: str) -> str:
+        from PIL import Image  # pylint: disable=import-outside-toplevel
+
+        with Image.open(filename) as image:
+            image.draft("RGB", (cls.WIDTH * 8, cls.HEIGHT * 8))
+            return cls.of(image.convert("RGB"))
+
+    @staticmethod
+    def distance(first: str, second: str) -> int:
+        return (int(first, 16) ^ int(second, 16)).bit_count()
+
+
+# Single Responsibility Principle (SRP): This class has the single responsibility of finding the images whose perceptual
+# hash is within a Hamming distance of a given hash, without comparing it with every hash.
+# It is a multi-index hash: each hash is split into 8 chunks (of 8 bits), and each chunk is indexed in a table of its own.
+# By the pigeonhole principle, two hashes within distance k differ by at most k // 8 bits in at least one chunk, hence only
+# the hashes that share a chunk (within that many bits) with the searched hash are candidates, which are then verified.
+# Images of identical hashes share an entry.  The index is not thread-safe; its owner is expected to serialize access.
+class PerceptualHashIndex:
+    CHUNKS = 8
+    CHUNK_BITS = 8
+
+    def __init__(self):
+        # Hash to the payloads (e.g. events) of its images.
+        self._payloads = dict[int, list]()
+        # Per chunk, the chunk value to the hashes that have it.
+        self._tables = [dict[int, list[int]]() for _ in range(self.CHUNKS)]
+        # Radius to the chunk masks that flip at most that many bits.
+        self._masks = dict[int, list[int]]()
+        self._count = 0
+
+    def __len__(self) -> int:
+        return self._count
+
+    def add(self, perceptual_hash: str, payload: object) -> None:
+        value = int(perceptual_hash, 16)
+        payloads = self._payloads.get(value)
+        if payloads is None:
+            payloads = self._payloads[value] = []
+            for table, chunk in zip(self._tables, self._chunks(value)):
+                table.setdefault(chunk, []).append(value)
+        payloads.append(payload)
+        self._count += 1
+
+    def clear(self) -> None:
+        self._payloads.clear()
+        for table in self._tables:
+            table.clear()
+        self._count = 0
+
+    # Payloads whose hash is within the distance of the hash, nearest first, along with their distance.
+    def search(
+        self, perceptual_hash: str, max_distance: int = PerceptualHash.MAX_DISTANCE
+    ) -> list[tuple[int, object]]:
+        value = int(perceptual_hash, 16)
+        masks = self._chunk_masks(min(max_distance // self.CHUNKS, self.CHUNK_BITS))
+        candidates = set[int]()
+        for table, chunk in zip(self._tables, self._chunks(value)):
+            for mask in masks:
+                candidates.update(table.get(chunk ^ mask, ()))
+        matches = []
+        for candidate in candidates:
+            distance = (candidate ^ value).bit_count()
+            if distance <= max_distance:
+                matches.extend(
+                    (distance, payload) for payload in self._payloads[candidate]
+                )
+        matches.sort(key=lambda match: match[0])
+        return matches
+
+    def _chunks(self, value: int) -> list[int]:
+        chunk_mask = (1 << self.CHUNK_BITS) - 1
+        return [
+            (value >> (index * self.CHUNK_BITS)) & chunk_mask
+            for index in range(self.CHUNKS)
+        ]
+
+    def _chunk_masks(self, radius: int) -> list[int]:
+        masks = self._masks.get(radius)
+        if masks is None:
+            masks = self._masks[radius] = [
+                mask
+                for mask in range(1 << self.CHUNK_BITS)
+                if mask.bit_count() <= radius
+            ]
+        return masks
+
+
+# Computes the perceptual hash of every logged image that has none yet (i.e. images generated before perceptual hashes were
+# recorded), including the images of archived events, on a process pool, as decoding the images is CPU bound.  The file of
+# an event's image is located by the given function (None when the file no longer exists).  Returns the number of events
+# updated.
+def backfill(
+    db: "ImageGenerationDb",
+    locate: Callable[[dict], str],
+    max_workers: int = None,
+) -> int:
+    files = dict[str, str]()
+    for event in db.events():
+        if event.get(db.Entity.COLUMN_PERCEPTUAL_HASH):
+            continue
+        filename = locate(event)
+        if filename is not None:
+            files[db.image_key(event)] = filename
+
+    hashes = dict[str, str]()
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        results = executor.map(_hash_file, files.values(), chunksize=16)
+        for key, perceptual_hash in zip(files, results):
+            if perceptual_hash is not None:
+                hashes[key] = perceptual_hash
+    return db.set_perceptual_hashes(hashes)
+
+
+# Process pool worker: the perceptual hash of the file, or None if the file could not be decoded.
+def _hash_file(filename: str) -> str:
+    try:
+        return PerceptualHash.of_file(filename)
+    except (OSError, ValueError):
+        return None
+
+
+# Usage:
+#     python perceptualhash.py backfill [workers]   (hashes the images logged before perceptual hashes were recorded)
+if __name__ == "__main__":
+    if sys.argv[1:2] != ["backfill"]:
+        sys.exit("Usage: python perceptualhash.py backfill [workers]")
+
+    import project  # pylint: disable=import-outside-toplevel
+
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else None
+    updated = backfill(project.db(), project.find_image_file, workers)
+    print(f"{updated} event(s) updated")
+    project.db().close()
@@ -36,19 +36,122 @@
 
 from imagegeneration import ImageGeneration
 from imagegenerationdb import ImageGenerationDb
+from imagederivatives import ImageDerivatives
+from imageencoder import EncodedImage, ImageEncoder
+from imageprocessing import ImageProcessingPool
+from imagemetadata import ImageMetadata
+from imagestore import ImageStore
+from jobqueue import Job, JobQueue
+from metrics import Metrics, metrics
 from openai_image_dto import OpenAiImageDto
+from ratelimitscheduler import RateLimitScheduler
 
+from concurrent.futures import CancelledError, Future
+from types import ModuleType
+from typing import Callable
 from urllib.parse import parse_qs
 
+import importlib.util
+import logging
 import os
-import eel
-
-
-db = ImageGenerationDb()
-image_generation = ImageGeneration()
+import sys
+
+
+# Imports the module upon the first use of one of its attributes, rather than right away.
+def lazy_import(name: str) -> ModuleType:
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+# Eel (along with gevent and bottle) weighs on the startup time of the tests and the headless entry points (e.g.
+# batchgeneration.py), none of which use it, hence it is only imported once the view is started.
+eel = lazy_import("eel")
+
+
+IMAGE_FOLDER = "web/img"
+FUTURE_POLL_INTERVAL = 0.05
+SEARCH_PAGE_SIZE = 20
+LOGGER = "imagegenie"
+# Per-stage timings of the image generation path, exported at /metrics (Prometheus), and logged per request.
+METRICS_ENABLED = True
+# SQLite requires a one-time migration of the TinyDB database: python imagegenerationdb.py migrate
+DATABASE_BACKEND = ImageGenerationDb.Backend.TINYDB
+# Image post-processing (decode, perceptual hash, encode and renditions) runs on a process pool, one worker per core.
+IMAGE_PROCESSING_POOL = True
+
+logger = logging.getLogger(LOGGER)
+
+# The database is shared by every component, and is only opened (i.e. parsed and indexed) upon first use, so that the
+# startup time does not grow with the history of image generations (see ImageGenerationDb.shared).  All but the most recent
+# events are rotated out of the database, into the (compressed, monthly) archive.
+ImageGenerationDb.shared_options.update(
+    durability=ImageGenerationDb.Durability.BATCHED,
+    backend=DATABASE_BACKEND,
+    archive=ImageGenerationDb.ARCHIVE,
+)
+image_encoder = ImageEncoder(ImageEncoder.Mode.JPEG)
+
+# Images are stored under their unique image identifier, in a sharded directory layout (see ImageStore).  As the database,
+# the image store (and the response cache) is shared by every component, and is only opened upon first use, so that the
+# startup time does not grow with the stored images (see ImageStore.shared and ImageGenerationCache.shared).
+ImageStore.shared_options.update(root=IMAGE_FOLDER)
+
+# Image generations (prompt build, API call, decode, encode and logging) are performed by background workers, off the Eel
+# (request handling) thread, so that several generations can be in flight at once.
+image_generation_jobs = JobQueue(thread_name_prefix="ImgGen")
+
+# Thumbnails and display-size renditions are produced in the background, once the full-size image has been written.
+image_derivatives = ImageDerivatives()
+image_derivative_jobs = JobQueue(thread_name_prefix="ImgDrv")
+
+# Image post-processing is CPU bound, hence on the threads of concurrent generations it would be serialized by the GIL.
+# Each generated image is rather handed to the pool as soon as it is received, and is decoded there once, for its
+# perceptual hash, its encoding and its renditions alike (see ImageProcessingPool).
+image_processing = (
+    ImageProcessingPool(None, image_encoder, image_derivatives)
+    if IMAGE_PROCESSING_POOL
+    else None
+)
+
+# Requests made from the view take priority over batch (e.g. sweep) requests, when the rate limit is reached.
+rate_limit_scheduler = RateLimitScheduler()
+# Replies are streamed, so the memory of the generations in flight does not grow with the size of their images.
+image_generation = ImageGeneration(
+    shared_cache=True,
+    scheduler=rate_limit_scheduler,
+    stream=True,
+    processor=image_processing,
+)
+
+
+# The database of the application, shared by every component (see ImageGenerationDb.shared).
+def db() -> ImageGenerationDb:
+    return ImageGenerationDb.shared()
+
+
+# The image store of the application, shared by every component (see ImageStore.shared).
+def image_store() -> ImageStore:
+    return ImageStore.shared()
+
+
+# Functions exposed to the view (JavaScript), which are registered with Eel once the view is started (see main).
+exposed_functions = list[Callable]()
 
 
 def main():
+    metrics.enabled = METRICS_ENABLED
+    logging.basicConfig(format="%(asctime)s %(name)s %(message)s")
+    logging.getLogger(Metrics.LOGGER).setLevel(logging.INFO)
+    for function in exposed_functions:
+        eel.expose(function)
+    eel.btl.route("/metrics")(metrics_handler)
     eel.init("web")
     eel.start("home.html")
 
@@ -56,64 +159,58 @@ def main():
 # region JavaScript exposed functions
 
 
+def expose(function: Callable) -> Callable:
+    exposed_functions.append(function)
+    return function
+
+
 # region Selection Lists
 
 
-@eel.expose
+# Every selection list (image aspect table) in a single round trip, keyed by table name.
+@expose
+def get_selection_catalog():
+    return db().get_catalog()
+
+
+@expose
 def get_specialization():
-    return [
-        record[ImageGenerationDb.Entity.COLUMN_NAME] for record in db.specialization
-    ]
+    return db().get_catalog()[ImageGenerationDb.Entity.TABLE_SPECIALIZATION]
 
 
-@eel.expose
+@expose
 def get_image_lighting():
-    return [
-        record[ImageGenerationDb.Entity.COLUMN_NAME] for record in db.image_lighting
-    ]
+    return db().get_catalog()[ImageGenerationDb.Entity.TABLE_IMAGE_LIGHTING]
 
 
-@eel.expose
+@expose
 def get_image_contrast():
-    return [
-        record[ImageGenerationDb.Entity.COLUMN_NAME] for record in db.image_contrast
-    ]
+    return db().get_catalog()[ImageGenerationDb.Entity.TABLE_IMAGE_CONTRAST]
 
 
-@eel.expose
+@expose
 def get_image_composition_type():
-    return [
-        record[ImageGenerationDb.Entity.COLUMN_NAME]
-        for record in db.image_composition_type
-    ]
+    return db().get_catalog()[ImageGenerationDb.Entity.TABLE_IMAGE_COMPOSITION_TYPE]
 
 
-@eel.expose
+@expose
 def get_image_style():
-    return [record[ImageGenerationDb.Entity.COLUMN_NAME] for record in db.image_style]
+    return db().get_catalog()[ImageGenerationDb.Entity.TABLE_IMAGE_STYLE]
 
 
-@eel.expose
+@expose
 def get_image_color():
-    return [
-        record[ImageGenerationDb.Entity.COLUMN_NAME] for record in db.image_color_scheme
-    ]
+    return db().get_catalog()[ImageGenerationDb.Entity.TABLE_IMAGE_COLOR_SCHEME]
 
 
-@eel.expose
+@expose
 def get_image_aesthetic_pattern():
-    return [
-        record[ImageGenerationDb.Entity.COLUMN_NAME]
-        for record in db.image_aesthetic_pattern
-    ]
+    return db().get_catalog()[ImageGenerationDb.Entity.TABLE_IMAGE_AESTHETIC_PATTERN]
 
 
-@eel.expose
+@expose
 def get_image_depth_of_field():
-    return [
-        record[ImageGenerationDb.Entity.COLUMN_NAME]
-        for record in db.image_depth_of_field
-    ]
+    return db().get_catalog()[ImageGenerationDb.Entity.TABLE_IMAGE_DEPTH_OF_FIELD]
 
 
 # endregion
@@ -122,50 +219,158 @@ def get_image_depth_of_field():
 # region View Event Handlers
 
 
-@eel.expose
+# Enqueues the image generation and immediately returns its job identifier.  The outcome of the job is pushed to the view
+# once it finishes (see notify_when_finished).
+@expose
 def form_submit_handler(form_data):
     dataset = query_string_to_dict(form_data)
-    image_prompt = build_image_prompt(dataset)
+    job = image_generation_jobs.submit(generate_image, dataset)
+    eel.spawn(notify_when_finished, job)
+    return job.id
 
-    try:
+
+@expose
+def image_generation_status_handler(job_id: str):
+    return image_generation_jobs.status(job_id)
+
+
+@expose
+def image_generation_cancel_handler(job_id: str):
+    return image_generation_jobs.cancel(job_id)
+
+
+# Depth of the rate limit queue (per lane), and the estimated wait of a new request, so the view can set expectations.
+@expose
+def get_rate_limit_backpressure():
+    return rate_limit_scheduler.backpressure()
+
+
+# Image generation job (runs on a background worker).
+def generate_image(job: Job, dataset: dict) -> dict:
+    with metrics.request(job=job.id):
+        job.set_stage("prompt")
+        with metrics.stage(Metrics.Stage.PROMPT):
+            image_prompt = build_image_prompt(dataset)
+        job.set_stage("generation")
         generated_image = image_generation.request_image_generation(
             image_prompt, dataset
         )
-        write_image_to_disk(generated_image)
+        # Near-identical images (e.g. of a re-run prompt) are reported, so redundant output can be spotted.
+        similar = [
+            event.get(ImageGenerationDb.Entity.COLUMN_IMAGE_ID)
+            for _, event in db().find_similar_events(
+                generated_image.perceptual_hash, exclude_image_id=generated_image.id
+            )
+        ]
+        if similar:
+            logger.warning(
+                "Image %s is near-identical to %d stored image(s): %s",
+                generated_image.id,
+                len(similar),
+                ", ".join(map(str, similar)),
+            )
+        # The image was paid for (and its event logged), so it is written even if the job was cancelled meanwhile.
+        job.set_stage("encoding", cancellable=False)
+        write_image_and_derivatives(generated_image)
+    return {
+        "image": generated_image.id,
+        "size": dataset[ImageGeneration.OpenApi.IMAGE_SIZE],
+        "similar": similar,
+    }
+
+
+# Waits (on the Eel thread) for the image generation job to finish, and then pushes its outcome to the view.
+def notify_when_finished(job: Job) -> None:
+    try:
+        wait_for_future(job.future)
+    except CancelledError:
+        pass  # The outcome (including a cancellation) is reported through the job's status.
 
-        dimensions = string_to_dimensions(dataset[ImageGeneration.OpenApi.IMAGE_SIZE])
+    if job.status == Job.Status.COMPLETED:
+        dimensions = string_to_dimensions(job.result["size"])
         eel.show(
-            f"image.html?image={generated_image.created}&height={dimensions['height']}&width={dimensions['width']}"
+            f"image.html?image={job.result['image']}&height={dimensions['height']}&width={dimensions['width']}"
         )
-
-    # From the end-user's perspective, it either worked, or did not.
-    # pylint: disable=broad-exception-caught
-    except Exception as e:
+    elif job.status == Job.Status.FAILED:
         # Callback is defined in JavaScript
         # pylint: disable=no-member
-        eel.image_generation_error_notification(str(e))
+        eel.image_generation_error_notification(str(job.error))
 
     # Callback is defined in JavaScript
     # pylint: disable=no-member
-    eel.image_generation_completion_notification()
-
-
-@eel.expose
-def request_image_prompts_handler(image_created: str):
-    entry = db.get_event_log_by_created(int(image_created))
-    if entry:
-        original_prompt = f"<b>Original Prompt:</b> {entry['prompt']}"
-        revised_prompt = f"<b>Revised Prompt:</b> {entry['revised_prompt']}"
-        # Callback is defined in JavaScript
-        # pylint: disable=no-member
-        eel.set_image_prompts(original_prompt, revised_prompt)
-
-
-@eel.expose
+    eel.image_generation_completion_notification(job.id)
+
+
+# Prompts of the image, read from the metadata embedded in its file (see ImageMetadata), and otherwise (i.e. for images
+# written before metadata was embedded) from the event log.
+@expose
+def request_image_prompts_handler(image_id: str):
+    entity = ImageGenerationDb.Entity
+    filename = find_image_file({entity.COLUMN_IMAGE_ID: image_id})
+    entry = ImageMetadata.read(filename) if filename else None
+    if entry is None:
+        entry = db().get_event_log_by_image_id(image_id)
+    if entry is None and image_id.isdigit():
+        # Image stored prior to the image store (i.e. named after its "created" value).
+        entry = db().get_event_log_by_created(int(image_id))
+    if entry is None:
+        return None
+    return {
+        "prompt": entry.get(entity.COLUMN_PROMPT),
+        "revised_prompt": entry.get(entity.COLUMN_REVISED_PROMPT),
+        "size": entry.get(ImageGeneration.OpenApi.IMAGE_SIZE),
+        "configuration": entry.get(ImageMetadata.CONFIGURATION),
+    }
+
+
+# Past image generations whose prompt or revised prompt contain the words of the query, best match first, a page at a time.
+@expose
+def search_image_generations_handler(
+    query: str, page: int = 0, page_size: int = SEARCH_PAGE_SIZE
+):
+    total, events = db().search_event_log(query, page * page_size, page_size)
+    return {
+        "total": total,
+        "page": page,
+        "page_size": page_size,
+        "results": [
+            {
+                "image": event.get(ImageGenerationDb.Entity.COLUMN_IMAGE_ID)
+                or str(event.get(ImageGenerationDb.Entity.COLUMN_CREATED)),
+                "created": event.get(ImageGenerationDb.Entity.COLUMN_CREATED),
+                "size": event.get(ImageGeneration.OpenApi.IMAGE_SIZE),
+                "prompt": event.get(ImageGenerationDb.Entity.COLUMN_PROMPT),
+                "revised_prompt": event.get(
+                    ImageGenerationDb.Entity.COLUMN_REVISED_PROMPT
+                ),
+            }
+            for event in events
+        ],
+    }
+
+
+# Image source (URL) of the smallest rendition of the image that is at least as wide as the displayed width.
+@expose
+def request_image_rendition_handler(image_id: str, width: float):
+    files = image_store().get(image_id)
+    if files is None:
+        # Image stored prior to the image store (i.e. directly in the image folder).
+        for extension in ImageEncoder.EXTENSIONS.values():
+            if os.path.exists(f"{IMAGE_FOLDER}/{image_id}{extension}"):
+                return f"/img/{image_id}{extension}"
+        return None
+    rendition_width = image_derivatives.best_fit(image_id, width)
+    if rendition_width is None:
+        return image_store().url(files[""])
+    return image_store().url(files[ImageDerivatives.variant(rendition_width)])
+
+
+@expose
 def delete_image_handler(query_string):
     try:
-        image_created = query_string_to_dict(query_string)["image"]
-        delete_image_from_disk(image_created)
+        image_id = query_string_to_dict(query_string)["image"]
+        delete_image_from_disk(image_id)
+        db().remove_image_events(image_id)
         # Callback is defined in JavaScript
         # pylint: disable=no-member
         eel.image_deletion_completion_notification()
@@ -184,6 +389,12 @@ def delete_image_handler(query_string):
 # endregion
 
 
+# Prometheus scrape endpoint, served alongside the view (e.g. http://localhost:8000/metrics).
+def metrics_handler():
+    eel.btl.response.content_type = Metrics.CONTENT_TYPE
+    return metrics.export_prometheus()
+
+
 def query_string_to_dict(query_string: str) -> dict[str, str]:
     result = dict[str, str]()
     collection = parse_qs(query_string)
@@ -203,14 +414,84 @@ def build_image_prompt(image_definition: dict) -> str:
 
 
 # Function exists solely for project requirement compliance.
-def write_image_to_disk(image: OpenAiImageDto) -> None:
-    image.save(f"web/img/{image.created}.jpg")
-
-
-def delete_image_from_disk(image_created: str) -> None:
-    file = f"web/img/{image_created}.jpg"
-    if os.path.exists(file):
-        os.remove(file)
+def write_image_to_disk(image: OpenAiImageDto) -> EncodedImage:
+    with image_store().writing(image.id, image_encoder.extension) as filename:
+        encoded_image = image_encoder.encode(image, filename)
+    # The decode and convert stages are measured by the image itself (see OpenAiImageDto).
+    for stage, metric in (
+        (ImageEncoder.Stage.ENCODE, Metrics.Stage.ENCODE),
+        (ImageEncoder.Stage.WRITE, Metrics.Stage.FILE_WRITE),
+    ):
+        if stage in encoded_image.timings:
+            metrics.observe(metric, encoded_image.timings[stage])
+    return encoded_image._replace(
+        filename=image_store().path(image.id, image_encoder.extension)
+    )
+
+
+# The image is written, and its derivatives are then produced in the background (or else, along with the encoding of the
+# image, on the image processing pool).
+def write_image_and_derivatives(image: OpenAiImageDto) -> EncodedImage:
+    if image_processing is not None:
+        return post_process_image(image)
+    encoded_image = write_image_to_disk(image)
+    image_derivative_jobs.submit(write_image_derivatives, image)
+    return encoded_image
+
+
+def post_process_image(image: OpenAiImageDto) -> EncodedImage:
+    processed_image = image_processing.process(image)
+    # The stages ran on a worker of the pool, which reported their timings.
+    for stage, metric in (
+        (ImageEncoder.Stage.DECODE, Metrics.Stage.PIL_DECODE),
+        (ImageEncoder.Stage.CONVERT, Metrics.Stage.RGB_CONVERT),
+        (ImageEncoder.Stage.ENCODE, Metrics.Stage.ENCODE),
+        (ImageEncoder.Stage.WRITE, Metrics.Stage.FILE_WRITE),
+    ):
+        if stage in processed_image.encoded_image.timings:
+            metrics.observe(metric, processed_image.encoded_image.timings[stage])
+    return processed_image.encoded_image
+
+
+# Image derivatives job (runs on a background worker).
+def write_image_derivatives(job: Job, image: OpenAiImageDto) -> dict[int, str]:
+    job.set_stage("derivatives")
+    return image_derivatives.generate(image)
+
+
+# The image (and its derivatives) is deleted regardless of the encoding it was written with.  Images stored prior to the
+# image store are named after their "created" value, directly in the image folder.
+def delete_image_from_disk(image_id: str) -> None:
+    if image_store().delete([image_id]):
+        return
+    for extension in ImageEncoder.EXTENSIONS.values():
+        file = f"{IMAGE_FOLDER}/{image_id}{extension}"
+        if os.path.exists(file):
+            os.remove(file)
+
+
+# File of the image of the event (in the image store, or else in the image folder), or None when it no longer exists.
+def find_image_file(event: dict) -> str:
+    image_key = ImageGenerationDb.image_key(event)
+    files = image_store().get(image_key)
+    if files is not None and os.path.exists(files[""]):
+        return files[""]
+    for extension in ImageEncoder.EXTENSIONS.values():
+        file = f"{IMAGE_FOLDER}/{image_key}{extension}"
+        if os.path.exists(file):
+            return file
+    return None
+
+
+def image_exists(event: dict) -> bool:
+    return find_image_file(event) is not None
+
+
+# Waits for the future to complete, while yielding to Eel (so that other requests continue to be served).
+def wait_for_future(future: Future) -> object:
+    while not future.done():
+        eel.sleep(FUTURE_POLL_INTERVAL)
+    return future.result()
 
 
 if __name__ == "__main__":
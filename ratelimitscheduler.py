@@ -0,0 +1,164 @@
+import heapq
+import itertools
+import re
+import threading
+import time
+
+from typing import TYPE_CHECKING, Callable, Mapping
+
+from httpclient import HttpClient, PooledHttpSession
+
+if TYPE_CHECKING:
+    import requests
+
+
+class RateLimitTimeoutError(Exception):
+    pass
+
+
+# Single Responsibility Principle (SRP): This class has the single responsibility of pacing requests to the rate limit of
+# the (OpenAI) API, rather than bursting into throttled (429) replies.
+# Requests draw from a token bucket, whose capacity, level and refill rate are continuously corrected from the rate limit
+# headers of every reply (x-ratelimit-limit/remaining/reset-requests), including the replies of requests that are retried.
+# A throttled reply empties the bucket, which only starts refilling once its Retry-After has elapsed, so that the requests
+# held back by it (e.g. retries) are paced rather than released at once.  Waiting requests are served by priority lane
+# (interactive requests ahead of batch requests), first come first served within a lane.  Rather than failing, callers can
+# observe the backpressure: the depth of each lane and the estimated wait of a new request.
+class RateLimitScheduler:
+    # Images per minute assumed until the first reply reports the actual rate limit.
+    REQUESTS_PER_MINUTE = 5
+
+    class Priority:
+        INTERACTIVE = 0
+        BATCH = 1
+
+    LANES = {Priority.INTERACTIVE: "interactive", Priority.BATCH: "batch"}
+
+    class Header:
+        LIMIT_REQUESTS = "x-ratelimit-limit-requests"
+        REMAINING_REQUESTS = "x-ratelimit-remaining-requests"
+        RESET_REQUESTS = "x-ratelimit-reset-requests"
+
+    # Durations of the reset headers, e.g. "1s", "6m0s" or "20ms".
+    DURATION_PATTERN = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+    DURATION_UNITS = {"h": 3600.0, "m": 60.0, "s": 1.0, "ms": 0.001}
+
+    def __init__(
+        self,
+        requests_per_minute: float = REQUESTS_PER_MINUTE,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self._clock = clock
+        self._condition = threading.Condition()
+        self._capacity = float(requests_per_minute)
+        self._tokens = float(requests_per_minute)
+        self._rate = requests_per_minute / 60.0  # Tokens per second.
+        self._updated = clock()
+        self._blocked_until = 0.0
+        self._waiters = list[tuple[int, int]]()  # Heap of (priority, ticket).
+        self._tickets = itertools.count()
+
+    # Observes every reply of the HTTP session (including the replies of retried requests).
+    def attach(self, http_session: PooledHttpSession) -> None:
+        http_session.add_response_hook(self._on_response)
+
+    # Blocks until the request may be sent, raising RateLimitTimeoutError if it could not be sent within the timeout.
+    def acquire(self, priority: int = Priority.INTERACTIVE, timeout: float = None):
+        deadline = None if timeout is None else self._clock() + timeout
+        with self._condition:
+            ticket = (priority, next(self._tickets))
+            heapq.heappush(self._waiters, ticket)
+            try:
+                while True:
+                    self._refill()
+                    wait = self._wait_for_head()
+                    if self._waiters[0] == ticket and wait <= 0:
+                        self._tokens -= 1
+                        return
+                    if deadline is not None:
+                        remaining = deadline - self._clock()
+                        if remaining <= 0:
+                            raise RateLimitTimeoutError(
+                                f"No request slot became available within {timeout} seconds."
+                            )
+                        wait = min(wait, remaining)
+                    self._condition.wait(wait if wait > 0 else None)
+            finally:
+                self._waiters.remove(ticket)
+                heapq.heapify(self._waiters)
+                self._condition.notify_all()
+
+    # Corrects the bucket from the rate limit headers of a reply.
+    def update(self, status_code: int, headers: Mapping[str, str]) -> None:
+        with self._condition:
+            self._refill()
+            limit = headers.get(self.Header.LIMIT_REQUESTS)
+            remaining = headers.get(self.Header.REMAINING_REQUESTS)
+            reset = headers.get(self.Header.RESET_REQUESTS)
+            if limit is not None:
+                self._capacity = max(1.0, float(limit))
+            if remaining is not None:
+                self._tokens = min(self._capacity, float(remaining))
+            if reset is not None:
+                seconds = self.parse_duration(reset)
+                if seconds > 0 and self._tokens < self._capacity:
+                    self._rate = (self._capacity - self._tokens) / seconds
+            if status_code == 429:
+                self._tokens = min(self._tokens, 0.0)
+                retry_after = headers.get(HttpClient.RETRY_AFTER)
+                if retry_after is not None:
+                    self._blocked_until = max(
+                        self._blocked_until,
+                        self._clock()
+                        + PooledHttpSession.parse_retry_after(retry_after),
+                    )
+            self._condition.notify_all()
+
+    # Number of waiting requests per lane, and the estimated wait (in seconds) of a new request per lane.
+    def backpressure(self) -> dict:
+        with self._condition:
+            self._refill()
+            depth = {lane: 0 for lane in self.LANES.values()}
+            for priority, _ in self._waiters:
+                depth[self.LANES[priority]] += 1
+            return {
+                "queue_depth": depth,
+                "estimated_wait": {
+                    lane: self._estimated_wait(priority)
+                    for priority, lane in self.LANES.items()
+                },
+                "tokens": self._tokens,
+                "capacity": self._capacity,
+                "requests_per_minute": self._rate * 60.0,
+            }
+
+    @classmethod
+    def parse_duration(cls, value: str) -> float:
+        return sum(
+            float(amount) * cls.DURATION_UNITS[unit]
+            for amount, unit in cls.DURATION_PATTERN.findall(value)
+        )
+
+    def _on_response(self, reply: "requests.Response", *args, **kwargs) -> None:
+        self.update(reply.status_code, reply.headers)
+
+    # Tokens do not accrue while the bucket is blocked (i.e. until the Retry-After of a throttled reply has elapsed).
+    def _refill(self) -> None:
+        now = self._clock()
+        elapsed = now - max(self._updated, self._blocked_until)
+        if elapsed > 0:
+            self._tokens = min(self._capacity, self._tokens + elapsed * self._rate)
+        self._updated = now
+
+    # Seconds until a token is available to the request at the head of the queue.
+    def _wait_for_head(self) -> float:
+        blocked = self._blocked_until - self._clock()
+        shortfall = 1.0 - self._tokens
+        return max(blocked, shortfall / self._rate if shortfall > 0 else 0.0)
+
+    # A new request of the priority is served after every waiting request of the same or a higher priority.
+    def _estimated_wait(self, priority: int) -> float:
+        ahead = sum(1 for waiting, _ in self._waiters if waiting <= priority)
+        blocked = max(0.0, self._blocked_until - self._clock())
+        shortfall = ahead + 1.0 - self._tokens
+        return max(blocked, shortfall / self._rate if shortfall > 0 else 0.0)
@@ -0,0 +1,100 @@
+import asyncio
+import threading
+
+from concurrent.futures import Executor, Future
+from typing import Callable, Hashable, TypeVar
+
+from metrics import Metrics, metrics
+
+T = TypeVar("T")
+
+
+# A call in flight: the outcome shared by its callers, and their number (including the caller that makes the call).
+class _Flight:
+    def __init__(self):
+        self.future = Future()
+        # Running futures cannot be cancelled, so a waiter that gives up (e.g. a cancelled asyncio task) never cancels the
+        # outcome of the other waiters.
+        self.future.set_running_or_notify_cancel()
+        self.waiters = 1
+
+
+# Single Responsibility Principle (SRP): This class has the single responsibility of coalescing identical calls in flight.
+# The first caller of a key makes the call, while the callers of the same key that arrive before it completes wait for its
+# outcome, rather than making a call of their own.  Every caller gets the same outcome: the same result, or the same
+# exception raised.  The key is released as soon as the call completes, so later callers make a new call (i.e. this is not
+# a cache, see ImageGenerationCache).  Callers may be threads (do) or asyncio tasks (do_async), alike.
+class SingleFlight:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = dict[Hashable, _Flight]()
+        self.calls = 0
+        self.coalesced = 0
+
+    # Makes the call, or waits for the identical call in flight, and returns its outcome.
+    def do(self, key: Hashable, function: Callable[[], T]) -> T:
+        flight, leader = self._join(key)
+        if leader:
+            self._call(key, flight, function)
+        return flight.future.result()
+
+    # Equivalent of do for asyncio tasks.  The (blocking) call is made on the executor (by default, that of the event loop),
+    # so the event loop is never blocked, and a waiter that is cancelled does not cancel the call.
+    async def do_async(
+        self, key: Hashable, function: Callable[[], T], executor: Executor = None
+    ) -> T:
+        flight, leader = self._join(key)
+        if leader:
+            asyncio.get_running_loop().run_in_executor(
+                executor, self._call, key, flight, function
+            )
+        return await asyncio.wrap_future(flight.future)
+
+    # Number of callers (including the caller that makes the call) of the call in flight for the key.
+    def waiters(self, key: Hashable) -> int:
+        with self._lock:
+            flight = self._flights.get(key)
+            return flight.waiters if flight else 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "coalesced": self.coalesced,
+                "in_flight": len(self._flights),
+                "waiters": sum(flight.waiters for flight in self._flights.values()),
+            }
+
+    def _join(self, key: Hashable) -> tuple[_Flight, bool]:
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+                self.calls += 1
+            else:
+                flight.waiters += 1
+                self.coalesced += 1
+        metrics.increment(
+            Metrics.Counter.SINGLE_FLIGHT_CALLS
+            if leader
+            else Metrics.Counter.SINGLE_FLIGHT_COALESCED
+        )
+        return flight, leader
+
+    # The key is released before the outcome is set, so a caller that arrives once the waiters are woken makes a new call.
+    def _call(self, key: Hashable, flight: _Flight, function: Callable[[], T]) -> None:
+        # The outcome, including any failure, is that of every waiter.
+        # pylint: disable=broad-exception-caught
+        try:
+            result = function()
+        except BaseException as e:
+            self._release(key)
+            flight.future.set_exception(e)
+        else:
+            self._release(key)
+            flight.future.set_result(result)
+
+    def _release(self, key: Hashable) -> None:
+        with self._lock:
+            del self._flights[key]
@@ -0,0 +1,180 @@
+import json
+import sqlite3
+import threading
+
+from typing import Callable, Iterable, Iterator, Mapping
+
+
+# A SQLite document table, which offers the subset of the TinyDB table interface that ImageGenerationDb relies upon, along
+# with (index backed) lookups by document field.  Each document is stored as JSON text, keyed by its document id.
+class SqliteTable:
+    def __init__(self, storage: "SqliteStorage", name: str):
+        self._storage = storage
+        self.name = name
+        self._quoted_name = '"' + name.replace('"', '""') + '"'
+        storage.execute(
+            f"CREATE TABLE IF NOT EXISTS {self._quoted_name} "
+            "(doc_id INTEGER PRIMARY KEY, document TEXT NOT NULL)"
+        )
+
+    def __iter__(self) -> Iterator[dict]:
+        return iter(self.all())
+
+    def __len__(self) -> int:
+        return self._storage.execute(f"SELECT COUNT(*) FROM {self._quoted_name}")[0][0]
+
+    def all(self) -> list[dict]:
+        return self._documents(
+            self._storage.execute(
+                f"SELECT doc_id, document FROM {self._quoted_name} ORDER BY doc_id"
+            )
+        )
+
+    def insert(self, document: dict) -> int:
+        return self.insert_multiple([document])[0]
+
+    # Documents are inserted within a single transaction (i.e. a group commit).  A document's own doc_id is preserved, when
+    # it has one (e.g. a TinyDB document that is being migrated).
+    def insert_multiple(self, documents: Iterable[dict]) -> list[int]:
+        doc_ids = []
+        with self._storage.transaction() as connection:
+            for document in documents:
+                cursor = connection.execute(
+                    f"INSERT INTO {self._quoted_name} (doc_id, document) VALUES (?, ?)",
+                    (getattr(document, "doc_id", None), json.dumps(document)),
+                )
+                doc_ids.append(cursor.lastrowid)
+        return doc_ids
+
+    # Updates every document, either with the fields, or by the function (which modifies the document in place), within a
+    # single transaction.
+    def update(self, fields: Mapping | Callable[[dict], None]) -> list[int]:
+        doc_ids = []
+        with self._storage.transaction() as connection:
+            rows = connection.execute(
+                f"SELECT doc_id, document FROM {self._quoted_name} ORDER BY doc_id"
+            ).fetchall()
+            for doc_id, text in rows:
+                document = json.loads(text)
+                if callable(fields):
+                    fields(document)
+                else:
+                    document.update(fields)
+                connection.execute(
+                    f"UPDATE {self._quoted_name} SET document = ? WHERE doc_id = ?",
+                    (json.dumps(document), doc_id),
+                )
+                doc_ids.append(doc_id)
+        return doc_ids
+
+    # Removes the documents of the document ids, within a single transaction.
+    def remove(self, doc_ids: Iterable[int]) -> list[int]:
+        doc_ids = list(doc_ids)
+        with self._storage.transaction() as connection:
+            connection.executemany(
+                f"DELETE FROM {self._quoted_name} WHERE doc_id = ?",
+                [(doc_id,) for doc_id in doc_ids],
+            )
+        return doc_ids
+
+    def truncate(self) -> None:
+        with self._storage.transaction() as connection:
+            connection.execute(f"DELETE FROM {self._quoted_name}")
+
+    def create_index(self, field: str) -> None:
+        self._storage.execute(
+            f'CREATE INDEX IF NOT EXISTS "{self.name}_{field}" '
+            f"ON {self._quoted_name} (json_extract(document, '$.{field}'))"
+        )
+
+    # Documents whose field equals the value, in insertion order.  Backed by an index, if one was created for the field.
+    def search_by(self, field: str, value: object) -> list[dict]:
+        return self._documents(
+            self._storage.execute(
+                f"SELECT doc_id, document FROM {self._quoted_name} "
+                f"WHERE json_extract(document, '$.{field}') = ? ORDER BY doc_id",
+                (value,),
+            )
+        )
+
+    @staticmethod
+    def _documents(rows: Iterable[tuple[int, str]]) -> list[dict]:
+        documents = []
+        for doc_id, document in rows:
+            documents.append(SqliteDocument(json.loads(document), doc_id))
+        return documents
+
+
+# Equivalent of a TinyDB document: a dictionary that knows its document id.
+class SqliteDocument(dict):
+    def __init__(self, value: dict, doc_id: int):
+        super().__init__(value)
+        self.doc_id = doc_id
+
+
+# Single Responsibility Principle (SRP): This class has the single responsibility of persisting document tables in SQLite.
+# Unlike TinyDB's JSON storage, SQLite neither loads the entire database into memory, nor rewrites it upon each insert, and
+# write-ahead logging (WAL) lets readers proceed concurrently with a writer (including writers in other processes).
+# Statements are parameterized, and the sqlite3 module caches their prepared form per connection.
+class SqliteStorage:
+    STATEMENT_CACHE_SIZE = 128
+    BUSY_TIMEOUT = 30.0
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.RLock()
+        self._tables = dict[str, SqliteTable]()
+        self._connection = sqlite3.connect(
+            path,
+            timeout=self.BUSY_TIMEOUT,
+            check_same_thread=False,
+            isolation_level=None,
+            cached_statements=self.STATEMENT_CACHE_SIZE,
+        )
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+
+    def table(self, name: str) -> SqliteTable:
+        with self._lock:
+            if name not in self._tables:
+                self._tables[name] = SqliteTable(self, name)
+            return self._tables[name]
+
+    def tables(self) -> set[str]:
+        rows = self.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'"
+        )
+        return {name for (name,) in rows}
+
+    def execute(self, statement: str, parameters: tuple = ()) -> list[tuple]:
+        with self._lock:
+            return self._connection.execute(statement, parameters).fetchall()
+
+    def transaction(self) -> "SqliteTransaction":
+        return SqliteTransaction(self._connection, self._lock)
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+
+# Context manager of an (immediate) SQLite transaction, which is committed upon success and rolled back upon failure.
+class SqliteTransaction:
+    def __init__(self, connection: sqlite3.Connection, lock: threading.RLock):
+        self._connection = connection
+        self._lock = lock
+
+    def __enter__(self) -> sqlite3.Connection:
+        self._lock.acquire()
+        try:
+            self._connection.execute("BEGIN IMMEDIATE")
+        except BaseException:
+            self._lock.release()
+            raise
+        return self._connection
+
+    def __exit__(self, exception_type, exception, traceback) -> None:
+        try:
+            self._connection.execute("ROLLBACK" if exception_type else "COMMIT")
+        finally:
+            self._lock.release()
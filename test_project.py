@@ -1,9 +1,44 @@
 import project
 
-from unittest.mock import Mock
+import asyncio
+import base64
+import io
+import json
+import logging
+import os
+import pathlib
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 
+from concurrent.futures import Future
+from io import BytesIO
+from unittest.mock import Mock, patch
+from PIL import Image
+import requests
+
+from aspectsweep import AspectSweep
+from batchgeneration import BatchGeneration
+from httpclient import HttpClient, PooledHttpSession
 from imagegeneration import ImageGeneration
+from imagegenerationcache import ImageGenerationCache
 from imagegenerationdb import ImageGenerationDb
+from imageresponsestream import ImageResponseStream
+from imagederivatives import ImageDerivatives
+from imageencoder import EncodedImage, ImageEncoder
+from imagemetadata import ImageMetadata, rebuild_event_log
+from imageprocessing import ImageProcessingPool
+from imagestore import ImageStore
+from jobqueue import Job, JobQueue
+from metrics import Metrics, metrics
+from mockimageserver import MockImageServer
+from openai_image_dto import OpenAiImageDto
+from perceptualhash import PerceptualHash, PerceptualHashIndex, backfill
+from ratelimitscheduler import RateLimitScheduler, RateLimitTimeoutError
+from textindex import TextIndex
 
 
 specialization = "Photographer"
@@ -27,6 +62,12 @@ test_query_string = f"?{test_field_image}={test_created_value}&{test_field_heigh
 
 test_dimension = f"{test_width_dimension}x{test_height_dimension}"
 
+test_configuration = {
+    ImageGeneration.OpenApi.IMAGE_SIZE: test_dimension,
+    ImageGeneration.OpenApi.IMAGE_QUALITY: "hd",
+    ImageGeneration.OpenApi.IMAGE_STYLE: "vivid",
+}
+
 
 # NOTE: Test(s) require a seeded database. Execute this prior to running this test proejct:
 # python imagegenerationdb.py
@@ -35,7 +76,32 @@ test_dimension = f"{test_width_dimension}x{test_height_dimension}"
 def main():
     test_query_string_to_dict()
     test_build_image_prompt()
-    test_write_image_to_disk()
+    test_write_image_to_disk(temporary_folder())
+    test_event_log_index(temporary_folder())
+    test_pooled_http_session_retry()
+    test_request_image_generation_batch()
+    test_image_generation_cache(temporary_folder())
+    test_openai_image_dto_lazy_decode(temporary_folder())
+    test_image_encoder(temporary_folder())
+    test_selection_catalog(temporary_folder())
+    test_event_log_write_behind(temporary_folder())
+    test_sqlite_backend_migration(temporary_folder())
+    test_job_queue()
+    test_image_derivatives(temporary_folder())
+    test_image_store(temporary_folder())
+    test_aspect_sweep(temporary_folder())
+    test_rate_limit_scheduler()
+    test_mock_image_server(temporary_folder())
+    test_metrics()
+    test_batch_generation(temporary_folder())
+    test_lazy_startup(temporary_folder())
+    test_event_log_search(temporary_folder())
+    test_perceptual_hash(temporary_folder())
+    test_event_log_rotation(temporary_folder())
+    test_response_streaming(temporary_folder())
+    test_image_processing_pool(temporary_folder())
+    test_single_flight(temporary_folder())
+    test_image_metadata(temporary_folder())
 
 
 # 1. Verify query-string to dictionary works as expected.
@@ -104,12 +170,1040 @@ def assert_prompt_contents(prompt_text: str, override: bool):
 
 
 # 4. Contrived test that verifies that the Project's write_image_to_disk() function call the appropriate image method witht he expected filename.
-def test_write_image_to_disk():
+def test_write_image_to_disk(tmp_path):
     image = Mock()
     image.created = 1711920536
-    project.write_image_to_disk(image)
-    image.save.assert_called_once_with(f"web/img/{image.created}.jpg")
+    image.id = f"{image.created}-0123456789abcdef"
+    store = ImageStore(str(tmp_path))
+
+    def encode(image_object, filename):
+        pathlib.Path(filename).write_bytes(b"image")
+        return EncodedImage(filename, 5, {})
+
+    encoder = Mock(extension=".jpg")
+    encoder.encode.side_effect = encode
+    with patch.object(project, "image_encoder", encoder), patch.object(
+        project, "image_store", lambda: store
+    ):
+        encoded_image = project.write_image_to_disk(image)
+    encoder.encode.assert_called_once()
+    assert encoder.encode.call_args.args[0] is image
+    assert encoded_image.filename == store.path(image.id, ".jpg")
+    assert encoded_image.filename.endswith(f"{image.id}.jpg")
+    assert store.get(image.id) == {"": encoded_image.filename}
+
+
+
+# 5. Verify that event log lookups are served by the maintained (created & prompt) indexes, including rebuilds.
+def test_event_log_index(tmp_path):
+    database = str(tmp_path / "db.json")
+    db = ImageGenerationDb(database)
+    event = {
+        ImageGeneration.OpenApi.PROMPT_TEXT: test_prompt_string,
+        ImageGeneration.OpenApi.REVISED_PROMPT: test_prompt_string,
+        ImageGeneration.OpenApi.IMAGE_TIMESTAMP: test_created_value,
+        ImageGenerationDb.Entity.COLUMN_IMAGE_ID: f"{test_created_value}-0123",
+    }
+    db.write_event(event)
+    assert db.get_event_log_by_created(test_created_value) == event
+    assert db.get_event_log_by_image_id(f"{test_created_value}-0123") == event
+    assert db.get_event_log_by_prompt(test_prompt_string) == [event]
+    assert db.get_event_log_by_created(test_created_value + 1) is None
+
+    # A freshly opened database builds its indexes from the persisted event log.
+    db = ImageGenerationDb(database)
+    assert db.get_event_log_by_created(test_created_value) == event
+
+    db.database.table(ImageGenerationDb.Entity.TABLE_EVENT_LOG).truncate()
+    db.rebuild_event_log_index()
+    assert db.get_event_log_by_created(test_created_value) is None
+
+
+# 6. Verify that throttled replies are retried, honouring the Retry-After header, and that the retry budget is respected.
+def test_pooled_http_session_retry():
+    delays = []
+    session = PooledHttpSession(max_retries=2, backoff_base=0.001, sleep=delays.append)
+    throttled = Mock(status_code=429, headers={HttpClient.RETRY_AFTER: "3"})
+    accepted = Mock(status_code=200, headers={})
+
+    session.session.post = Mock(side_effect=[throttled, accepted])
+    assert session.post("https://localhost", "{}", {}) is accepted
+    assert delays == [3.0]
+
+    session.session.post = Mock(side_effect=[throttled, throttled, throttled])
+    assert session.post("https://localhost", "{}", {}) is throttled
+    assert session.stats()["retries"] == 3
+    assert session.stats()["requests"] == 5
+
+    # A failure to connect is retried, while a connection dropped once the request was sent is not (lest it be paid twice).
+    session = PooledHttpSession(max_retries=2, sleep=delays.append)
+    with MockImageServer() as server:
+        url = server.url
+    try:
+        session.post(url, "{}", {})
+    except requests.ConnectionError:
+        pass
+    assert session.stats()["retries"] == 2
+    with MockImageServer(disconnect_rate=1.0) as server:
+        try:
+            session.post(server.url, json.dumps({"prompt": "x"}), {})
+        except requests.ConnectionError:
+            pass
+        assert server.stats()["disconnected"] == 1
+    assert session.stats()["requests"] == 4
+    assert session.stats()["retries"] == 2
+
+
+# 7. Verify that batch generation streams results as they complete, and reports a failed item without aborting the batch.
+def test_request_image_generation_batch():
+    def generate(prompt: str, configuration: dict, priority: int):
+        time.sleep(configuration["delay"])
+        if prompt == "fail":
+            raise RuntimeError(prompt)
+        return prompt
+
+    generator = ImageGeneration(http_session=Mock())
+    generator.request_image_generation = generate
+    batch = [("slow", {"delay": 0.2}), ("fail", {"delay": 0}), ("fast", {"delay": 0})]
+
+    results = list(generator.request_image_generation_batch(batch, max_workers=3))
+    assert [result.index for result in results][-1] == 0
+    assert {result.prompt: result.image for result in results} == {
+        "slow": "slow",
+        "fail": None,
+        "fast": "fast",
+    }
+    assert str(next(r.error for r in results if r.prompt == "fail")) == "fail"
+
+
+# 8. Verify that a cached generation is served without a network call, and that the cache bounds are enforced.
+def test_image_generation_cache(tmp_path):
+    cache = ImageGenerationCache(str(tmp_path), max_entries=2)
+    http_session = Mock()
+    generator = ImageGeneration(http_session=http_session, cache=cache)
+    body = generator.build_image_request_body(test_prompt_string, test_configuration)
+    cache.put(body, build_image_response(test_created_value))
+
+    image = generator.request_image_generation(test_prompt_string, test_configuration)
+    assert image.created == test_created_value
+    http_session.post.assert_not_called()
+    assert cache.stats()["hits"] == 1
+
+    # Entries are read without holding the cache-wide lock.
+    read = cache._read
+    cache._read = lambda key: None if cache._lock.locked() else read(key)
+    assert cache.get(body) is not None
+    del cache._read
+
+    # Least recently used entries are evicted once the bounds are exceeded.
+    for created in (1, 2):
+        cache.put({"created": created}, build_image_response(created))
+    assert cache.get(body) is None
+    assert cache.get({"created": 2}) is not None
+    assert cache.stats()["evictions"] == 1
+
+    # Entries do not outlive their time-to-live, and the remaining entries persist across instances.
+    assert ImageGenerationCache(str(tmp_path), ttl=0).get({"created": 2}) is None
+    assert ImageGenerationCache(str(tmp_path)).stats()["entries"] == 1
+
+
+# 9. Verify that the image payload is decoded lazily, and that the original bytes are saved as-is.
+def test_openai_image_dto_lazy_decode(tmp_path):
+    response = build_image_response(test_created_value)
+    payload = response[ImageGeneration.OpenApi.PAYLOAD_DATA][0]
+    original = base64.b64decode(payload[ImageGeneration.OpenApi.PAYLOAD_B64_JSON])
+
+    image_object = OpenAiImageDto(response)
+    assert image_object._bitmap is None and image_object._image is None
+    image_object.save_original(str(tmp_path / "streamed.png"))
+    assert (tmp_path / "streamed.png").read_bytes() == original
+    assert image_object._image is None
+
+    assert image_object.image.mode == "RGB"
+    assert image_object._b64_image is None
+    assert image_object.b64_json == payload[ImageGeneration.OpenApi.PAYLOAD_B64_JSON]
+    image_object.save_original(str(tmp_path / "decoded.png"))
+    assert (tmp_path / "decoded.png").read_bytes() == original
+
+
+# 10. Verify that each encoding mode writes the expected image format, and reports its stage timings.
+def test_image_encoder(tmp_path):
+    all_stages = {
+        ImageEncoder.Stage.DECODE,
+        ImageEncoder.Stage.CONVERT,
+        ImageEncoder.Stage.ENCODE,
+        ImageEncoder.Stage.WRITE,
+    }
+    expectations = {
+        ImageEncoder.Mode.PASSTHROUGH: ("PNG", {ImageEncoder.Stage.WRITE}),
+        ImageEncoder.Mode.JPEG: ("JPEG", all_stages),
+        ImageEncoder.Mode.WEBP: ("WEBP", all_stages),
+    }
+    for mode, (image_format, stages) in expectations.items():
+        encoder = ImageEncoder(mode, quality=80)
+        filename = str(tmp_path / f"image{encoder.extension}")
+        encoded = encoder.encode(OpenAiImageDto(build_image_response(1)), filename)
+        with Image.open(filename) as image:
+            assert image.format == image_format
+        assert encoded.size == os.path.getsize(filename)
+        assert set(encoded.timings) == stages
+
+
+# 11. Verify that the selection catalog holds every aspect table, is served from memory, and is invalidated by reseeding.
+def test_selection_catalog(tmp_path):
+    db = ImageGenerationDb(str(tmp_path / "db.json"))
+    assert db.get_catalog()[ImageGenerationDb.Entity.TABLE_SPECIALIZATION] == []
+
+    db.seed_database()
+    catalog = db.get_catalog()
+    assert set(catalog) == set(ImageGenerationDb.Entity.ASPECT_TABLES)
+    assert specialization in catalog[ImageGenerationDb.Entity.TABLE_SPECIALIZATION]
+    assert image_contrast in catalog[ImageGenerationDb.Entity.TABLE_IMAGE_CONTRAST]
+
+    db.image_contrast.insert({ImageGenerationDb.Entity.COLUMN_NAME: "extreme"})
+    assert db.get_catalog() == catalog
+
+
+# 12. Verify that batched (write-behind) events are readable at once, and persisted as a group upon each flush threshold.
+def test_event_log_write_behind(tmp_path):
+    database = str(tmp_path / "db.json")
+    db = ImageGenerationDb(
+        database, ImageGenerationDb.Durability.BATCHED, flush_size=3, flush_interval=60
+    )
+
+    def persisted_events() -> int:
+        table = ImageGenerationDb.Entity.TABLE_EVENT_LOG
+        return len(ImageGenerationDb(database).database.table(table))
+
+    for created in (1, 2):
+        db.write_event({ImageGeneration.OpenApi.IMAGE_TIMESTAMP: created})
+    assert db.get_event_log_by_created(2) is not None
+    assert persisted_events() == 0
+
+    db.write_event({ImageGeneration.OpenApi.IMAGE_TIMESTAMP: 3})
+    assert persisted_events() == 3
+
+    db.flush_interval = 0.01
+    db.write_event({ImageGeneration.OpenApi.IMAGE_TIMESTAMP: 4})
+    time.sleep(0.5)
+    assert persisted_events() == 4
+
+    db.write_event({ImageGeneration.OpenApi.IMAGE_TIMESTAMP: 5})
+    db.close()
+    assert persisted_events() == 5
+
+
+# 13. Verify that a TinyDB database migrates to the SQLite backend, which then serves the same interface.
+def test_sqlite_backend_migration(tmp_path):
+    source = ImageGenerationDb(str(tmp_path / "db.json"))
+    source.seed_database()
+    event = {
+        ImageGeneration.OpenApi.PROMPT_TEXT: test_prompt_string,
+        ImageGeneration.OpenApi.IMAGE_TIMESTAMP: test_created_value,
+    }
+    source.write_event(event)
+    catalog = source.get_catalog()
+    source.close()
+
+    db = ImageGenerationDb(
+        str(tmp_path / "db.sqlite"),
+        ImageGenerationDb.Durability.BATCHED,
+        flush_interval=60,
+        backend=ImageGenerationDb.Backend.SQLITE,
+    )
+    imported = db.import_database(str(tmp_path / "db.json"))
+    assert imported[ImageGenerationDb.Entity.TABLE_EVENT_LOG] == 1
+    assert db.get_catalog() == catalog
+    assert db.get_event_log_by_created(test_created_value) == event
+
+    # Pending (batched) events are served before and after they are flushed.
+    db.write_event({**event, ImageGeneration.OpenApi.IMAGE_TIMESTAMP: 1})
+    assert len(db.get_event_log_by_prompt(test_prompt_string)) == 2
+    db.flush()
+    assert len(db.get_event_log_by_prompt(test_prompt_string)) == 2
+    assert db.get_event_log_by_created(1) is not None
+    db.close()
+
+
+# 14. Verify that jobs run concurrently, report their status and failures, and can be cancelled (queued or running).
+def test_job_queue():
+    jobs = JobQueue(max_workers=2)
+    release = threading.Event()
+
+    def work(job: Job, name: str):
+        job.set_stage("waiting")
+        release.wait(5)
+        job.set_stage("working")
+        if name == "fail":
+            raise RuntimeError(name)
+        return name
+
+    running, failing, queued = (jobs.submit(work, name) for name in ("a", "fail", "b"))
+    assert jobs.status(queued.id)["status"] == Job.Status.QUEUED
+    assert jobs.cancel(queued.id)
+    assert jobs.status(queued.id)["status"] == Job.Status.CANCELLED
+    assert jobs.pending() == 2
+
+    completed = jobs.submit(work, "c")
+    time.sleep(0.1)
+    assert jobs.status(running.id)["stage"] == "waiting"
+    assert jobs.cancel(running.id)
+    release.set()
+    jobs.shutdown()
+    assert jobs.status(running.id)["status"] == Job.Status.CANCELLED
+    assert jobs.status(failing.id)["status"] == Job.Status.FAILED
+    assert jobs.status(failing.id)["error"] == "fail"
+    assert jobs.status(completed.id)["result"] == "c"
+
+    # Once the image was generated, cancelling the job no longer discards it.
+    job = Job("generated")
+    image = Mock(id=1, perceptual_hash=None)
+    generation = Mock()
+    generation.request_image_generation.side_effect = lambda *_: (
+        job.request_cancel() or image
+    )
+    with patch.object(project, "image_generation", generation), patch.object(
+        project, "db"
+    ) as db, patch.object(project, "write_image_and_derivatives") as write:
+        db.return_value.find_similar_events.return_value = []
+        result = project.generate_image(job, {"size": "1024x1024"})
+    write.assert_called_once_with(image)
+    assert result["image"] == 1 and job.stage == "encoding"
+
+
+# 15. Verify that image renditions are produced (without upscaling), and that the smallest fitting rendition is selected.
+def test_image_derivatives(tmp_path):
+    store = ImageStore(str(tmp_path))
+    derivatives = ImageDerivatives(store, widths=(16, 32, 128))
+    image_object = OpenAiImageDto(build_image_response(test_created_value, (64, 32)))
+    renditions = derivatives.generate(image_object)
+    assert sorted(renditions) == [16, 32]
+    with Image.open(renditions[16]) as image:
+        assert image.size == (16, 8)
+
+    assert derivatives.best_fit(image_object.id, 10) == 16
+    assert derivatives.best_fit(image_object.id, 20) == 32
+    assert derivatives.best_fit(image_object.id, 40) is None
+    store.delete([image_object.id])
+    assert derivatives.best_fit(image_object.id, 10) is None
+    assert not os.path.exists(renditions[16])
+
+
+# 16. Verify that images created within the same second are stored apart, atomically, and that the manifest survives a reopen.
+def test_image_store(tmp_path):
+    store = ImageStore(str(tmp_path))
+    first = OpenAiImageDto(build_image_response(test_created_value, (8, 8)))
+    second = OpenAiImageDto(build_image_response(test_created_value, (16, 16)))
+    assert first.id != second.id
+    assert first.id == OpenAiImageDto(build_image_response(test_created_value)).id
+
+    for image_object in (first, second):
+        with store.writing(image_object.id, ".png") as filename:
+            image_object.save_original(filename)
+            assert not os.path.exists(store.path(image_object.id, ".png"))
+    assert sorted(store.find_by_created(test_created_value)) == sorted(
+        [first.id, second.id]
+    )
+    assert os.path.dirname(store.path(first.id, ".png")) != str(tmp_path)
+
+    # A failed write leaves neither the file nor a manifest record behind.
+    try:
+        with store.writing(f"{test_created_value}-failed", ".png") as filename:
+            raise RuntimeError("failed")
+    except RuntimeError:
+        pass
+    assert not os.path.exists(filename)
+    assert store.get(f"{test_created_value}-failed") is None
+
+    store = ImageStore(str(tmp_path))
+    assert store.exists([first.id, second.id, "0-missing"]) == {
+        first.id: True,
+        second.id: True,
+        "0-missing": False,
+    }
+    assert store.url(store.path(first.id, ".png")).startswith(
+        "/" + os.path.basename(str(tmp_path)) + "/"
+    )
+    assert store.delete([first.id, "0-missing"]) == 1
+    store.compact()
+    store = ImageStore(str(tmp_path))
+    assert store.find_by_created(test_created_value) == [second.id]
+
+    # The manifest is compacted once its stale records outnumber its current ones (and the threshold).
+    store = ImageStore(str(tmp_path), compaction_threshold=4)
+    for _ in range(3):
+        with store.writing(second.id, ".png") as filename:
+            second.save_original(filename)
+    manifest = pathlib.Path(tmp_path, ImageStore.MANIFEST)
+    assert len(manifest.read_text().splitlines()) == 4
+    with store.writing(second.id, ".png") as filename:
+        second.save_original(filename)
+    assert len(manifest.read_text().splitlines()) == 1
+    assert ImageStore(str(tmp_path)).get(second.id) == store.get(second.id)
+
+
+# 17. Verify that the aspect sweep addresses every combination, samples reproducibly and evenly, and honours its budget.
+def test_aspect_sweep(tmp_path):
+    catalog = {table: ["any"] for table in ImageGenerationDb.Entity.ASPECT_TABLES}
+    catalog |= {
+        ImageGenerationDb.Entity.TABLE_SPECIALIZATION: ["Painter", "Photographer"],
+        ImageGenerationDb.Entity.TABLE_IMAGE_STYLE: ["abstract", "pop art", "realism"],
+        ImageGenerationDb.Entity.TABLE_IMAGE_LIGHTING: ["ambient", "natural"],
+        ImageGenerationDb.Entity.TABLE_IMAGE_CONTRAST: ["high", "low"],
+    }
+    generator = ImageGeneration(
+        http_session=Mock(), db=ImageGenerationDb(str(tmp_path / "db.json"))
+    )
+    sweep = AspectSweep(generator, catalog)
+    assert sweep.size() == 24
+    combinations = [sweep.combination(index) for index in range(sweep.size())]
+    assert len({tuple(c.values()) for c in combinations}) == 24
+
+    stratified = list(sweep.indexes(AspectSweep.Mode.STRATIFIED, seed=1))
+    assert sorted(stratified) == list(range(24))
+    assert stratified == list(sweep.indexes(AspectSweep.Mode.STRATIFIED, seed=1))
+    # Every value of each aspect table is used once per cycle through that table.
+    style = ImageGenerationDb.Entity.TABLE_IMAGE_STYLE
+    styles = [sweep.combination(index)[style] for index in stratified[:3]]
+    assert sorted(styles) == catalog[style]
+    assert sorted(sweep.indexes(AspectSweep.Mode.RANDOM, seed=1)) == list(range(24))
+
+    prompts = list(sweep.prompts(test_prompt_string))
+    assert len(prompts) == len(set(prompts)) == 24
+    assert all(test_prompt_string in prompt for prompt in prompts)
+
+    generator.request_image_generation = lambda prompt, *args: prompt
+    results = list(sweep.run(test_prompt_string, test_configuration, budget=5, seed=1))
+    assert len(results) == 5
+    assert len({result.prompt for result in results}) == 5
+
+
+# 18. Verify that the rate limit headers drive the token bucket, that interactive requests go first, and that throttling backs off.
+def test_rate_limit_scheduler():
+    assert RateLimitScheduler.parse_duration("6m0s") == 360
+    assert RateLimitScheduler.parse_duration("1h2m3.5s") == 3723.5
+    assert RateLimitScheduler.parse_duration("20ms") == 0.02
+
+    scheduler = RateLimitScheduler()
+    http_session = PooledHttpSession()
+    scheduler.attach(http_session)
+    headers = {
+        RateLimitScheduler.Header.LIMIT_REQUESTS: "60",
+        RateLimitScheduler.Header.REMAINING_REQUESTS: "0",
+        RateLimitScheduler.Header.RESET_REQUESTS: "6s",  # i.e. 10 requests per second.
+    }
+    for hook in http_session.session.hooks["response"]:
+        hook(Mock(status_code=200, headers=headers))
+    assert scheduler.backpressure()["capacity"] == 60
+
+    order = []
+
+    def request(priority: int, lane: str):
+        scheduler.acquire(priority)
+        order.append(lane)
+
+    batch = threading.Thread(
+        target=request, args=(RateLimitScheduler.Priority.BATCH, "batch")
+    )
+    batch.start()
+    time.sleep(0.02)
+    interactive = threading.Thread(
+        target=request, args=(RateLimitScheduler.Priority.INTERACTIVE, "interactive")
+    )
+    interactive.start()
+    time.sleep(0.02)
+    backpressure = scheduler.backpressure()
+    assert backpressure["queue_depth"] == {"interactive": 1, "batch": 1}
+    estimated_wait = backpressure["estimated_wait"]
+    assert estimated_wait["batch"] > estimated_wait["interactive"] > 0
+    batch.join()
+    interactive.join()
+    assert order == ["interactive", "batch"]
+
+    # A throttled reply empties the bucket until its Retry-After has elapsed.
+    scheduler.update(429, {HttpClient.RETRY_AFTER: "1"})
+    assert scheduler.backpressure()["estimated_wait"]["interactive"] > 0.5
+    try:
+        scheduler.acquire(timeout=0.05)
+        assert False, "The request should not have been sent."
+    except RateLimitTimeoutError:
+        pass
+    assert scheduler.backpressure()["queue_depth"]["interactive"] == 0
+
+
+# 19. Verify that the mock server stands in for the API: unique image payloads, injected errors, and rate limit headers.
+def test_mock_image_server(tmp_path):
+    db = ImageGenerationDb(str(tmp_path / "db.json"))
+    with MockImageServer(size=(16, 8), requests_per_minute=60) as server:
+        scheduler = RateLimitScheduler()
+        generator = ImageGeneration(
+            http_session=PooledHttpSession(max_retries=0),
+            db=db,
+            scheduler=scheduler,
+            url=server.url,
+        )
+        first = generator.request_image_generation("First.", test_configuration)
+        second = generator.request_image_generation("Second.", test_configuration)
+        assert first.image.size == (16, 8)
+        assert first.revised_prompt == "First."
+        assert first.id != second.id
+        assert db.get_event_log_by_image_id(second.id) is not None
+        assert scheduler.backpressure()["capacity"] == 60
+
+        server.error_rate = 1.0
+        try:
+            generator.request_image_generation(test_prompt_string, test_configuration)
+            assert False, "The server error should have been raised."
+        except RuntimeError as e:
+            assert str(e) == "The server had an error."
+
+        server.error_rate, server.throttle_rate = 0.0, 1.0
+        try:
+            generator.request_image_generation(test_prompt_string, test_configuration)
+            assert False, "The throttled reply should have been raised."
+        except RuntimeError as e:
+            assert str(e) == "Rate limit exceeded."
+        assert server.stats()["throttled"] == 1
+
+    # Retries of throttled requests are admitted by the scheduler, which paces them once the Retry-After has elapsed, rather
+    # than each request sleeping (and then retrying) on its own.
+    with MockImageServer(size=(16, 8)) as server:
+        reply = server.reply
+        attempts = []
+        lock = threading.Lock()
+
+        def throttle_first_attempts(body: dict) -> tuple:
+            with lock:
+                attempts.append(time.monotonic())
+                throttled = len(attempts) <= 2
+            if throttled:
+                return 429, {HttpClient.RETRY_AFTER: "0.2"}, {"error": {}}
+            return reply(body)
+
+        sleep = Mock()
+        generator = ImageGeneration(
+            http_session=PooledHttpSession(sleep=sleep),
+            db=db,
+            scheduler=RateLimitScheduler(requests_per_minute=600),
+            url=server.url,
+        )
+        with patch.object(server, "reply", throttle_first_attempts):
+            threads = [
+                threading.Thread(
+                    target=generator.request_image_generation,
+                    args=(prompt, test_configuration),
+                )
+                for prompt in ("First.", "Second.")
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        assert len(attempts) == 4 and server.stats()["served"] == 2
+        sleep.assert_not_called()
+        # No token accrues until the Retry-After has elapsed, and then one per 0.1 second (600 requests per minute).
+        assert attempts[2] - attempts[1] >= 0.25
+        assert attempts[3] - attempts[2] >= 0.08
+
+
+# 20. Verify that the stages of a request are recorded, exported in the Prometheus format and logged, only when enabled.
+def test_metrics():
+    records = []
+    handler = logging.Handler()
+    handler.emit = records.append
+    logger = logging.getLogger(Metrics.LOGGER)
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    metrics.reset()
+    try:
+        assert metrics.stage(Metrics.Stage.B64_DECODE) is metrics.stage("other")
+        OpenAiImageDto(build_image_response(test_created_value)).image
+        assert metrics.snapshot() == {"histograms": {}, "counters": {}}
+
+        metrics.enabled = True
+        with metrics.request(job="job"):
+            OpenAiImageDto(build_image_response(test_created_value)).image
+        stages = {
+            Metrics.Stage.B64_DECODE,
+            Metrics.Stage.PIL_DECODE,
+            Metrics.Stage.RGB_CONVERT,
+        }
+        snapshot = metrics.snapshot()
+        for stage in stages:
+            assert snapshot["histograms"][stage]["count"] == 1
+        assert snapshot["counters"]['requests_total{outcome="success"}'] == 1
+
+        exported = metrics.export_prometheus()
+        assert "# TYPE imagegenie_stage_seconds histogram" in exported
+        assert 'imagegenie_stage_seconds_count{stage="b64_decode"} 1' in exported
+        assert 'stage_seconds_bucket{stage="b64_decode",le="+Inf"} 1' in exported
+
+        record = json.loads(records[-1].getMessage())
+        assert record["job"] == "job" and record["outcome"] == "success"
+        assert set(record["stages"]) == stages
+    finally:
+        metrics.enabled = False
+        metrics.reset()
+        logger.removeHandler(handler)
+
+
+# 21. Verify that a headless batch emits a result line per request, and that a resumed batch skips the completed requests.
+def test_batch_generation(tmp_path):
+    record = {table: "any" for table in ImageGenerationDb.Entity.ASPECT_TABLES}
+    record |= test_configuration | {ImageGeneration.OpenApi.PROMPT_TEXT: "First."}
+    records = [
+        record,
+        record | {"id": "second", ImageGeneration.OpenApi.PROMPT_TEXT: "Second."},
+        {"id": "incomplete", ImageGeneration.OpenApi.PROMPT_TEXT: "Incomplete."},
+    ]
+    lines = io.StringIO("".join(json.dumps(r) + "\n" for r in records))
+    store = ImageStore(str(tmp_path / "img"))
+
+    def write_image(image_object: OpenAiImageDto) -> EncodedImage:
+        with store.writing(image_object.id, ".png") as filename:
+            image_object.save_original(filename)
+        return EncodedImage(store.path(image_object.id, ".png"), 0, {})
+
+    with MockImageServer(size=(8, 8)) as server:
+        generator = ImageGeneration(
+            http_session=PooledHttpSession(max_retries=0),
+            db=ImageGenerationDb(str(tmp_path / "db.json")),
+            url=server.url,
+        )
+        checkpoint = str(tmp_path / "checkpoint.jsonl")
+        batch = BatchGeneration(generator, write_image, checkpoint, max_workers=2)
+        output = io.StringIO()
+        counts = batch.run(BatchGeneration.read_records(lines), output)
+        assert counts == {"completed": 2, "failed": 1, "skipped": 0}
+        results = {r["id"]: r for r in map(json.loads, output.getvalue().splitlines())}
+        assert results["incomplete"]["status"] == "failed"
+        assert os.path.exists(results["second"]["filename"])
+        assert results[BatchGeneration.request_id(record)]["status"] == "completed"
+
+        # A resumed batch (e.g. after a crash) skips the checkpointed requests.
+        batch = BatchGeneration(generator, write_image, checkpoint)
+        counts = batch.run(records, io.StringIO())
+        assert counts == {"completed": 0, "failed": 1, "skipped": 2}
+        assert server.stats()["requests"] == 2
+
+
+# 22. Verify that importing the application neither opens its database, image store or cache, nor imports Eel, Requests or PIL.
+def test_lazy_startup(tmp_path):
+    environment = dict(os.environ, PYTHONPATH=os.path.dirname(project.__file__))
+
+    def run(script: str) -> None:
+        subprocess.run(
+            [sys.executable, "-c", "import sys, project\n" + script],
+            cwd=tmp_path,
+            env=environment,
+            check=True,
+        )
+
+    run("assert not [m for m in ('gevent', 'requests', 'PIL') if m in sys.modules]")
+    assert not (tmp_path / ImageGenerationDb.DATABASE).exists()
+    # The database is opened upon first use, and is shared by every component.
+    run("assert project.db() is project.image_generation.db")
+    assert (tmp_path / ImageGenerationDb.DATABASE).exists()
+    run(
+        "from imagestore import ImageStore\n"
+        "from imagegenerationcache import ImageGenerationCache\n"
+        "assert ImageStore._shared is None and ImageGenerationCache._shared is None\n"
+        "assert project.image_store() is project.image_derivatives.store\n"
+        "assert project.image_store() is project.image_processing.store\n"
+        "assert project.image_generation.cache is ImageGenerationCache.shared()"
+    )
+
+
+# 23. Verify that the event log is searched by the wording of its prompts, ranked, paginated, and kept up to date.
+def test_event_log_search(tmp_path):
+    index = TextIndex()
+    assert index.tokenize("A Red-Fox, in the SNOW!") == ["red", "fox", "snow"]
+    index.add("long", "a red fox runs through a field of tall grass in the snow")
+    index.add("short", "red fox")
+    index.add("other", "a blue whale", "revised: a blue whale at sea")
+    # The shorter text is the better match.
+    total, matches = index.search("red fox")
+    assert total == 2 and [document for document, _ in matches] == ["short", "long"]
+    assert matches[0][1] > matches[1][1] > 0
+    assert [document for document, _ in index.search("fo")[1]] == ["short", "long"]
+    assert index.search("red whale") == (0, [])
+    assert index.search("the") == (0, [])
+    assert [document for document, _ in index.search("sea")[1]] == ["other"]
+
+    db = ImageGenerationDb(
+        str(tmp_path / "db.json"), durability=ImageGenerationDb.Durability.BATCHED
+    )
+    entity = ImageGenerationDb.Entity
+    for created in range(25):
+        db.write_event(
+            {
+                entity.COLUMN_CREATED: created,
+                entity.COLUMN_PROMPT: f"Subject: lighthouse number {created}",
+                entity.COLUMN_REVISED_PROMPT: "A lighthouse at dusk.",
+            }
+        )
+    total, page = db.search_event_log("lighthouse", offset=20, limit=10)
+    assert total == 25 and len(page) == 5
+    # Among equally relevant events, the most recent comes first.
+    assert db.search_event_log("lighthouse", limit=1)[1][0]["created"] == 24
+    assert db.search_event_log("Number 7")[1][0]["created"] == 7
+
+    # Events written after the first search are searchable, as are the events of a reopened database.
+    db.write_event(
+        {
+            entity.COLUMN_CREATED: 25,
+            entity.COLUMN_PROMPT: "Subject: windmill",
+            entity.COLUMN_REVISED_PROMPT: "A windmill in a tulip field.",
+        }
+    )
+    assert db.search_event_log("tulip")[1][0]["created"] == 25
+    db.close()
+    reopened = ImageGenerationDb(str(tmp_path / "db.json"))
+    assert reopened.search_event_log("tulip")[0] == 1
+
+
+# 24. Verify that near-identical images are found by their perceptual hash, including the images of a backfill.
+def test_perceptual_hash(tmp_path):
+    gradient = Image.linear_gradient("L").resize((64, 48)).convert("RGB")
+    original = PerceptualHash.of(gradient)
+    rescaled = PerceptualHash.of(gradient.resize((128, 96)))
+    different = PerceptualHash.of(gradient.rotate(90))
+    assert PerceptualHash.distance(original, rescaled) <= PerceptualHash.MAX_DISTANCE
+    assert PerceptualHash.distance(original, different) > PerceptualHash.MAX_DISTANCE
+
+    # The index finds exactly what a linear scan finds.
+    rng = random.Random(7)
+    hashes = [f"{rng.getrandbits(64):016x}" for _ in range(500)]
+    index = PerceptualHashIndex()
+    for number, perceptual_hash in enumerate(hashes):
+        index.add(perceptual_hash, number)
+    for query in hashes[:20]:
+        expected = {
+            number
+            for number, other in enumerate(hashes)
+            if PerceptualHash.distance(query, other) <= 24
+        }
+        assert {number for _, number in index.search(query, 24)} == expected
+
+    entity = ImageGenerationDb.Entity
+    gradient.save(tmp_path / "100.png")
+    for backend in ImageGenerationDb.Backend.TINYDB, ImageGenerationDb.Backend.SQLITE:
+        db = ImageGenerationDb(str(tmp_path / f"db.{backend}"), backend=backend)
+        # The first event was logged prior to perceptual hashes.
+        db.write_event({entity.COLUMN_CREATED: 100})
+        db.write_event(
+            {
+                entity.COLUMN_CREATED: 200,
+                entity.COLUMN_IMAGE_ID: "200-ab",
+                entity.COLUMN_PERCEPTUAL_HASH: rescaled,
+            }
+        )
+        similar = db.find_similar_events(original)
+        assert [event[entity.COLUMN_IMAGE_ID] for _, event in similar] == ["200-ab"]
+        assert db.find_similar_events(rescaled, exclude_image_id="200-ab") == []
+
+        def locate(event: dict) -> str:
+            filename = tmp_path / f"{event[entity.COLUMN_CREATED]}.png"
+            return str(filename) if filename.exists() else None
+
+        assert backfill(db, locate, max_workers=1) == 1
+        similar = db.find_similar_events(original)
+        assert [event[entity.COLUMN_CREATED] for _, event in similar] == [100, 200]
+        backfilled = db.get_event_log_by_created(100)
+        assert backfilled[entity.COLUMN_PERCEPTUAL_HASH] == original
+        db.close()
+
+    # Archived events are backfilled as well.
+    db = ImageGenerationDb(
+        str(tmp_path / "archived.json"), archive=str(tmp_path / "archive")
+    )
+    db.write_event({entity.COLUMN_CREATED: 100})
+    assert db.rotate_event_log(keep=0) == 1
+    assert backfill(db, locate, max_workers=1) == 1
+    backfilled = db.get_event_log_by_created(100)
+    assert backfilled[entity.COLUMN_PERCEPTUAL_HASH] == original
+    similar = db.find_similar_events(original)
+    assert [event[entity.COLUMN_CREATED] for _, event in similar] == [100]
+    db.close()
+
+
+# 25. Verify that the event log is rotated into its archive, and that archived events are still looked up and searched.
+def test_event_log_rotation(tmp_path):
+    entity = ImageGenerationDb.Entity
+    for backend in ImageGenerationDb.Backend.TINYDB, ImageGenerationDb.Backend.SQLITE:
+        archive = tmp_path / f"archive.{backend}"
+        db = ImageGenerationDb(
+            str(tmp_path / f"db.{backend}"),
+            backend=backend,
+            archive=str(archive),
+            hot_segment_size=3,
+        )
+        # Ten days apart, hence spread over several monthly partitions.
+        created = [1700000000 + day * 86400 for day in range(0, 60, 10)]
+        for value in created:
+            db.write_event(
+                {
+                    entity.COLUMN_CREATED: value,
+                    entity.COLUMN_IMAGE_ID: f"{value}-ab",
+                    entity.COLUMN_PROMPT: f"Subject: harbor {value}",
+                }
+            )
+        # The event log was rotated once it held twice the hot segment.
+        assert len(db.database.table(entity.TABLE_EVENT_LOG)) == 3
+        assert len(list(db.archive)) == 3
+        assert db.archive.partitions() == ["2023-11", "2023-12"]
+        assert db.get_event_log_by_created(created[0])[entity.COLUMN_IMAGE_ID] == (
+            f"{created[0]}-ab"
+        )
+        assert db.get_event_log_by_image_id(f"{created[1]}-ab") is not None
+        assert len(db.get_event_log_by_prompt(f"Subject: harbor {created[2]}")) == 1
+        assert db.search_event_log("harbor")[0] == 6
+
+        # An interrupted rotation (archived, but not yet removed) is not archived twice.
+        db.archive.append(db.database.table(entity.TABLE_EVENT_LOG).all())
+        assert db.rotate_event_log(keep=0) == 3
+        assert len(list(db.archive)) == 6
+
+        # The events of a deleted image are removed (from the archive), as are those of images that no longer exist.
+        assert db.remove_image_events(f"{created[0]}-ab") == 1
+        assert db.get_event_log_by_created(created[0]) is None
+        db.write_event({entity.COLUMN_CREATED: created[1]})
+        kept = {f"{created[5]}-ab", str(created[1])}
+        assert db.sweep_orphaned_events(lambda e: db.image_key(e) in kept) == 4
+        remaining = [*db.archive, *db.database.table(entity.TABLE_EVENT_LOG)]
+        assert sorted(map(db.image_key, remaining)) == sorted(kept)
+        assert db.search_event_log("harbor")[0] == 1
+        db.close()
+
+
+# 26. Verify that a streamed response is decoded as it is received, and yields the same image as a buffered response.
+def test_response_streaming(tmp_path):
+    response = build_image_response(test_created_value)
+    payload = response[ImageGeneration.OpenApi.PAYLOAD_DATA][0]
+    b64_json = payload[ImageGeneration.OpenApi.PAYLOAD_B64_JSON]
+    # The payload key within a string is not a payload, and a JSON encoder may escape the slashes of the base64 text.
+    payload[ImageGeneration.OpenApi.REVISED_PROMPT] = 'A "b64_json": "quoted" prompt.'
+    text = json.dumps(response).replace("/", "\\/").encode("utf-8")
+    for chunk_size in (1, 3, 7, 4096):
+        payload_file = io.BytesIO()
+        stream = ImageResponseStream(payload_file)
+        for offset in range(0, len(text), chunk_size):
+            stream.feed(text[offset : offset + chunk_size])
+        streamed = OpenAiImageDto(stream.close(), payload_file, stream.digest)
+        assert payload_file.getvalue() == base64.b64decode(b64_json)
+        assert streamed.id == OpenAiImageDto(response).id
+        assert streamed.revised_prompt == 'A "b64_json": "quoted" prompt.'
+        assert streamed.streamed and streamed.image.size == (8, 8)
+    truncated = ImageResponseStream(io.BytesIO())
+    truncated.feed(text[: len(text) // 2])
+    try:
+        truncated.close()
+        assert False, "The truncated response should have been rejected."
+    except ValueError:
+        pass
+
+    # Streamed replies are cached as received, and a cache hit yields the very same image.
+    db = ImageGenerationDb(str(tmp_path / "db.json"))
+    cache = ImageGenerationCache(str(tmp_path / "cache"))
+    with MockImageServer(size=(16, 8)) as server:
+        generator = ImageGeneration(db=db, cache=cache, url=server.url, stream=True)
+        first = generator.request_image_generation("First.", test_configuration)
+        first.save_original(str(tmp_path / "first.png"))
+        cached = generator.request_image_generation("First.", test_configuration)
+        assert not cached.streamed and cached.id == first.id
+        assert (tmp_path / "first.png").read_bytes() == cached.bitmap
+        assert first.revised_prompt == "First." and first.image.size == (16, 8)
+        assert db.get_event_log_by_image_id(first.id)["perceptual_hash"]
+        assert server.stats()["served"] == 1
+
+
+# 27. Verify that images are post-processed on the image processing pool: encoded, hashed and downscaled in one pass.
+def test_image_processing_pool(tmp_path):
+    store = ImageStore(str(tmp_path / "img"))
+    derivatives = ImageDerivatives(store, widths=(4, 8, 64))
+    pool = ImageProcessingPool(store, ImageEncoder(), derivatives, max_workers=1)
+    try:
+        image_object = OpenAiImageDto(build_image_response(test_created_value, (16, 8)))
+        processed = pool.process(image_object)
+        assert processed.size == (16, 8) and sorted(processed.renditions) == [4, 8]
+        assert store.get(image_object.id) == {
+            "": processed.encoded_image.filename,
+            ImageDerivatives.variant(8): processed.renditions[8],
+            ImageDerivatives.variant(4): processed.renditions[4],
+        }
+        with Image.open(processed.encoded_image.filename) as encoded:
+            assert encoded.format == "JPEG" and encoded.size == (16, 8)
+        # The perceptual hash is that of the outcome, and the image is not decoded here.
+        assert image_object.perceptual_hash == PerceptualHash.of(
+            OpenAiImageDto(build_image_response(test_created_value, (16, 8))).image
+        )
+        assert image_object._image is None
+
+        # A failure is the outcome of the post-processing, and its temporary files are discarded.
+        response = build_image_response(test_created_value + 1)
+        response[ImageGeneration.OpenApi.PAYLOAD_DATA][0][
+            ImageGeneration.OpenApi.PAYLOAD_B64_JSON
+        ] = base64.b64encode(b"not an image").decode("ascii")
+        try:
+            pool.process(OpenAiImageDto(response))
+            assert False, "The undecodable image should have been reported."
+        except OSError:
+            pass
+        assert not list((tmp_path / "img").glob("**/*.tmp*"))
+    finally:
+        pool.shutdown()
+
+    # A failed post-processing neither fails the (paid) request, nor keeps its event from being logged: the perceptual hash
+    # is then computed in-thread, or else (when the image cannot be decoded at all) left to the backfill.
+    def fail(image_object: OpenAiImageDto) -> None:
+        image_object.processing = Future()
+        image_object.processing.set_exception(RuntimeError("failed"))
+
+    db = ImageGenerationDb(str(tmp_path / "db.json"))
+    processors = Mock(submit=fail), Mock(submit=Mock(side_effect=RuntimeError))
+    responses = build_image_response(test_created_value, (16, 8)), response
+    for processor, reply_body in zip(processors, responses):
+        http_session = Mock()
+        http_session.post.return_value = Mock(
+            ok=True, json=Mock(return_value=reply_body)
+        )
+        generator = ImageGeneration(
+            http_session=http_session, db=db, processor=processor
+        )
+        image_object = generator.request_image_generation("Same.", test_configuration)
+        event = db.get_event_log_by_image_id(image_object.id)
+        assert event[ImageGenerationDb.Entity.COLUMN_PROMPT] == "Same."
+        if reply_body is response:
+            assert event[ImageGenerationDb.Entity.COLUMN_PERCEPTUAL_HASH] is None
+        else:
+            assert event[ImageGenerationDb.Entity.COLUMN_PERCEPTUAL_HASH] == (
+                PerceptualHash.of(image_object.image)
+            )
+
+
+# 28. Verify that identical requests in flight share a single API call and its outcome, from threads and asyncio tasks alike.
+def test_single_flight(tmp_path):
+    db = ImageGenerationDb(str(tmp_path / "db.json"))
+    with MockImageServer(size=(16, 8), latency=0.3) as server:
+        generator = ImageGeneration(
+            http_session=PooledHttpSession(max_retries=0), db=db, url=server.url
+        )
+        outcomes = []
+
+        def request(prompt: str) -> None:
+            try:
+                outcomes.append(
+                    generator.request_image_generation(prompt, test_configuration)
+                )
+            except RuntimeError as e:
+                outcomes.append(e)
+
+        threads = [threading.Thread(target=request, args=("Same.",)) for _ in range(4)]
+        threads.append(threading.Thread(target=request, args=("Other.",)))
+        for thread in threads:
+            thread.start()
+        time.sleep(0.1)
+        body = generator.build_image_request_body("Same.", test_configuration)
+        assert generator.single_flight.waiters(ImageGenerationCache.key(body)) == 4
+        for thread in threads:
+            thread.join()
+        assert server.stats()["served"] == 2
+        assert len({id(image) for image in outcomes}) == 2
+        assert generator.single_flight.stats() == {
+            "calls": 2,
+            "coalesced": 3,
+            "in_flight": 0,
+            "waiters": 0,
+        }
+
+        async def request_all(count: int) -> list:
+            return await asyncio.gather(
+                *(
+                    generator.request_image_generation_async(
+                        "Async.", test_configuration
+                    )
+                    for _ in range(count)
+                ),
+                return_exceptions=True,
+            )
+
+        images = asyncio.run(request_all(3))
+        assert server.stats()["served"] == 3
+        assert images[0] is images[1] is images[2]
+        assert db.get_event_log_by_image_id(images[0].id) is not None
+
+        # A failure is raised to every request that joined the call.
+        server.error_rate = 1.0
+        errors = asyncio.run(request_all(3))
+        assert all(isinstance(error, RuntimeError) for error in errors)
+        assert server.stats()["errors"] == 1
+
+        # Once completed, the call is made anew (i.e. the outcome is not cached).
+        server.error_rate = 0.0
+        outcomes.clear()
+        request("Same.")
+        assert server.stats()["served"] == 4
+
+
+# 29. Verify that the prompts are embedded in the image files, read back without decoding them, and rebuild the event log.
+def test_image_metadata(tmp_path):
+    metadata = {"prompt": 'A "quoted" <prompt> & café.', "created": test_created_value}
+    for mode in ImageEncoder.EXTENSIONS:
+        encoder = ImageEncoder(mode)
+        image_object = OpenAiImageDto(build_image_response(test_created_value, (16, 8)))
+        image_object.metadata = metadata
+        filename = str(tmp_path / f"{mode}{encoder.extension}")
+        encoder.encode(image_object, filename)
+        assert ImageMetadata.read(filename) == metadata
+        with Image.open(filename) as image:
+            image.load()
+            assert image.size == (16, 8)
+    # The JPEG encoder writes the packet in an XMP APP1 segment (which Pillow only writes as of 11.0).
+    with Image.open(tmp_path / "jpeg.jpg") as image:
+        assert ImageMetadata.parse(image.info["xmp"]) == metadata
+    image_object.metadata = None
+    encoder.encode(image_object, str(tmp_path / "bare.jpg"))
+    assert ImageMetadata.read(str(tmp_path / "bare.jpg")) is None
+
+    db = ImageGenerationDb(str(tmp_path / "db.json"))
+    store = ImageStore(str(tmp_path / "img"))
+    with MockImageServer(size=(16, 8)) as server, patch.object(
+        project, "image_store", lambda: store
+    ):
+        generator = ImageGeneration(db=db, url=server.url, stream=True)
+        image_object = generator.request_image_generation("First.", test_configuration)
+        project.write_image_to_disk(image_object)
+        prompts = project.request_image_prompts_handler(image_object.id)
+        assert prompts["prompt"] == "First." and prompts["revised_prompt"] == "First."
+        assert prompts["configuration"][ImageGeneration.OpenApi.IMAGE_STYLE] == "vivid"
+
+        # The event log is rebuilt from the image files alone.
+        rebuilt = ImageGenerationDb(str(tmp_path / "rebuilt.json"))
+        assert rebuild_event_log(rebuilt, store) == 1
+        assert rebuild_event_log(rebuilt, store) == 0
+        event = rebuilt.get_event_log_by_image_id(image_object.id)
+        assert event["prompt"] == "First." and event["size"] == test_dimension
+
+
+def temporary_folder() -> pathlib.Path:
+    return pathlib.Path(tempfile.mkdtemp())
+
+
+def build_image_response(created: int, size: tuple[int, int] = (8, 8)) -> dict:
+    buffer = BytesIO()
+    Image.new("RGBA", size, (32, 64, 128, 255)).save(buffer, "PNG")
+    return {
+        ImageGeneration.OpenApi.IMAGE_TIMESTAMP: created,
+        ImageGeneration.OpenApi.PAYLOAD_DATA: [
+            {
+                ImageGeneration.OpenApi.PAYLOAD_B64_JSON: base64.b64encode(
+                    buffer.getvalue()
+                ).decode("ascii"),
+                ImageGeneration.OpenApi.REVISED_PROMPT: test_prompt_string,
+            }
+        ],
+    }
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
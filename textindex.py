@@ -0,0 +1,135 @@
+import bisect
+import heapq
+import math
+import re
+
+from collections import Counter
+
+
+# Single Responsibility Principle (SRP): This class has the single responsibility of finding documents by their wording.
+# It is an inverted index, which maps each term (a lowercase word) to the documents that contain it, along with the number
+# of occurrences, so a search only visits the documents that contain the searched terms, rather than every document.
+# Documents are added incrementally, and searches are ranked by relevance (Okapi BM25): rare terms weigh more than common
+# ones, and a term weighs more in a short text than in a long one.  Every searched term must occur in a matching document,
+# and the last searched term also matches the terms that it prefixes (i.e. so a search can be run as the user types).
+# The index is not thread-safe; its owner is expected to serialize access to it.
+class TextIndex:
+    TERM_PATTERN = re.compile(r"\w+")
+    # Words that occur in nearly every prompt, which are neither indexed nor searched.
+    STOP_WORDS = frozenset(
+        {"a", "an", "and", "as", "at", "be", "by", "for", "in", "is", "it"}
+        | {"of", "on", "or", "that", "the", "this", "to", "with"}
+    )
+    # Upper bound on the number of terms that the last searched term expands to (as a prefix).
+    MAX_PREFIX_TERMS = 64
+    PAGE_SIZE = 20
+    # Okapi BM25 parameters: term frequency saturation (K1), and document length normalization (B).
+    K1 = 1.2
+    B = 0.75
+
+    def __init__(self):
+        self._documents = list[object]()
+        self._lengths = list[int]()
+        self._total_length = 0
+        # Term to the term frequency per document (by document number).
+        self._postings = dict[str, dict[int, int]]()
+        # Sorted vocabulary, so a prefix maps to a contiguous range of terms.  It is sorted upon the first search, rather than
+        # upon each added term, so the bulk of the index is built in linear time.
+        self._terms = None
+
+    def __len__(self) -> int:
+        return len(self._documents)
+
+    @classmethod
+    def tokenize(cls, text: str) -> list[str]:
+        return [
+            term
+            for term in cls.TERM_PATTERN.findall(text.casefold())
+            if term not in cls.STOP_WORDS
+        ]
+
+    # Indexes the document under the terms of its texts (e.g. its prompt and revised prompt).
+    def add(self, document: object, *texts: str) -> None:
+        number = len(self._documents)
+        terms = [term for text in texts if text for term in self.tokenize(text)]
+        self._documents.append(document)
+        self._lengths.append(len(terms))
+        self._total_length += len(terms)
+        for term, frequency in Counter(terms).items():
+            postings = self._postings.get(term)
+            if postings is None:
+                postings = self._postings[term] = {}
+                if self._terms is not None:
+                    bisect.insort(self._terms, term)
+            postings[number] = frequency
+
+    def clear(self) -> None:
+        self._documents.clear()
+        self._lengths.clear()
+        self._total_length = 0
+        self._postings.clear()
+        self._terms = None
+
+    # The page of the documents that match the query, best match first (the most recently added first, among equals),
+    # along with their relevance score, and the total number of matching documents.
+    def search(
+        self, query: str, offset: int = 0, limit: int = PAGE_SIZE
+    ) -> tuple[int, list[tuple[object, float]]]:
+        terms = self.tokenize(query)
+        if not terms or not self._documents:
+            return 0, []
+        # Each searched term matches a group of indexed terms (several for the last one, as a prefix).
+        groups = [[term] for term in terms[:-1]] + [self._expand(terms[-1])]
+        groups = [
+            [self._postings[t] for t in group if t in self._postings]
+            for group in groups
+        ]
+        if not all(groups):
+            return 0, []
+        # Candidates are drawn from the most selective group, and then filtered by membership in the other groups, so
+        # the documents of a common term are never visited as a whole.
+        groups.sort(key=lambda group: sum(map(len, group)))
+        candidates = set[int]().union(*groups[0])
+        for group in groups[1:]:
+            candidates = {
+                number
+                for number in candidates
+                if any(number in postings for postings in group)
+            }
+
+        scores = dict.fromkeys(candidates, 0.0)
+        average_length = self._total_length / len(self._documents) or 1.0
+        for group in groups:
+            for postings in group:
+                weight = self._idf(len(postings)) * (self.K1 + 1)
+                for number in candidates:
+                    frequency = postings.get(number)
+                    if frequency:
+                        length = self._lengths[number] / average_length
+                        norm = self.K1 * (1 - self.B + self.B * length)
+                        scores[number] += weight * frequency / (frequency + norm)
+
+        page = heapq.nsmallest(
+            offset + limit, candidates, key=lambda number: (-scores[number], -number)
+        )[offset:]
+        return len(candidates), [
+            (self._documents[number], scores[number]) for number in page
+        ]
+
+    # Indexed terms that start with the prefix (including the prefix itself, when indexed).
+    def _expand(self, prefix: str) -> list[str]:
+        if self._terms is None:
+            self._terms = sorted(self._postings)
+        start = bisect.bisect_left(self._terms, prefix)
+        terms = []
+        for term in self._terms[start : start + self.MAX_PREFIX_TERMS]:
+            if not term.startswith(prefix):
+                break
+            terms.append(term)
+        return terms or [prefix]
+
+    def _idf(self, document_frequency: int) -> float:
+        count = len(self._documents)
+        return math.log(
+            1 + (count - document_frequency + 0.5) / (document_frequency + 0.5)
+        )